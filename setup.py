@@ -114,6 +114,7 @@ ext_modules = [
         include_dirs=[
             str(get_pybind_include()),
             str(get_pybind_include(user=True)),
+            "src/capgenie",
             "src/capgenie/edlib",
         ],
         extra_link_args=link_args,
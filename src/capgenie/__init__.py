@@ -0,0 +1,18 @@
+# The Python API (see api.py for implementation) is imported on first use, so
+# `import capgenie` (the CLI, map-reduce and daemon workers) doesn't load
+# pandas and every engine just to expose it.
+
+__all__ = ["count", "count_libraries", "count_demultiplexed", "cache_reads", "scan_fastq", "denoise_mask", "count_sample",
+           "count_directory", "average", "aggregate", "matrix", "load_matrix", "export_session", "lookup_peptide", "top",
+           "enrich", "save"]
+
+
+def __getattr__(name):
+    if name in __all__:
+        from capgenie import api
+        return getattr(api, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
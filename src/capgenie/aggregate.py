@@ -0,0 +1,162 @@
+# File that keeps running aggregates of the replicates (FASTQ files) of a data
+# directory, so the average and enrichment tables are updated in
+# O(variants of the changed files) when files are added to, replaced in or
+# removed from a directory, instead of re-reading and re-merging every per file
+# table. Per peptide the aggregate holds the number of replicates it was seen
+# in, the sum and the sum of squares of its Decimal, and per replicate the
+# Decimal of each of its peptides (membership, also the per file columns of the
+# average table). It is pickled with the session next to the average table
+# (pkl_files/<dir>/aggregate_<dir>.pkl).
+
+import hashlib
+import math
+import pandas as pd
+from pandas import DataFrame
+
+
+"""
+ * table_digest: DataFrame --> str
+-- Fingerprint of the Peptide/Decimal columns of a count table, to notice a
+-- replicate whose table changed since it was aggregated
+ * @param [in] table (DataFrame) - Count table (Peptide, Count, Decimal)
+ * @param [out] digest (str) - Hex digest
+"""
+def table_digest(table):
+    hashes = pd.util.hash_pandas_object(table[["Peptide", "Decimal"]], index=False)
+    return hashlib.sha1(hashes.values.tobytes()).hexdigest()
+
+
+class replicate_aggregate:
+    def __init__(self):
+        self.files = {} # Replicate --> digest of the table it was added from
+        self.values = {} # Replicate --> {peptide: Decimal}
+        self.count = {} # Peptide --> number of replicates it is in
+        self.sum = {} # Peptide --> sum of Decimal
+        self.sumsq = {} # Peptide --> sum of Decimal squared
+
+    """
+    add: str, DataFrame, str --> None
+    -- Adds a replicate, O(variants of its table)
+    * @param [in] file (str) - Replicate (FASTQ file) name
+    * @param [in] table (DataFrame) - Its count table
+    * @param [in] digest (str) - table_digest of the table, computed if not given
+    """
+    def add(self, file, table, digest=None):
+        if file in self.files:
+            raise ValueError(f"{file} is already aggregated, remove it first")
+        values = dict(zip(table.Peptide, table.Decimal))
+        for peptide, value in values.items():
+            self.count[peptide] = self.count.get(peptide, 0) + 1
+            self.sum[peptide] = self.sum.get(peptide, 0.0) + value
+            self.sumsq[peptide] = self.sumsq.get(peptide, 0.0) + value * value
+        self.values[file] = values
+        self.files[file] = digest if digest else table_digest(table)
+
+    """
+    remove: str --> None
+    -- Removes a replicate, O(variants of its table)
+    * @param [in] file (str) - Replicate name
+    """
+    def remove(self, file):
+        values = self.values.pop(file)
+        del self.files[file]
+        for peptide, value in values.items():
+            self.count[peptide] -= 1
+            if self.count[peptide]:
+                self.sum[peptide] -= value
+                self.sumsq[peptide] -= value * value
+            else: # Dropped exactly, so no rounding error is left behind
+                del self.count[peptide], self.sum[peptide], self.sumsq[peptide]
+
+    """
+    update: list, dict, callable --> list
+    -- Makes the aggregate hold exactly the given replicates: removes the ones
+    -- no longer listed, replaces the ones whose table changed and adds new ones
+    * @param [in] files (list) - Replicate names, in column order
+    * @param [in] tables (dict) - Replicate --> count table already in memory
+    * @param [in] load (callable) - Loads the table of a new replicate that is not in tables
+    * @param [out] changed (list) - Replicates that were added, replaced or removed
+    ** Replicates that are aggregated and not in tables are kept as they are,
+    ** so their tables are never reloaded
+    """
+    def update(self, files, tables, load):
+        changed = [file for file in self.files if file not in files]
+        for file in changed:
+            self.remove(file)
+        for file in files:
+            if file in tables:
+                digest = table_digest(tables[file])
+                if self.files.get(file) == digest:
+                    continue
+                if file in self.files:
+                    self.remove(file)
+                self.add(file, tables[file], digest)
+            elif file not in self.files:
+                self.add(file, load(file))
+            else:
+                continue
+            changed.append(file)
+        # Column order follows the listing order of this run
+        self.values = {file: self.values[file] for file in files}
+        self.files = {file: self.files[file] for file in files}
+        return changed
+
+    """
+    average_table: None --> DataFrame
+    -- Same table as search_aav9.avg_table on the aggregated replicates
+    * @param [out] merged_df (DataFrame) - One column per replicate plus Average Decimal, indexed by Peptide
+    """
+    def average_table(self):
+        files = list(self.values)
+        merged_df = DataFrame({file: pd.Series(values, dtype=float) for file, values in self.values.items()},
+                              index=pd.Index(list(self.count), name="Peptide"), columns=files)
+        merged_df["Average Decimal"] = [self.sum[peptide] / self.count[peptide] for peptide in merged_df.index]
+        merged_df = merged_df.sort_values("Average Decimal", ascending=False)
+        return merged_df
+
+    """
+    summary: None --> DataFrame
+    -- Replicate statistics of every peptide from the running sums
+    * @param [out] df (DataFrame) - Replicates, Average Decimal and Std Decimal (sample
+    -- standard deviation, 0 for a single replicate), indexed by Peptide
+    """
+    def summary(self):
+        rows = {}
+        for peptide, n in self.count.items():
+            mean = self.sum[peptide] / n
+            variance = (self.sumsq[peptide] - n * mean * mean) / (n - 1) if n > 1 else 0.0
+            rows[peptide] = [n, mean, math.sqrt(max(variance, 0.0))]
+        df = DataFrame.from_dict(rows, orient="index", columns=["Replicates", "Average Decimal", "Std Decimal"])
+        df.index.name = "Peptide"
+        return df.sort_values("Average Decimal", ascending=False)
+
+    """
+    enrichment_table: DataFrame, list --> DataFrame
+    -- Same table as enrichment.enrichment_table on the aggregated replicates,
+    -- looking up only the peptides of the pre insert table
+    * @param [in] pre_insert_table (DataFrame) - Count table (Peptide, Decimal) of the pre insert file
+    * @param [in] exclude (list) - Replicates left out (e.g. the pre insert file itself)
+    * @param [out] df (DataFrame) - One enrichment column per replicate plus Average_Enrichment, indexed by Peptide
+    """
+    def enrichment_table(self, pre_insert_table, exclude=()):
+        pre_insert_dict = {x: y for x, y in zip(pre_insert_table.Peptide, pre_insert_table.Decimal) if y != 0}
+        files = [file for file in self.values if file not in exclude]
+        excluded = [self.values[file] for file in exclude if file in self.values]
+
+        rows = {}
+        for key, pre_insert_value in pre_insert_dict.items():
+            n = self.count.get(key, 0)
+            if not n:
+                continue
+            total = self.sum[key]
+            for values in excluded:
+                if key in values:
+                    n -= 1
+                    total -= values[key]
+            if n:
+                rows[key] = [self.values[file].get(key, math.nan) / pre_insert_value for file in files] + [total / n / pre_insert_value]
+
+        df = DataFrame.from_dict(rows, orient="index", columns=files + ["Average_Enrichment"])
+        df.index.name = "Peptide"
+        df = df.sort_values("Average_Enrichment", ascending=False)
+        return df
@@ -0,0 +1,323 @@
+# File that exposes the pipeline as plain Python functions. Every stage returns
+# a pandas DataFrame that can be handed straight to the next one, and nothing is
+# written to disk unless save() is called, so no session or prompt is needed:
+#
+#   tables = capgenie.count_directory("project/tissueA", capsid_file="capsids.csv")
+#   avg = capgenie.average(tables)
+#   enriched = capgenie.enrich(tables, "tissueA_pre.fastq")
+#   capgenie.save(enriched, "out/enrichment.xlsx")
+
+import os
+import tempfile
+import pandas as pd
+from capgenie.search_aav9 import search_aav9
+from capgenie.enrichment import enrichment
+from capgenie.aggregate import replicate_aggregate
+from capgenie.count_matrix import count_matrix
+from capgenie.library import library_index
+from capgenie import threads as native_threads
+from capgenie import multilib
+from capgenie.demux import barcode_sheet
+from capgenie import readcache
+from capgenie import quality_mask
+from capgenie import fastq
+from capgenie import mani
+from capgenie import ranking
+from capgenie import session_export
+from capgenie.peptide_index import peptide_index
+from capgenie.preview import sample_fastq, estimate_table
+
+
+"""
+ * _counter: int, float, telemetry --> search_aav9
+-- Returns a search_aav9 instance without a session, so scratch folders go to
+-- the temp folder and no pkl files or instructions are written
+ * @param [in] jobs (int) - Worker processes per FASTQ file
+ * @param [in] out_of_core (float) - Memory budget in MB for out-of-core counting, None for in memory
+ * @param [in] telemetry_instance (telemetry) - Optional telemetry to record stages into
+ * @param [in] mask (str) - Optional quality mask file of fastq_file, failing reads are skipped
+ * @param [in] fastq_file (str) - FASTQ file the mask belongs to
+ * @param [out] instance (search_aav9) - Configured instance
+"""
+def _counter(jobs=1, out_of_core=None, telemetry_instance=None, mask=None, fastq_file=None):
+    instance = search_aav9(telemetry_instance)
+    if mask:
+        instance.quality_masks[os.path.abspath(fastq_file)] = mask
+    instance.workers = int(jobs)
+    if out_of_core:
+        instance.out_of_core_budget = int(float(out_of_core) * 1024 * 1024)
+    return instance
+
+"""
+ * count: str, ... --> DataFrame
+-- Counts the variants of one FASTQ file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] capsid_file (str) - Capsid CSV for known variants
+ * @param [in] mismatches (int) - Allowed mismatches for known variants (0 = exact)
+ * @param [in] indels (bool) - Whether mismatches may be indels as well as substitutions
+ * @param [in] flanks (tuple) - (upstream, downstream) flanks for unknown variants
+ * @param [in] refseq (str) - Reference sequence for unknown variants without flanks
+ * @param [in] jobs (int) - Worker processes for the file (see mapreduce.py)
+ * @param [in] out_of_core (float) - Memory budget in MB for out-of-core flank counting
+ * @param [in] telemetry_instance (telemetry) - Optional telemetry to record stages into
+ * @param [in] threads (int) - Resizes the native thread pools (see threads.py), None keeps the current size
+ * @param [in] both_strands (bool) - Also count reverse complement matches, in the same pass
+ * @param [in] mask (str) - Quality mask file from denoise_mask, failing reads are skipped
+ * @param [out] table (DataFrame) - Peptide, Count and Decimal columns (plus Forward Count
+-- and Reverse Count with both_strands)
+** Same table the CLI pickles under pkl_files/<dir>/(unknown_)variants_<file>.pkl
+"""
+def count(fastq_file, capsid_file=None, mismatches=0, indels=False, flanks=None, refseq=None, jobs=1, out_of_core=None, telemetry_instance=None, threads=None, both_strands=False, mask=None):
+    if threads:
+        native_threads.configure(threads)
+    instance = _counter(jobs, out_of_core, telemetry_instance, mask, fastq_file)
+    instance.both_strands = both_strands
+    data_directory = os.path.basename(os.path.dirname(os.path.abspath(fastq_file)))
+
+    if capsid_file:
+        library = library_index.load(capsid_file)
+        if mismatches:
+            return instance.fuzzy_match_table(library.peptide_map, fastq_file, int(mismatches), not indels, data_directory)
+        automaton = library.strand_automaton if both_strands else library.automaton
+        return instance.count_known_table(library.peptide_map, fastq_file, automaton, data_directory)
+    if flanks:
+        upstream, downstream = flanks
+        return instance.flank_table(upstream, downstream, fastq_file, data_directory)
+    if refseq:
+        return instance.filter_count_table(fastq_file, refseq, data_directory)
+    raise ValueError("One of capsid_file, flanks or refseq must be given")
+
+"""
+ * count_libraries: str, list, ... --> dict
+-- Counts several libraries in one pass over a FASTQ file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] libraries (list) - Spec strings, e.g. ["AAV9=capsids.csv", "7mer=flanks:UP:DOWN"], or a multilib.tagged_matcher
+ * @param [in] mismatches (int) - Allowed mismatches for capsid libraries (0 = exact)
+ * @param [in] indels (bool) - Whether mismatches may be indels as well as substitutions
+ * @param [in] jobs (int) - Worker processes for the file (see mapreduce.py)
+ * @param [in] telemetry_instance (telemetry) - Optional telemetry to record stages into
+ * @param [in] threads (int) - Resizes the native thread pools (see threads.py), None keeps the current size
+ * @param [out] tables (dict) - Library name --> the table count() returns for that library alone
+** Pass a tagged_matcher to reuse the compiled libraries across files
+"""
+def count_libraries(fastq_file, libraries, mismatches=0, indels=False, jobs=1, telemetry_instance=None, threads=None):
+    if threads:
+        native_threads.configure(threads)
+    matcher = libraries if isinstance(libraries, multilib.tagged_matcher) else multilib.tagged_matcher(libraries, mismatches, not indels)
+    data_directory = os.path.basename(os.path.dirname(os.path.abspath(fastq_file)))
+    return _counter(jobs, None, telemetry_instance).library_tables(matcher, fastq_file, data_directory)
+
+"""
+ * count_demultiplexed: str, str or dict, list, ... --> dict
+-- Demultiplexes a pooled FASTQ file by inline sample barcodes and counts
+-- every sample in the same pass
+ * @param [in] fastq_file (str) - Path to the pooled FASTQ file
+ * @param [in] barcodes (str or dict) - Barcode sheet path (Sample,Barcode CSV), or sample --> barcode
+ * @param [in] libraries (list) - Library specs or a tagged_matcher (see count_libraries)
+ * @param [in] barcode_mismatches (int) - Mismatches allowed per barcode
+ * @param [in] mismatches (int) - Allowed mismatches for capsid libraries (0 = exact)
+ * @param [in] indels (bool) - Whether mismatches may be indels as well as substitutions
+ * @param [in] jobs (int) - Worker processes for the file (see mapreduce.py)
+ * @param [in] telemetry_instance (telemetry) - Optional telemetry to record stages into
+ * @param [in] threads (int) - Resizes the native thread pools (see threads.py), None keeps the current size
+ * @param [out] tables (dict) - Sample --> library name --> table
+"""
+def count_demultiplexed(fastq_file, barcodes, libraries, barcode_mismatches=1, mismatches=0, indels=False, jobs=1, telemetry_instance=None, threads=None):
+    if threads:
+        native_threads.configure(threads)
+    sheet = barcode_sheet.load(barcodes, barcode_mismatches) if isinstance(barcodes, str) else barcode_sheet(barcodes, barcode_mismatches)
+    matcher = libraries if isinstance(libraries, multilib.tagged_matcher) else multilib.tagged_matcher(libraries, mismatches, not indels)
+    data_directory = os.path.basename(os.path.dirname(os.path.abspath(fastq_file)))
+    return _counter(jobs, None, telemetry_instance).demux_tables(matcher, sheet, fastq_file, data_directory)
+
+"""
+ * cache_reads: str, bool --> str
+-- Converts a FASTQ file once into its binary read cache (see readcache.py),
+-- which every later count of the file reads instead of the text
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] quality (bool) - Also store the mean quality of every read (readcache.read_cache.quality)
+ * @param [out] path (str) - Path of the cache file
+"""
+def cache_reads(fastq_file, quality=False):
+    return readcache.convert(fastq_file, quality)
+
+"""
+ * scan_fastq: str, int --> dict
+-- Reads a FASTQ file once natively for its read statistics and a chunk plan (see fastq.scan)
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] parts (int) - Number of record-aligned byte ranges to plan
+ * @param [out] scan (dict) - reads, length_histogram, mean_length, mean_quality, phred_offset,
+-- compression, complete, malformed_reads, split_points and ranges
+"""
+def scan_fastq(fastq_file, parts=1):
+    return fastq.scan(fastq_file, int(parts))
+
+"""
+ * denoise_mask: str, int, str --> DenoiseResult
+-- Denoises a FASTQ file into a pass/fail quality mask instead of a filtered copy
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] threshold (int) - Minimum average read quality
+ * @param [in] folder (str) - Folder for the mask file, the temp folder by default
+ * @param [out] stats (DenoiseResult) - Denoise statistics, output_filename is the mask to pass to count(mask=...)
+"""
+def denoise_mask(fastq_file, threshold, folder=None):
+    folder = folder if folder else tempfile.gettempdir()
+    return quality_mask.build(fastq_file, quality_mask.mask_path(folder, fastq_file), threshold)
+
+"""
+ * count_sample: str, int, **options --> DataFrame
+-- Counts an even sample of a FASTQ file's reads (see preview.py), to check
+-- counting options in seconds before counting the whole file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] reads (int) - Reads to sample
+ * @param [in] options (dict) - Keyword arguments for count(), except mask
+ * @param [out] table (DataFrame) - The count table of the sample with Decimal Low and
+-- Decimal High columns (95% Wilson interval of every Decimal)
+"""
+def count_sample(fastq_file, reads=100000, **options):
+    with tempfile.TemporaryDirectory(prefix="capgenie_preview_") as folder:
+        sample_path = os.path.join(folder, os.path.basename(fastq_file))
+        sample_fastq(fastq_file, int(reads), sample_path)
+        return estimate_table(count(sample_path, **options))
+
+"""
+ * count_directory: str, **options --> dict
+-- Counts every FASTQ file in a directory
+ * @param [in] directory (str) - Directory with FASTQ files
+ * @param [in] options (dict) - Keyword arguments for count()
+ * @param [out] tables (dict) - File name --> count table, in directory listing order
+"""
+def count_directory(directory, **options):
+    return {file: count(os.path.join(directory, file), **options) for file in os.listdir(directory) if file.endswith(".fastq")}
+
+"""
+ * average: dict --> DataFrame
+-- Averages the Decimal column of several count tables
+ * @param [in] tables (dict) - File name --> count table, e.g. from count_directory
+ * @param [out] table (DataFrame) - One column per file plus Average Decimal, indexed by Peptide
+"""
+def average(tables):
+    return search_aav9().avg_table(tables)
+
+"""
+ * aggregate: dict, replicate_aggregate --> replicate_aggregate
+-- Running replicate aggregate of count tables, for averages that are updated
+-- file by file (add / remove) instead of recomputed
+ * @param [in] tables (dict) - File name --> count table
+ * @param [in] aggregate_instance (replicate_aggregate) - Optional aggregate to bring up to date, a new one by default
+ * @param [out] aggregate (replicate_aggregate) - Aggregate of exactly these tables (see aggregate.py for
+-- average_table, enrichment_table and summary)
+"""
+def aggregate(tables, aggregate_instance=None):
+    aggregate_instance = aggregate_instance if aggregate_instance is not None else replicate_aggregate()
+    aggregate_instance.update(list(tables), tables, tables.get)
+    return aggregate_instance
+
+"""
+ * matrix: dict, str --> count_matrix
+-- Sparse samples x peptides matrix of count tables, for vectorized averages,
+-- enrichments and comparisons across data directories
+ * @param [in] tables (dict) - Data directory --> {file name: count table}, e.g. from count_directory
+ * @param [in] kind (str) - Instructions key recorded with the samples
+ * @param [out] matrix (count_matrix) - The matrix (see count_matrix.py for average, enrichment
+-- and directory_averages)
+"""
+def matrix(tables, kind="count_known_reads"):
+    instance = count_matrix()
+    for directory, directory_tables in tables.items():
+        instance.update_directory(directory, directory_tables, kind)
+    return instance
+
+"""
+ * load_matrix: str --> count_matrix
+-- Loads the count matrix a CLI session saved
+ * @param [in] session (str) - Session name (in the cache folder) or path to a count_matrix.pkl
+ * @param [out] matrix (count_matrix) - The session's matrix
+"""
+def load_matrix(session):
+    if os.path.isfile(session):
+        return count_matrix.load(session)
+    return count_matrix.load(os.path.join(os.path.expanduser(mani.get_cache_folder()), session, "pkl_files", "count_matrix.pkl"))
+
+"""
+ * export_session: str, str, str, bool --> dict
+-- Exports a CLI session like -o, linking files where it can
+ * @param [in] session (str) - Session name (in the cache folder) or path to a session folder
+ * @param [in] output_dir (str) - Output folder
+ * @param [in] profile (str) - tables, plots or all
+ * @param [in] archive (bool) - Stream one compressed tar archive into output_dir instead
+ * @param [out] summary (dict) - See session_export.export_folder / export_archive
+"""
+def export_session(session, output_dir, profile="all", archive=False):
+    session_dir = session if os.path.isdir(session) else os.path.join(os.path.expanduser(mani.get_cache_folder()), session)
+    if archive:
+        return session_export.export_archive(session_dir, session_export.archive_path(output_dir, os.path.basename(os.path.normpath(session_dir))), profile)
+    return session_export.export_folder(session_dir, output_dir, profile)
+
+"""
+ * lookup_peptide: str, bool, list, bool --> DataFrame
+-- How a peptide did in every CLI session of the cache folder, from the
+-- cross-session peptide index
+ * @param [in] peptide (str) - Peptide, or prefix with prefix=True
+ * @param [in] prefix (bool) - Match every peptide starting with peptide
+ * @param [in] sessions (list) - Session names to look in, None for all
+ * @param [in] update (bool) - Index new or changed sessions first
+ * @param [out] table (DataFrame) - One row per sample listing the peptide: Peptide, Session, Directory,
+-- File (None for the directory's average), Kind, Count, Decimal, Enrichment (see peptide_index.py)
+"""
+def lookup_peptide(peptide, prefix=False, sessions=None, update=True):
+    index = peptide_index()
+    try:
+        if update:
+            index.update(sessions)
+        return index.lookup(peptide, prefix, sessions)
+    finally:
+        index.close()
+
+"""
+ * top: DataFrame, int, str --> DataFrame
+-- The n highest rows of a count, average or enrichment table, without sorting the whole table
+ * @param [in] table (DataFrame) - Table from count, average or enrich
+ * @param [in] n (int) - Number of rows
+ * @param [in] column (str) - Column to rank by, Average_Enrichment, Average Decimal or Decimal by default
+ * @param [out] rows (DataFrame) - Highest first, ties in table order
+"""
+def top(table, n, column=None):
+    return ranking.top(table, n, column)
+
+"""
+ * enrich: dict, str or DataFrame --> DataFrame
+-- Calculates the enrichment of count tables against a pre insert table
+ * @param [in] tables (dict) - File name --> count table
+ * @param [in] pre_insert (str or DataFrame) - Key of the pre insert table in tables, or the table itself
+ * @param [out] table (DataFrame) - One column per file plus Average_Enrichment, indexed by Peptide
+"""
+def enrich(tables, pre_insert):
+    if isinstance(pre_insert, pd.DataFrame):
+        return enrichment.enrichment_table(pre_insert, tables)
+    if pre_insert not in tables:
+        raise KeyError(f"Pre insert table {pre_insert} is not one of the tables")
+    others = {file: table for file, table in tables.items() if file != pre_insert}
+    return enrichment.enrichment_table(tables[pre_insert], others)
+
+"""
+ * save: DataFrame, str --> str
+-- Persists a table, the format is picked from the file extension
+ * @param [in] table (DataFrame) - Table from count, average or enrich
+ * @param [in] path (str) - Destination ending in .pkl, .csv or .xlsx
+ * @param [out] path (str) - The written path
+"""
+def save(table, path):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".pkl":
+        table.to_pickle(path)
+    elif extension == ".csv":
+        table.to_csv(path)
+    elif extension == ".xlsx":
+        table.to_excel(path)
+    else:
+        raise ValueError(f"Unsupported table format: {extension} (use .pkl, .csv or .xlsx)")
+    return path
@@ -5,6 +5,7 @@ import os
 import random
 import numpy as np
 import warnings
+from capgenie.ranking import top # See ranking.py for implementation
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -43,10 +44,11 @@ def gen_bubble_plots(bubble_dir, session_dir, dir, cache_folder):
     
     enrich_df = pd.read_pickle(os.path.join(cache_folder, session_dir, "pkl_files", dir, f"average_enrichment_{dir}.pkl"))
     normal_df = pd.read_pickle(os.path.join(cache_folder, session_dir, "pkl_files", dir, f"average_{dir}.pkl"))
-    peptides = normal_df.index.tolist()[:500]
+    peptides = top(normal_df, 500).index.tolist()
 
-    enrich_df = enrich_df.iloc[:, -1].to_dict()
-    normal_df = normal_df.iloc[:, -1].to_dict()
+    # Only the plotted peptides are looked up
+    enrich_df = enrich_df.iloc[:, -1].reindex(peptides).dropna().to_dict()
+    normal_df = normal_df.iloc[:, -1].reindex(peptides).dropna().to_dict()
 
     temp =list(zip(peptides, [enrich_df[x] if x in enrich_df else 0 for x in peptides], [normal_df[x]*100 if x in normal_df else 0 for x in peptides]))
     random.shuffle(temp)
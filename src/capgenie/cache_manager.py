@@ -0,0 +1,287 @@
+# File that keeps the cache folder (mani.get_cache_folder) under a size cap.
+# Every file is accounted to a session (or to the shared read caches and
+# library indexes) and sorted into a kind:
+#
+#   metadata   - instructions.pkl / instruction.json of a session, always kept
+#   table      - pkl_files and spreadsheets of a session, always kept
+#   chart      - bubble and frequency distribution charts of a session, always kept
+#   denoised   - denoised FASTQ copies (denoised_<dir>), regenerable with -qual
+#   mask       - quality masks (quality_masks), regenerable with -qual -qm
+#   read_cache - binary read caches (.reads), regenerable with -rc
+#   library    - compiled library indexes (.libraries), recompiled on first use
+#   scratch    - leftover map-reduce and shard folders and .tmp files
+#   other      - anything else (e.g. motif output, the peptide index), kept
+#
+# Enforcing the cap first compresses cold (unused for COLD_AGE) read caches and
+# denoised copies with zstd (gzip when the zstandard package is missing). They
+# are restored transparently when they're next opened (see restore). If the
+# folder is still over the cap, the regenerable kinds are evicted least
+# recently used first. "Used" is the access time, which the readers of cached
+# artifacts set explicitly (touch), as many file systems are mounted relatime.
+
+import gzip
+import os
+import shutil
+import time
+from capgenie import mani
+
+try:
+    import zstandard
+except ImportError: # Falls back to gzip
+    zstandard = None
+
+MB = 1024 * 1024
+COLD_AGE = 24 * 3600 # Seconds unused before a compressible artifact is compressed
+COMPRESSION_SUFFIXES = (".zst", ".gz")
+KEPT_KINDS = ("metadata", "table", "chart", "other")
+COMPRESSIBLE_KINDS = ("read_cache", "denoised")
+SESSION_TABLE_FOLDERS = ("pkl_files", "spreadsheets")
+SESSION_CHART_FOLDERS = ("bubble", "freq_distribution")
+SCRATCH_FOLDERS = ("mapreduce", "shards")
+SHARED = {".reads": "read_cache", ".libraries": "library"} # Hidden folders shared by every session --> kind
+CACHE_LIMIT_ENV = "CAPGENIE_CACHE_LIMIT" # Cache cap in MB when -cl isn't given
+
+
+"""
+ * touch: str --> None
+-- Marks a cached artifact as used now (its access time), for LRU eviction
+ * @param [in] path (str) - File or folder
+"""
+def touch(path):
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+"""
+ * compressed_path: str --> str
+-- Returns the compressed copy of an artifact if there is one
+ * @param [in] path (str) - Path of the uncompressed artifact
+ * @param [out] compressed (str) - Path with a COMPRESSION_SUFFIXES suffix, None if there is none
+"""
+def compressed_path(path):
+    for suffix in COMPRESSION_SUFFIXES:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+"""
+ * compress: str --> str
+-- Replaces a file by its zstd (or gzip) compressed copy
+ * @param [in] path (str) - File to compress
+ * @param [out] compressed (str) - Path of the compressed copy
+** The copy keeps the file's access and modification times, so LRU order is unchanged
+"""
+def compress(path):
+    stat = os.stat(path)
+    target = path + (".zst" if zstandard else ".gz")
+    tmp_path = target + ".tmp"
+    with open(path, "rb") as source:
+        if zstandard:
+            with open(tmp_path, "wb") as out:
+                zstandard.ZstdCompressor(level=3).copy_stream(source, out)
+        else:
+            with gzip.open(tmp_path, "wb", compresslevel=6) as out:
+                shutil.copyfileobj(source, out, 1 << 20)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path, target)
+    os.remove(path)
+    return target
+
+"""
+ * restore: str --> bool
+-- Decompresses an artifact compressed by compress, if it is
+ * @param [in] path (str) - Path of the uncompressed artifact
+ * @param [out] restored (bool) - Whether path exists now
+** Used by the readers of compressible artifacts, so compression stays
+** invisible to them. The restored file keeps its modification time (read caches
+** are checked against their source) and is marked as used
+"""
+def restore(path):
+    if os.path.exists(path):
+        return True
+    compressed = compressed_path(path)
+    if compressed is None:
+        return False
+    stat = os.stat(compressed)
+    tmp_path = path + ".tmp"
+    try:
+        if compressed.endswith(".zst"):
+            if zstandard is None:
+                return False
+            with open(compressed, "rb") as source, open(tmp_path, "wb") as out:
+                zstandard.ZstdDecompressor().copy_stream(source, out)
+        else:
+            with gzip.open(compressed, "rb") as source, open(tmp_path, "wb") as out:
+                shutil.copyfileobj(source, out, 1 << 20)
+    except (OSError, EOFError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if isinstance(e, EOFError) or not os.path.exists(compressed):
+            return False # Truncated, or evicted by another process meanwhile
+        raise
+    os.utime(tmp_path, ns=(time.time_ns(), stat.st_mtime_ns))
+    os.replace(tmp_path, path)
+    os.remove(compressed)
+    return True
+
+"""
+ * cache_limit: str --> int
+-- Cache cap in bytes from -cl or CAPGENIE_CACHE_LIMIT
+ * @param [in] limit_mb (str) - -cl value in MB, None to use the environment
+ * @param [out] limit (int) - Bytes, None if neither is set
+"""
+def cache_limit(limit_mb=None):
+    limit_mb = limit_mb if limit_mb else os.environ.get(CACHE_LIMIT_ENV)
+    return int(float(limit_mb) * MB) if limit_mb else None
+
+
+class cache_manager:
+    def __init__(self, limit=None, cache_folder=None, cold_age=COLD_AGE):
+        self.limit = limit # bytes, None for no cap
+        self.cache_folder = cache_folder if cache_folder else os.path.expanduser(mani.get_cache_folder())
+        self.cold_age = cold_age # seconds
+
+    """
+    kind_of: tuple --> tuple
+    -- Sorts a path of the cache folder into an owner and a kind
+    * @param [in] parts (tuple) - Path components relative to the cache folder
+    * @param [out] artifact (tuple) - (owner: session name or shared folder, kind, number of
+    -- leading parts that make up the artifact: library indexes and scratch folders go as a whole)
+    """
+    @staticmethod
+    def kind_of(parts):
+        top = parts[0]
+        if len(parts) == 1:
+            return "", "other", 1
+        if top in SHARED:
+            kind = SHARED[top]
+            if parts[-1].endswith(".tmp") or parts[1].startswith(".build_"):
+                return top, "scratch", 2
+            return top, kind, 2 if kind == "library" else len(parts)
+        if top.startswith("."):
+            return top, "other", len(parts)
+        section = parts[1]
+        if len(parts) == 2 and section in ("instructions.pkl", "instruction.json"):
+            return top, "metadata", 2
+        if section in SCRATCH_FOLDERS:
+            return top, "scratch", 3 if len(parts) > 3 else len(parts)
+        if parts[-1].endswith(".tmp"):
+            return top, "scratch", len(parts)
+        if section.startswith("denoised_") and len(parts) > 2:
+            return top, "denoised", len(parts)
+        if section == "quality_masks":
+            return top, "mask", len(parts)
+        if section in SESSION_TABLE_FOLDERS:
+            return top, "table", len(parts)
+        if section in SESSION_CHART_FOLDERS:
+            return top, "chart", len(parts)
+        return top, "other", len(parts)
+
+    """
+    artifacts: None --> list
+    -- Every artifact of the cache folder
+    * @param [out] artifacts (list) - Dicts with path, owner, kind, bytes, last_used (newest access
+    -- or modification time of its files) and compressed
+    ** An artifact is a file, or a whole library index or scratch folder
+    """
+    def artifacts(self):
+        found = {}
+        for root, _, files in os.walk(self.cache_folder):
+            for name in files:
+                path = os.path.join(root, name)
+                parts = tuple(os.path.relpath(path, self.cache_folder).split(os.sep))
+                owner, kind, depth = self.kind_of(parts)
+                try:
+                    stat = os.lstat(path)
+                except OSError: # Removed meanwhile
+                    continue
+                key = os.path.join(self.cache_folder, *parts[:depth])
+                artifact = found.setdefault(key, {"path": key, "owner": owner, "kind": kind, "bytes": 0, "last_used": 0.0,
+                                                  "compressed": name.endswith(COMPRESSION_SUFFIXES) and depth == len(parts)})
+                artifact["bytes"] += stat.st_size
+                artifact["last_used"] = max(artifact["last_used"], stat.st_atime, stat.st_mtime)
+        return list(found.values())
+
+    """
+    usage: list --> dict
+    -- Bytes per owner and kind
+    * @param [in] artifacts (list) - From artifacts(), scanned when None
+    * @param [out] usage (dict) - Owner --> {"total", "last_used", kind --> bytes}, most recently used first
+    """
+    def usage(self, artifacts=None):
+        artifacts = self.artifacts() if artifacts is None else artifacts
+        owners = {}
+        for artifact in artifacts:
+            owner = owners.setdefault(artifact["owner"], {"total": 0, "last_used": 0.0})
+            owner[artifact["kind"]] = owner.get(artifact["kind"], 0) + artifact["bytes"]
+            owner["total"] += artifact["bytes"]
+            owner["last_used"] = max(owner["last_used"], artifact["last_used"])
+        return dict(sorted(owners.items(), key=lambda item: item[1]["last_used"], reverse=True))
+
+    """
+    _remove: dict --> None
+    -- Deletes an artifact (file or folder)
+    """
+    def _remove(self, artifact):
+        if os.path.isdir(artifact["path"]):
+            shutil.rmtree(artifact["path"], ignore_errors=True)
+        elif os.path.exists(artifact["path"]):
+            os.remove(artifact["path"])
+
+    """
+    enforce: None --> dict
+    -- Compresses cold artifacts and evicts the least recently used regenerable
+    -- ones until the cache folder fits the cap
+    * @param [out] report (dict) - before and after (bytes), limit, compressed (count),
+    -- saved (bytes saved by compression), evicted (list of (path, kind, bytes)) and over_limit
+    ** Metadata, tables, charts and other files are never touched, so a cap below them
+    ** leaves the folder over the limit (over_limit), and scratch files are left
+    ** to the runs that write them until they are cold. Stale compressed copies of
+    ** artifacts that were regenerated since are dropped first
+    """
+    def enforce(self):
+        artifacts = self.artifacts()
+        before = total = sum(artifact["bytes"] for artifact in artifacts)
+        report = {"before": before, "limit": self.limit, "compressed": 0, "saved": 0, "evicted": []}
+        paths = {artifact["path"] for artifact in artifacts}
+        lru = sorted(artifacts, key=lambda artifact: artifact["last_used"])
+
+        for artifact in lru:
+            original = artifact["path"].rsplit(".", 1)[0] if artifact["compressed"] else None
+            if original in paths: # Regenerated after it was compressed
+                self._remove(artifact)
+                total -= artifact["bytes"]
+                report["evicted"].append((artifact["path"], artifact["kind"], artifact["bytes"]))
+                artifact["bytes"] = 0
+
+        if self.limit is not None:
+            now = time.time()
+            for artifact in lru:
+                if (artifact["kind"] in COMPRESSIBLE_KINDS and not artifact["compressed"] and artifact["bytes"]
+                        and now - artifact["last_used"] > self.cold_age):
+                    try:
+                        artifact["path"] = compress(artifact["path"])
+                    except OSError: # Removed or in use meanwhile
+                        continue
+                    size = os.path.getsize(artifact["path"])
+                    report["compressed"] += 1
+                    report["saved"] += artifact["bytes"] - size
+                    total -= artifact["bytes"] - size
+                    artifact["bytes"] = size
+                    artifact["compressed"] = True
+
+            for artifact in lru:
+                if total <= self.limit:
+                    break
+                if artifact["kind"] in KEPT_KINDS or not artifact["bytes"]:
+                    continue
+                if artifact["kind"] == "scratch" and now - artifact["last_used"] < self.cold_age:
+                    continue # May belong to a run in progress
+                self._remove(artifact)
+                total -= artifact["bytes"]
+                report["evicted"].append((artifact["path"], artifact["kind"], artifact["bytes"]))
+
+        report["after"] = total
+        report["over_limit"] = self.limit is not None and total > self.limit
+        return report
@@ -2,15 +2,32 @@ from capgenie.bubble import gen_bubble_plots # See bubble.py for implementation
 from capgenie.biodistribution import gen_bio_graphs # See biodistribution.py for implementation
 from capgenie.motif import Motif
 import os
+import time
+import tempfile
 import argparse
+import sqlite3
 from capgenie.search_aav9 import search_aav9 # See search_aav9.py for implementation
 from capgenie.enrichment import enrichment # See enrichment.py for implementation
 from capgenie.spreadsheet import spreadsheet # See spreadsheet.py for implementation
 from capgenie import mani # See mani.cpp for implementation
 from capgenie import denoise # See denoise.cpp for implementation
+from capgenie.telemetry import telemetry # See telemetry.py for implementation
+from capgenie.library import library_index # See library.py for implementation
+from capgenie import threads # See threads.py for implementation
+from capgenie import multilib # See multilib.py for implementation
+from capgenie import readcache # See readcache.py for implementation
+from capgenie import quality_mask # See quality_mask.py for implementation
+from capgenie import fastq # See fastq.py for implementation
+from capgenie.demux import barcode_sheet # See demux.py for implementation
+from capgenie import preview # See preview.py for implementation
+from capgenie.planner import memory_planner # See planner.py for implementation
+from capgenie import cache_manager # See cache_manager.py for implementation
+from capgenie.peptide_index import peptide_index # See peptide_index.py for implementation
 
 # Currently all implemented features for pipeline
 
+PREVIEW_TOP = 10 # Variants printed per table in preview mode
+
 usage = "capgenie [-cf FOO] [-f FOO] [-o FOO] -unk [-s FOO] [-e FOO] -w -qual -bar -cls"
 
 parser = argparse.ArgumentParser(description="CAPGENIE CLI")
@@ -22,9 +39,10 @@ group.add_argument("-cf", "--capsidfile", help="Capsid file path")
 parser.add_argument("-m", "--mismatches", help="Required flag 1 for capsid file")
 parser.add_argument("-mt", "--mtype", help="Required flag 2 for capsid file")
 
-parser.add_argument("-f", "--folder", required=True, help="Nested folder containing fastq file studies")
+parser.add_argument("-f", "--folder", help="Nested folder containing fastq file studies (required unless serving)")
 parser.add_argument("-o", "--output", required=False, help="Output Directory")
 group.add_argument("-unk", "--unknownvariants", help="search for unknown variants", action="store_true")
+group.add_argument("-lib", "--library", action="append", help="Library counted in the same pass, repeatable: [NAME=]capsids.csv or NAME=flanks:UPSTREAM:DOWNSTREAM[:MIN-MAX]")
 
 parser.add_argument("-f1", "--flank1", help="Optional flag 1 for unknown variants")
 parser.add_argument("-f2", "--flank2", help="Optional flag 2 for unknown variants")
@@ -35,9 +53,28 @@ parser.add_argument("-e", "--enrichment", help="Enrichment File path")
 parser.add_argument("-b", "--bubble", help="Generate bubble charts", action="store_true")
 parser.add_argument("-fd", "--freq_distribution", help="Generate frequency distribution charts", action="store_true")
 parser.add_argument("-qual", "--quality_threshold", help="Quality threshold for denoising fastq files", default=False)
+parser.add_argument("-qm", "--quality_mask", help="With -qual, store a pass/fail bitmap per file instead of a denoised FASTQ copy", action="store_true")
 parser.add_argument("-cls", "--clear_cache", help="This option clears all cache", action="store_true")
 parser.add_argument("-ses", "--session", help="DESKTOP: overrides the session name so no command utility is asked")
 parser.add_argument("-mot", "--motif", help="Find motifs in capsid file", action="store_true")
+parser.add_argument("-ooc", "--out_of_core", help="Count unknown variants out of core with this memory budget in MB")
+parser.add_argument("-j", "--jobs", help="Split each FASTQ file into byte ranges counted by this many worker processes", default=1)
+parser.add_argument("-bar", "--barcodes", help="Barcode sheet (Sample,Barcode CSV) to demultiplex pooled FASTQ files by their inline barcodes")
+parser.add_argument("-barm", "--barcode_mismatches", help="Mismatches allowed per barcode", default=1)
+parser.add_argument("-rc", "--read_cache", help="Convert every FASTQ file once into a binary read cache that later runs read instead of the text", action="store_true")
+parser.add_argument("-bs", "--both_strands", help="Count matches on both strands in one pass and report Forward/Reverse Count columns", action="store_true")
+parser.add_argument("-t", "--threads", help="Threads for the native engines (default: CPUs allowed by the affinity mask and cgroup quota)")
+parser.add_argument("-ev", "--events", help="Append per-stage timing/memory events as JSON lines to this file")
+parser.add_argument("-w", "--watch", nargs="?", const=30, help="Keep watching the folder and count every new FASTQ file once it is complete, polling every this many seconds (default 30)")
+parser.add_argument("-wt", "--watch_timeout", help="Stop watching after this many minutes without a new FASTQ file")
+parser.add_argument("-ml", "--memory_limit", help="Memory budget in MB: every FASTQ file is counted in memory, streamed through byte ranges or out of core, with as many workers (up to -j) as fit")
+parser.add_argument("-pv", "--preview", nargs="?", const=100000, help="Count an even sample of this many reads per FASTQ file (default 100000) and report estimated frequencies with 95%% intervals and the projected full-run time and memory, without creating a session")
+parser.add_argument("-cl", "--cache_limit", help="Cap the cache folder at this many MB after the run: cold read caches and denoised copies are compressed, then regenerable artifacts are evicted least recently used first (default: CAPGENIE_CACHE_LIMIT)")
+parser.add_argument("-cu", "--cache_usage", help="Print the cache usage per session and kind (enforcing -cl first, if set) and exit", action="store_true")
+parser.add_argument("-xp", "--export_profile", choices=["tables", "plots", "all"], default="all", help="What -o exports: tables (metadata, pkl files, spreadsheets), plots (tables and charts) or all (default)")
+parser.add_argument("-xa", "--export_archive", help="Stream the -o export into one compressed <session>.tar.zst (.tar.gz without zstandard) instead of a folder", action="store_true")
+parser.add_argument("-lk", "--lookup", help="Print how a peptide (or every peptide starting with a prefix, e.g. AEPV*) did in every session of the cache folder, from the cross-session peptide index, and exit")
+parser.add_argument("-sv", "--serve", nargs="?", const="-", help="DESKTOP: run as a warm worker reading JSON jobs from stdin, or from a port/Unix socket path")
 
 class color:
    PURPLE = '\033[95m'
@@ -66,14 +103,25 @@ class cap_genie:
         self.freq_distribution = self.args.freq_distribution
         self.session_name = self.args.session
         self.run_motif = self.args.motif
+        self.telemetry = telemetry(self.args.events)
 
         if self.args.clear_cache:
             mani.clear_cache_folder()
             print("Cleared Cache!")
             quit()
 
-        if not self.args.capsidfile and not self.args.unknownvariants:
-            parser.error("Either -cf/--capsidfile or -unk/--unknownvariants must be provided.")
+        self.libraries = []
+        if self.args.library:
+            try:
+                self.libraries = multilib.parse_libraries(self.args.library)
+            except ValueError as e:
+                parser.error(str(e))
+            self.capsid_file = None
+            self.unknown_variants = False
+            self.known_variants = False
+            self.library_mismatches = int(self.args.mismatches) if self.args.mismatches else 0
+        elif not self.args.capsidfile and not self.args.unknownvariants:
+            parser.error("Either -cf/--capsidfile, -unk/--unknownvariants or -lib/--library must be provided.")
         else:
             self.capsid_file = self.args.capsidfile
             self.unknown_variants = self.args.unknownvariants
@@ -88,12 +136,38 @@ class cap_genie:
                     self.mismatches = 0
             self.known_variants = not self.unknown_variants
 
+        self.barcode_sheet = None
+        if self.args.barcodes:
+            try:
+                self.barcode_sheet = barcode_sheet.load(self.args.barcodes, int(self.args.barcode_mismatches))
+            except ValueError as e:
+                parser.error(str(e))
+            if not self.libraries: # The -cf/-unk run becomes a single unnamed library, counted exactly like the known path
+                if self.capsid_file:
+                    self.libraries = [multilib.library_spec("", "capsid", capsid_file=self.capsid_file)]
+                elif None not in self.flanks:
+                    self.libraries = [multilib.library_spec("", "flanks", upstream=self.flanks[0], downstream=self.flanks[1])]
+                else:
+                    parser.error("-bar/--barcodes needs -cf, -unk with -f1/-f2, or -lib")
+                self.library_mismatches = 0
+
         self.SEPERATOR = "----------------------------------------"
 
         self.dirs = []
 
         self.denoised_dirs = []
 
+        self.watching = bool(self.args.watch)
+        self.watch_interval = float(self.args.watch) if self.args.watch else 0
+        self.pending = {} # Watch mode: directory --> files to count in this round
+        self.counted_files = {} # Watch mode: data directory --> files summarized so far
+        self.awaiting_enrichment = {} # Watch mode: data directory --> (instructions key, pre-insert file) not counted yet
+        self.saved_records = 0 # Telemetry records already saved with the session
+        if self.watching and self.quality_threshold and not self.args.quality_mask:
+            parser.error("-w/--watch with -qual needs -qm/--quality_mask, so new files are counted in place")
+        if self.watching and self.args.preview:
+            parser.error("-pv/--preview samples the files already in the folder and can't be combined with -w/--watch")
+
     """
     get_files: None --> list
     -- Gets all FASTQ files from the nested directory structure
@@ -128,48 +202,76 @@ class cap_genie:
     -- Denoises FASTQ files using quality threshold
     * @param [in] instance (search_aav9) - Search AAV9 instance
     * @param [out] None - Denoises files and saves results
-    ** Filters low-quality reads from FASTQ files
+    ** Filters low-quality reads from FASTQ files. With -qm only a quality mask
+    ** is written per file and the original files are counted (see quality_mask.py)
     """
     def denoise_files(self, instance):
         for dir in self.dirs:
-            for file in os.listdir(os.path.join(self.nested_dir, dir)):
+            for file in self.fastq_files(dir):
                 if file.endswith(".fastq"):
                     file_path = os.path.join(self.nested_dir, dir, file)
+                    if self.args.quality_mask:
+                        mask_dir = os.path.join(instance._cache_folder, instance.save_dir, "quality_masks", dir)
+                        os.makedirs(mask_dir, exist_ok=True)
+                        with self.telemetry.stage("denoise", directory=dir, file=file, bytes=os.path.getsize(file_path)) as record:
+                            result = quality_mask.build(file_path, quality_mask.mask_path(mask_dir, file_path), int(self.quality_threshold))
+                            record["reads"] = result.num_reads
+                        instance.quality_masks[os.path.abspath(file_path)] = result.output_filename
+                        instance.save_denoise_result(result, file)
+                        print(f"Denoised {file}: {result.num_reads - result.low_quality_reads} of {result.num_reads} reads pass "
+                              f"(average quality {result.avg_quality:.2f}), mask saved under {result.output_filename}.")
+                        continue
                     new_dir = os.path.join(instance._cache_folder, instance.save_dir, "denoised_"+ dir)
                     print(new_dir)
                     if not os.path.exists(new_dir):
                         os.makedirs(new_dir)
                         self.denoised_dirs.append(new_dir)
                     
-                    result = denoise.denoise(file.encode(), file_path.encode(), new_dir.encode(), int(self.quality_threshold))
+                    with self.telemetry.stage("denoise", directory=dir, file=file, bytes=os.path.getsize(file_path)) as record:
+                        result = denoise.denoise(file.encode(), file_path.encode(), new_dir.encode(), int(self.quality_threshold))
+                        record["reads"] = result.num_reads
                     spliced_enrichment_file = os.path.normpath(self.enrichment_file).split(os.sep)
                     if os.path.join(*spliced_enrichment_file[-2:]) == os.path.join(dir, file):
                         self.enrichment_file = result.output_filename
                     instance.save_denoise_result(result, file)
                     print(f"Denoised {file}, saved under {os.path.join(new_dir, file)}.")
     """
+    cache_reads: list --> None
+    -- Converts every FASTQ file that doesn't have a current binary read cache
+    * @param [in] dirs (list) - Data directory paths
+    ** Later runs (and the counting below) read the cache instead of the text
+    """
+    def cache_reads(self, dirs):
+        for dir in dirs:
+            for file in self.fastq_files(dir):
+                if file.endswith(".fastq"):
+                    file_path = os.path.join(self.nested_dir, dir, file)
+                    with self.telemetry.stage("read_cache", directory=os.path.basename(dir), file=file, bytes=os.path.getsize(file_path)):
+                        cache_file = readcache.convert(file_path)
+                    print(f"Read cache for {file}: {cache_file} ({os.path.getsize(cache_file) / os.path.getsize(file_path):.0%} of the FASTQ)")
+
+    """
     run_pipeline: None --> None
     -- Main pipeline execution method that processes all selected files
     * @param [out] None - Executes the complete pipeline workflow
     ** Orchestrates the entire CAPGENIE pipeline workflow
     """
     def run_pipeline(self):
-        instance = search_aav9()
+        threads.configure(self.args.threads)
+        if self.args.preview:
+            self.run_preview()
+            return
+        instance = search_aav9(self.telemetry)
+        instance.workers = int(self.args.jobs)
+        instance.both_strands = self.args.both_strands
+        if self.args.out_of_core:
+            instance.out_of_core_budget = int(float(self.args.out_of_core) * 1024 * 1024)
 
         if self.session_name:
             instance._override_session(self.session_name)
         else:
             instance.init_session()
 
-        if self.unknown_variants:
-            if None in self.flanks:
-                self._run_flank = False
-                self.ref_seq = self.args.refseq
-            else:
-                self._run_flank = True
-                upstream = self.flanks[0]
-                downstream = self.flanks[1]
-
         session_folder = instance.save_dir
 
         new_dirs = []
@@ -188,16 +290,177 @@ class cap_genie:
                 os.mkdir(new_dir)
                 print(f"Created {new_dir}")
 
+        if self.args.watch:
+            self.watch(instance, spreadsheet_instance, enrichment_instance, session_folder)
+        else:
+            self.get_files()
+            if self.quality_threshold:
+                self.denoise_files(instance)
+            self.prepare_counting(instance)
+            self.count_directories(instance, spreadsheet_instance, enrichment_instance, session_folder)
+            self.save_session(instance)
+        self.report_memory()
+
+        if self.args.output:
+            instance.save_to_output(self.output_dir, self.args.export_profile, self.args.export_archive)
+        limit = cache_manager.cache_limit(self.args.cache_limit)
+        if limit is not None:
+            print_cache_report(cache_manager.cache_manager(limit).enforce())
+
+    """
+    run_preview: None --> None
+    -- Preview mode: counts an even sample of every FASTQ file of the selected
+    -- directories with the engine of the full run and prints the estimated
+    -- frequencies (95% Wilson intervals) of the top variants and the projected
+    -- full-run time and memory (see preview.py). No session is created, -o
+    -- saves the sample tables as CSV
+    """
+    def run_preview(self):
+        instance = search_aav9(self.telemetry) # No session, scratch folders go to the temp folder
+        instance.both_strands = self.args.both_strands
+        if self.args.out_of_core:
+            instance.out_of_core_budget = int(float(self.args.out_of_core) * 1024 * 1024)
+        previewer = preview.preview_run(self.telemetry)
+        reads = int(self.args.preview)
+        jobs = max(1, int(self.args.jobs))
+
         self.get_files()
+        if self.libraries:
+            self.matcher = multilib.tagged_matcher(self.libraries, self.library_mismatches, self.args.mtype != "levenshtein")
+        elif self.capsid_file:
+            self.library = library_index.load(self.capsid_file)
+            self.peptide_map = self.library.peptide_map
+
+        total_time = 0.0
+        peak_memory = 0
+        with tempfile.TemporaryDirectory(prefix="capgenie_preview_") as sample_dir:
+            for dir in self.dirs:
+                for file in self.fastq_files(dir):
+                    file_path = os.path.join(self.nested_dir, dir, file)
+                    sample_path = os.path.join(sample_dir, file)
+                    file_scan = fastq.scan(file_path)
+                    if file_scan["compression"] != "none":
+                        print(color.RED + f"{os.path.join(dir, file)} is {file_scan['compression']} compressed, decompress it before counting" + color.END)
+                        continue
+                    sample = preview.sample_fastq(file_path, reads, sample_path)
+                    print(color.BOLD + f"{os.path.join(dir, file)}: {sample['reads']:,} of {sample['file_reads']:,} reads "
+                          f"sampled ({sample['fraction']:.1%}) from {preview.WINDOWS} windows" + color.END)
+                    self.print_scan(file_scan)
+                    projected_time = 0.0
+                    if self.quality_threshold:
+                        mask_path = quality_mask.mask_path(sample_dir, sample_path)
+                        result, record = previewer.measure("preview_denoise", sample,
+                                                           lambda: quality_mask.build(sample_path, mask_path, int(self.quality_threshold)))
+                        instance.quality_masks[os.path.abspath(sample_path)] = mask_path
+                        projected_time += record["projected_time"]
+                        passing = result.num_reads - result.low_quality_reads
+                        print(f"  Quality: {passing:,} reads pass -qual {self.quality_threshold} "
+                              f"({preview.format_share(passing, result.num_reads)}), average quality {result.avg_quality:.2f}")
+
+                    tables, record = previewer.measure("preview_counting", sample, lambda: self.preview_tables(instance, sample_path, os.path.basename(dir)))
+                    projected_time += record["projected_time"] / jobs
+                    unique_reads = fastq.collapse_reads(fastq.iter_reads(sample_path, mask=instance.mask_file(sample_path)))
+                    memory = previewer.project_memory(record, sample, unique_reads, instance.out_of_core_budget)
+                    for name, (table, table_reads) in tables.items():
+                        self.print_preview(name, preview.estimate_table(table), table_reads, file)
+                    print(f"  Projected full run of this file: {preview.format_seconds(projected_time)}"
+                          f"{f' with -j {jobs}' if jobs > 1 else ''}, peak memory {preview.format_bytes(memory)}")
+                    total_time += projected_time
+                    peak_memory = max(peak_memory, memory)
+                    if self.output_dir:
+                        for name, (table, _) in tables.items():
+                            out_dir = os.path.join(self.output_dir, "preview", name)
+                            os.makedirs(out_dir, exist_ok=True)
+                            preview.estimate_table(table).to_csv(os.path.join(out_dir, file.replace(".fastq", ".csv")), index=False)
+        print(color.BOLD + f"Projected full run: {preview.format_seconds(total_time)} of counting, peak memory {preview.format_bytes(peak_memory)}" + color.END)
+
+    """
+    print_scan: dict --> None
+    -- Prints the read statistics of a FASTQ file's scan (fastq.scan) and warns
+    -- about what would skew its counts
+    """
+    def print_scan(self, file_scan):
+        lengths = list(file_scan["length_histogram"])
+        length = f"{lengths[0]}" if len(lengths) == 1 else f"{lengths[0]}-{lengths[-1]} (mean {file_scan['mean_length']:.1f})"
+        quality = "n/a" if file_scan["mean_quality"] is None else f"{file_scan['mean_quality']:.2f}"
+        encoding = f"Phred+{file_scan['phred_offset']}{', guessed' if file_scan['phred_ambiguous'] else ''}"
+        print(f"  File: read length {length}, mean quality {quality} ({encoding})")
+        if file_scan["malformed_reads"]:
+            print(color.RED + f"  {file_scan['malformed_reads']:,} malformed records" + color.END)
+        if not file_scan["complete"]:
+            print(color.RED + "  The file ends in a partial record (still being written?)" + color.END)
+        if self.quality_threshold and file_scan["phred_offset"] == 64:
+            print(color.RED + "  Qualities look like Phred+64, but -qual reads them as Phred+33" + color.END)
 
-        if self.quality_threshold:
-            self.denoise_files(instance)
+    """
+    preview_tables: search_aav9, str, str --> dict
+    -- Counts a sample file with the engine the full run would use, without
+    -- touching a session
+    * @param [in] instance (search_aav9) - Instance without a session
+    * @param [in] sample_path (str) - Sample FASTQ file
+    * @param [in] data_directory (str) - Data directory name
+    * @param [out] tables (dict) - Data directory the table would be summarized under --> (table,
+    -- reads it was counted from: the sample's reads, or a barcode sample's reads)
+    """
+    def preview_tables(self, instance, sample_path, data_directory):
+        if self.barcode_sheet:
+            sample_tables = instance.demux_tables(self.matcher, self.barcode_sheet, sample_path, data_directory)
+            return {multilib.library_directory(sample, name): (table, instance.sample_reads[sample])
+                    for sample, library_tables in sample_tables.items() for name, table in library_tables.items()}
+        if self.libraries:
+            tables = instance.library_tables(self.matcher, sample_path, data_directory)
+        elif self.capsid_file:
+            if self.mismatches:
+                automaton = self.library.strand_automaton if instance.both_strands else self.library.automaton
+                tables = {"": instance.count_known_table(self.peptide_map, sample_path, automaton, data_directory)}
+            else:
+                tables = {"": instance.fuzzy_match_table(self.peptide_map, sample_path, 0, True, data_directory)}
+        elif None not in self.flanks:
+            tables = {"": instance.flank_table(self.flanks[0], self.flanks[1], sample_path, data_directory)}
+        else:
+            tables = {"": instance.filter_count_table(sample_path, self.args.refseq, data_directory)}
+        return {multilib.library_directory(data_directory, name): (table, instance.num_reads) for name, table in tables.items()}
 
-        instructions_link = ""
+    """
+    print_preview: str, DataFrame, int, str --> None
+    -- Prints the match rate and the top variants of a sample table
+    * @param [in] name (str) - Data directory of the table
+    * @param [in] table (DataFrame) - Table from preview.estimate_table
+    * @param [in] reads (int) - Reads counted in the sample (after -qual)
+    * @param [in] file (str) - FASTQ file name
+    """
+    def print_preview(self, name, table, reads, file):
+        matches = int(table["Count"].sum())
+        print(f"  {name}: {len(table):,} variants from {matches:,} matches, "
+              f"in {preview.format_share(min(matches, reads), reads)} of the reads")
+        if not matches:
+            print(color.YELLOW + f"  No matches in {file}, check the capsid file, flanks or refseq" + color.END)
+            return
+        for peptide, count, decimal, low, high in table.head(PREVIEW_TOP)[["Peptide", "Count", "Decimal", "Decimal Low", "Decimal High"]].itertuples(index=False):
+            print(f"    {peptide:<30} {count:>8,}  {decimal:7.2%}  [{low:.2%}, {high:.2%}]")
 
-        if self.capsid_file:
-            instructions_link = "count_known_reads"
-            peptide_map = search_aav9.create_peptide_map(self.capsid_file)
+    """
+    prepare_counting: search_aav9 --> None
+    -- Loads what the counting mode needs once per run (capsid library, flanks,
+    -- tagged matcher) and runs the motif analysis
+    * @param [in] instance (search_aav9) - Session instance
+    """
+    def prepare_counting(self, instance):
+        self.instructions_link = ""
+        self.planner = None
+
+        if self.libraries:
+            self.matcher = multilib.tagged_matcher(self.libraries, self.library_mismatches, self.args.mtype != "levenshtein")
+            self.create_planner("demux" if self.barcode_sheet else "libraries",
+                                [sequence for library in self.libraries if library.peptide_map for sequence in library.peptide_map],
+                                any(library.kind == "flanks" for library in self.libraries))
+            if self.args.library:
+                print(color.BOLD + f"Counting {len(self.libraries)} libraries in one pass: {', '.join(library.name for library in self.libraries)}" + color.END)
+        elif self.capsid_file:
+            self.instructions_link = "count_known_reads"
+            self.library = library_index.load(self.capsid_file)
+            self.peptide_map = self.library.peptide_map
+            self.create_planner("known" if self.mismatches else "fuzzy", self.peptide_map.keys())
             print("Here's the capsid file imported: ")
             mani.pprint_csv(self.capsid_file)
             #input("Press enter to run pipeline: ")
@@ -205,62 +468,488 @@ class cap_genie:
             if self.run_motif:
                 print(color.BOLD + "Finding Motifs" + color.END)
                 save_dir = os.path.join(instance._cache_folder, instance._save_dir)
-                motif = Motif(list(peptide_map.values()), True)
-                motif.get_motifs(save_dir)
-                print(color.BOLD + "Creating Motif Logo" + color.END)
-                motif.createMotifLogo(f"{save_dir}")
+                peptides = list(self.peptide_map.values())
+                if self.planner and peptides:
+                    sample = self.planner.motif_sample(len(peptides), max(len(peptide) for peptide in peptides))
+                    if sample < len(peptides): # Evenly spaced, so the sample is the same every run
+                        peptides = [peptides[i * len(peptides) // sample] for i in range(sample)]
+                        print(f"Memory plan: motifs are clustered on {sample:,} of {len(self.peptide_map):,} peptides to stay under -ml")
+                with self.telemetry.stage("motif", reads=len(peptides)):
+                    motif = Motif(peptides, True)
+                    motif.get_motifs(save_dir)
+                    print(color.BOLD + "Creating Motif Logo" + color.END)
+                    motif.createMotifLogo(f"{save_dir}")
                 print(f"Motif Logo saved to: {save_dir}")
             print(color.BOLD + "Searching for known reads" + color.END)
 
         else:
-            instructions_link = "unknown_reads"
+            self.instructions_link = "unknown_reads"
+            self.create_planner("flank" if None not in self.flanks else "filter")
             print(color.BOLD + "Searching for Unknown reads" + color.END)
 
-        dirs_to_use = self.denoised_dirs if self.quality_threshold else self.dirs
+    """
+    create_planner: str, iterable, bool --> None
+    -- With -ml, creates the memory planner of the run (see planner.py)
+    * @param [in] engine (str) - Counting engine (see memory_planner)
+    * @param [in] sequences (iterable) - Capsid library sequences, empty for unknown variants
+    * @param [in] inserts (bool) - Whether a library counts flank inserts
+    """
+    def create_planner(self, engine, sequences=(), inserts=False):
+        if not self.args.memory_limit:
+            return
+        sequences = list(sequences)
+        self.planner = memory_planner(self.args.memory_limit, engine, len(sequences), sum(len(sequence) for sequence in sequences),
+                                      int(self.args.jobs), inserts, self.args.out_of_core)
+        print(color.BOLD + f"Planning every file under a {self.args.memory_limit} MB memory limit" + color.END)
+
+    """
+    plan_file: search_aav9, str --> dict
+    -- With -ml, plans how a file is counted and configures the instance for it
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] file_path (str) - Path to FASTQ file
+    * @param [out] plan (dict) - The plan, None without -ml
+    """
+    def plan_file(self, instance, file_path):
+        if not self.planner:
+            return None
+        plan = self.planner.apply(instance, file_path)
+        print(f"Memory plan for {os.path.basename(file_path)}: {memory_planner.describe(plan)}")
+        return plan
+
+    """
+    report_memory: None --> None
+    -- With -ml, prints the plan of every counted file next to its measured peak
+    ** The measured peak is this process's peak during the counting stage. For byte
+    ** range plans the largest worker peak so far is shown next to the estimate of
+    ** one worker; a forked worker's RSS also counts the pages it shares with this process
+    """
+    def report_memory(self):
+        if not self.planner:
+            return
+        print(color.BOLD + "Memory plan vs measured peak" + color.END)
+        for record in self.telemetry.records:
+            if record["stage"] != "counting" or "memory_path" not in record:
+                continue
+            workers = ""
+            if "worker_peak_rss" in record:
+                workers = (f", {record['workers']} workers estimated {preview.format_bytes(record['estimated_worker_rss'])} each "
+                           f"(largest measured {preview.format_bytes(record['worker_peak_rss'])} including shared pages)")
+            print(f"  {record['directory']}/{record['file']}: {record['memory_path']}, estimated {preview.format_bytes(record['estimated_rss'])} "
+                  f"in total, this process measured {preview.format_bytes(record['peak_rss'] or 0)} of {preview.format_bytes(record['memory_budget'])}{workers}")
+
+    """
+    count_directories: search_aav9, spreadsheet, enrichment, str --> None
+    -- Counts the FASTQ files of every selected directory (see fastq_files) and
+    -- summarizes the directories
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] spreadsheet_instance (spreadsheet) - Spreadsheet writer
+    * @param [in] enrichment_instance (enrichment) - Enrichment calculator
+    * @param [in] session_folder (str) - Session folder name
+    """
+    def count_directories(self, instance, spreadsheet_instance, enrichment_instance, session_folder):
+        instructions_link = self.instructions_link
+        dirs_to_use = self.denoised_dirs if self.quality_threshold and not self.args.quality_mask else self.dirs
+
+        if self.args.read_cache:
+            self.cache_reads(dirs_to_use)
+
+        if self.barcode_sheet: # Pooled directories, every sample is summarized as its own data directory
+            self.count_demultiplexed(instance, self.matcher, dirs_to_use, spreadsheet_instance, enrichment_instance, session_folder)
+            dirs_to_use = []
 
         for dir in dirs_to_use: # Goes through every directory
+            if self.watching and not self.fastq_files(dir):
+                continue
+            if self.libraries:
+                self.count_libraries(instance, self.matcher, dir, spreadsheet_instance, enrichment_instance, session_folder)
+                continue
             files = []
+            tables = {} # Count tables kept in memory for the spreadsheet, average and enrichment stages
             data_directory = os.path.basename(dir)
-            for file in os.listdir(os.path.join(self.nested_dir, dir)):
-                if file.endswith(".fastq"):
-                    file_path = os.path.join(self.nested_dir, dir, file)
-                    print(f"Currently processing {file} ({mani.fastq_file_size(file_path)})")
+            for file in self.fastq_files(dir):
+                file_path = os.path.join(self.nested_dir, dir, file)
+                print(f"Currently processing {file} ({mani.fastq_file_size(file_path)}, {fastq.scan(file_path)['reads']:,} reads)")
+                plan = self.plan_file(instance, file_path)
+                with self.telemetry.stage("counting", directory=data_directory, file=file, bytes=os.path.getsize(file_path)) as record:
                     if self.capsid_file:
                         if self.mismatches:
-                            instance.count_known_reads(peptide_map, file_path, data_directory)
+                            automaton = self.library.strand_automaton if instance.both_strands else self.library.automaton
+                            table = instance.count_known_reads(self.peptide_map, file_path, data_directory, automaton)
                         else:
-                            instance._cpp_fuzzy_match(peptide_map, file_path, data_directory, 0, subOnly=True)
+                            table = instance._cpp_fuzzy_match(self.peptide_map, file_path, data_directory, 0, subOnly=True)
                     else:
-                        if self._run_flank:
-                            instance.search_by_flank(upstream, downstream, file_path, data_directory)
+                        if None not in self.flanks:
+                            table = instance.search_by_flank(self.flanks[0], self.flanks[1], file_path, data_directory)
                         else:
-                            instance._cpp_filter_count(data_directory, file_path, self.ref_seq)
-                    print(f"Finished {file}")
-                    files.append(file)
-                    spreadsheet_instance.save_file(instance.pkl_file_path, file, data_directory, instructions_link)
-            if len(files) > 1:
-                avg_file = instance.create_avg_pkl(data_directory, files, instructions_link)
-                print(f"Created average pkl/xlsx: {data_directory}")
+                            table = instance._cpp_filter_count(data_directory, file_path, self.args.refseq)
+                    record["reads"] = instance.num_reads
+                    record["unique_reads"] = instance.num_unique_reads
+                    if plan:
+                        self.planner.record(record, plan)
+                print(f"Finished {file}")
+                files.append(file)
+                tables[file] = table
+                with self.telemetry.stage("spreadsheet", directory=data_directory, file=file):
+                    spreadsheet_instance.save_file(instance.pkl_file_path, file, data_directory, instructions_link, table=table)
+            self.summarize_directory(instance, spreadsheet_instance, enrichment_instance, session_folder,
+                                     data_directory, files, tables, instructions_link, self.enrichment_file)
+
+    """
+    save_session: search_aav9 --> None
+    -- Saves the session matrix, the stage records not saved yet and the JSON instructions
+    * @param [in] instance (search_aav9) - Session instance
+    """
+    def save_session(self, instance):
+        instance.save_matrix()
+        instance.save_stages(self.telemetry.records[self.saved_records:])
+        self.saved_records = len(self.telemetry.records)
+        instance._serialize_pkl()
+        if peptide_index.exists(instance._cache_folder):
+            index = peptide_index(cache_folder=instance._cache_folder)
+            try:
+                index.update([instance._save_dir])
+            except sqlite3.Error as e:
+                print(f"Error updating the peptide index: {e}")
+            finally:
+                index.close()
+
+    """
+    fastq_files: str --> list
+    -- FASTQ files of a directory to count in this round: every one, or in
+    -- watch mode the ones that finished writing since the last round
+    * @param [in] dir (str) - Data directory path
+    * @param [out] files (list) - File names
+    """
+    def fastq_files(self, dir):
+        if self.watching:
+            return self.pending.get(os.path.basename(dir), [])
+        return [file for file in os.listdir(os.path.join(self.nested_dir, dir)) if file.endswith(".fastq")]
+
+    """
+    complete_fastq: str, tuple, tuple --> bool
+    -- Whether a FASTQ file the sequencer writes is finished: unchanged since
+    -- the last poll (or not modified for a whole poll interval) and ending in
+    -- a complete record (fastq.scan)
+    * @param [in] file_path (str) - Path to FASTQ file
+    * @param [in] stamp (tuple) - (size, mtime_ns) now
+    * @param [in] previous (tuple) - (size, mtime_ns) at the last poll, None if unseen
+    * @param [out] complete (bool) - True if it can be counted
+    """
+    def complete_fastq(self, file_path, stamp, previous):
+        if not stamp[0]:
+            return False
+        if stamp != previous and time.time() - stamp[1] / 1e9 < self.watch_interval:
+            return False
+        return fastq.scan(file_path)["complete"]
+
+    """
+    watch: search_aav9, spreadsheet, enrichment, str --> None
+    -- Watch mode: polls the project folder and counts every FASTQ file as soon
+    -- as it is complete, then updates the averages, enrichment and charts of its
+    -- directory incrementally (see aggregate.py). Stops on Ctrl-C or after
+    -- -wt minutes without a new file
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] spreadsheet_instance (spreadsheet) - Spreadsheet writer
+    * @param [in] enrichment_instance (enrichment) - Enrichment calculator
+    * @param [in] session_folder (str) - Session folder name
+    ** Directories are summarized with every file counted so far. Enrichment waits
+    ** until the pre-insert file is counted and then catches up every directory
+    """
+    def watch(self, instance, spreadsheet_instance, enrichment_instance, session_folder):
+        self.get_files()
+        self.prepare_counting(instance)
+        timeout = float(self.args.watch_timeout) * 60 if self.args.watch_timeout else None
+        stamps = {} # FASTQ path --> (size, mtime_ns) at the last poll
+        counted = set()
+        last_new = time.time()
+        print(color.BOLD + f"Watching {self.nested_dir} every {self.watch_interval:g}s for new FASTQ files (Ctrl-C to stop)" + color.END)
+        try:
+            while True:
+                if self.session_name: # Lanes may arrive as new directories
+                    self.get_files()
+                self.pending = {}
+                for dir in self.dirs:
+                    folder = os.path.join(self.nested_dir, dir)
+                    if not os.path.isdir(folder):
+                        continue
+                    for file in sorted(os.listdir(folder)):
+                        file_path = os.path.join(folder, file)
+                        if not file.endswith(".fastq") or file_path in counted:
+                            continue
+                        stat = os.stat(file_path)
+                        stamp = (stat.st_size, stat.st_mtime_ns)
+                        if self.complete_fastq(file_path, stamp, stamps.get(file_path)):
+                            self.pending.setdefault(dir, []).append(file)
+                            counted.add(file_path)
+                        stamps[file_path] = stamp
+
+                if self.pending:
+                    print(color.BOLD + f"New FASTQ files: {', '.join(f for files in self.pending.values() for f in files)}" + color.END)
+                    if self.quality_threshold:
+                        self.denoise_files(instance)
+                    self.count_directories(instance, spreadsheet_instance, enrichment_instance, session_folder)
+                    self.catch_up_enrichment(instance, spreadsheet_instance, enrichment_instance, session_folder)
+                    self.save_session(instance)
+                    last_new = time.time()
+                elif timeout is not None and time.time() - last_new > timeout:
+                    print(f"No new FASTQ files for {self.args.watch_timeout} minutes, stopping")
+                    break
+                time.sleep(self.watch_interval)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        finally:
+            self.pending = {}
+        self.save_session(instance)
+
+    """
+    pre_insert_counted: search_aav9, str, str --> bool
+    -- Whether the table of a pre-insert file exists yet
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] enrichment_file (str) - Pre-insert file (<pre dir>/<file>)
+    * @param [in] instructions_link (str) - Instructions key of the tables
+    * @param [out] counted (bool) - True once calc_enrichment can load it
+    """
+    def pre_insert_counted(self, instance, enrichment_file, instructions_link):
+        prefix = "variants_" if instructions_link == "count_known_reads" else "unknown_variants_"
+        pre_dir = os.path.basename(os.path.dirname(enrichment_file))
+        return os.path.exists(os.path.join(instance.pkl_file_path, pre_dir, f"{prefix}{os.path.basename(enrichment_file)}".replace(".fastq", ".pkl")))
+
+    """
+    catch_up_enrichment: search_aav9, spreadsheet, enrichment, str --> None
+    -- Watch mode: summarizes again the directories whose enrichment waited for
+    -- a pre-insert file that has been counted since
+    """
+    def catch_up_enrichment(self, instance, spreadsheet_instance, enrichment_instance, session_folder):
+        for data_directory, (instructions_link, enrichment_file) in list(self.awaiting_enrichment.items()):
+            if self.pre_insert_counted(instance, enrichment_file, instructions_link):
+                self.summarize_directory(instance, spreadsheet_instance, enrichment_instance, session_folder,
+                                         data_directory, [], {}, instructions_link, enrichment_file)
+
+    """
+    summarize_directory: search_aav9, spreadsheet, enrichment, str, str, list, dict, str, str --> None
+    -- Runs the per directory stages once its files are counted: recording the
+    -- tables in the session matrix (see count_matrix.py), updating the replicate
+    -- aggregate (see aggregate.py), averaging, enrichment, bubble and frequency
+    -- distribution charts
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] spreadsheet_instance (spreadsheet) - Spreadsheet writer
+    * @param [in] enrichment_instance (enrichment) - Enrichment calculator
+    * @param [in] session_folder (str) - Session folder name
+    * @param [in] data_directory (str) - Data directory name
+    * @param [in] files (list) - Counted FASTQ file names
+    * @param [in] tables (dict) - File name --> count table (in watch mode only the files counted in this round)
+    * @param [in] instructions_link (str) - Instructions key of the tables
+    * @param [in] enrichment_file (str) - Pre-insert file, None to skip enrichment
+    """
+    def summarize_directory(self, instance, spreadsheet_instance, enrichment_instance, session_folder, data_directory, files, tables, instructions_link, enrichment_file):
+        if self.watching: # Only the new tables are in memory, the aggregate holds the rest
+            files = self.counted_files.setdefault(data_directory, []) + [file for file in files if file not in self.counted_files.get(data_directory, [])]
+            self.counted_files[data_directory] = files
+            if enrichment_file and not self.pre_insert_counted(instance, enrichment_file, instructions_link):
+                print(f"Enrichment of {data_directory} waits for the pre-insert file {enrichment_file}")
+                self.awaiting_enrichment[data_directory] = (instructions_link, enrichment_file)
+                enrichment_file = None
+            else:
+                self.awaiting_enrichment.pop(data_directory, None)
+        instance.record_samples(data_directory, files, tables, instructions_link)
+        aggregate = None
+        if len(files) > 1 or enrichment_file:
+            with self.telemetry.stage("aggregating", directory=data_directory, files=len(files)):
+                aggregate = instance.update_aggregate(data_directory, files, instructions_link, tables)
+        if len(files) > 1:
+            with self.telemetry.stage("averaging", directory=data_directory, files=len(files)):
+                avg_file = instance.create_avg_pkl(data_directory, files, instructions_link, tables, aggregate)
+            print(f"Created average pkl/xlsx: {data_directory}")
+            with self.telemetry.stage("spreadsheet", directory=data_directory, file=avg_file):
                 spreadsheet_instance.save_file(instance.pkl_file_path, avg_file, data_directory, instructions_link, avg_file=True)
-            if self.enrichment_file:
-                print(self.enrichment_file)
-                avg_enrichment_file = enrichment_instance.calc_enrichment(self.enrichment_file, session_folder, files, data_directory, instructions_link)
-                print(f"Calculated enrichment: {data_directory}")
+        if enrichment_file:
+            print(enrichment_file)
+            with self.telemetry.stage("enrichment", directory=data_directory, files=len(files)):
+                avg_enrichment_file = enrichment_instance.calc_enrichment(enrichment_file, session_folder, files, data_directory, instructions_link, tables, aggregate)
+            print(f"Calculated enrichment: {data_directory}")
+            with self.telemetry.stage("spreadsheet", directory=data_directory, file=avg_enrichment_file):
                 spreadsheet_instance.save_file(instance.pkl_file_path, avg_enrichment_file, data_directory, instructions_link, avg_file=True)
-                print(f"Created average enrichment pkl/xlsx: {data_directory}")
-            if self.bubble and self.enrichment_file:
+            print(f"Created average enrichment pkl/xlsx: {data_directory}")
+        if self.bubble and enrichment_file:
+            with self.telemetry.stage("bubble", directory=data_directory):
                 gen_bubble_plots(self.bubble_dir, session_folder, data_directory, instance._cache_folder)
-                print(f"Created bubble charts: {data_directory}")
-            if self.freq_distribution:
+            print(f"Created bubble charts: {data_directory}")
+        if self.freq_distribution:
+            with self.telemetry.stage("freq_distribution", directory=data_directory):
                 gen_bio_graphs(self.freq_dir, session_folder, data_directory, instance._cache_folder)
-                print(f"Created frequency distribution charts: {data_directory}")
-            
-        instance._serialize_pkl()
-        if self.args.output:
-            instance.save_to_output(self.output_dir)
+            print(f"Created frequency distribution charts: {data_directory}")
+
+    """
+    count_libraries: search_aav9, tagged_matcher, str, spreadsheet, enrichment, str --> None
+    -- Counts every library of a directory in one pass per FASTQ file and
+    -- summarizes each library as its own data directory (<dir>_<library>)
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] dir (str) - Data directory path
+    * @param [in] spreadsheet_instance (spreadsheet) - Spreadsheet writer
+    * @param [in] enrichment_instance (enrichment) - Enrichment calculator
+    * @param [in] session_folder (str) - Session folder name
+    ** The pre-insert file of library L is looked up as <pre dir>_L/<file>, i.e.
+    ** the table the same run saved for it
+    """
+    def count_libraries(self, instance, matcher, dir, spreadsheet_instance, enrichment_instance, session_folder):
+        data_directory = os.path.basename(dir)
+        files = []
+        tables = {library.name: {} for library in self.libraries}
+        for file in self.fastq_files(dir):
+            if file.endswith(".fastq"):
+                file_path = os.path.join(self.nested_dir, dir, file)
+                print(f"Currently processing {file} ({mani.fastq_file_size(file_path)}, {fastq.scan(file_path)['reads']:,} reads)")
+                plan = self.plan_file(instance, file_path)
+                with self.telemetry.stage("counting", directory=data_directory, file=file, bytes=os.path.getsize(file_path),
+                                          libraries=len(self.libraries)) as record:
+                    library_tables = instance.count_libraries(matcher, file_path, data_directory)
+                    record["reads"] = instance.num_reads
+                    record["unique_reads"] = instance.num_unique_reads
+                    if plan:
+                        self.planner.record(record, plan)
+                print(f"Finished {file}")
+                files.append(file)
+                for library in self.libraries:
+                    library_dir = multilib.library_directory(data_directory, library.name)
+                    tables[library.name][file] = library_tables[library.name]
+                    with self.telemetry.stage("spreadsheet", directory=library_dir, file=file):
+                        spreadsheet_instance.save_file(instance.pkl_file_path, file, library_dir, library.instructions_link, table=library_tables[library.name])
+
+        for library in self.libraries:
+            self.summarize_directory(instance, spreadsheet_instance, enrichment_instance, session_folder,
+                                     multilib.library_directory(data_directory, library.name), files, tables[library.name],
+                                     library.instructions_link, self.library_enrichment_file(library))
+
+    """
+    count_demultiplexed: search_aav9, tagged_matcher, list, spreadsheet, enrichment, str --> None
+    -- Demultiplexes every pooled FASTQ file by sample barcode and counts all
+    -- samples in the same pass, then summarizes every sample (and library) as
+    -- its own data directory
+    * @param [in] instance (search_aav9) - Session instance
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] dirs (list) - Data directory paths holding pooled FASTQ files
+    * @param [in] spreadsheet_instance (spreadsheet) - Spreadsheet writer
+    * @param [in] enrichment_instance (enrichment) - Enrichment calculator
+    * @param [in] session_folder (str) - Session folder name
+    ** The tables of a sample are named after the pooled files, so the
+    ** pre-insert file is given as -e <pre sample>/<pooled file>.fastq
+    """
+    def count_demultiplexed(self, instance, matcher, dirs, spreadsheet_instance, enrichment_instance, session_folder):
+        tables = {} # Sample data directory --> file --> table
+        for dir in dirs:
+            data_directory = os.path.basename(dir)
+            for file in self.fastq_files(dir):
+                if file.endswith(".fastq"):
+                    file_path = os.path.join(self.nested_dir, dir, file)
+                    print(f"Currently processing {file} ({mani.fastq_file_size(file_path)}, {fastq.scan(file_path)['reads']:,} reads)")
+                    plan = self.plan_file(instance, file_path)
+                    with self.telemetry.stage("counting", directory=data_directory, file=file, bytes=os.path.getsize(file_path),
+                                              samples=len(self.barcode_sheet.barcodes)) as record:
+                        sample_tables = instance.count_demultiplexed(matcher, self.barcode_sheet, file_path, data_directory)
+                        record["reads"] = instance.num_reads
+                        record["unique_reads"] = instance.num_unique_reads
+                        record["unassigned_reads"] = instance.unassigned_reads
+                        if plan:
+                            self.planner.record(record, plan)
+                    print(f"Finished {file}: {instance.num_reads - instance.unassigned_reads} of {instance.num_reads} reads assigned to {len(sample_tables)} samples")
+                    for sample, library_tables in sample_tables.items():
+                        for library in self.libraries:
+                            sample_dir = multilib.library_directory(sample, library.name)
+                            tables.setdefault(sample_dir, {})[file] = library_tables[library.name]
+                            with self.telemetry.stage("spreadsheet", directory=sample_dir, file=file):
+                                spreadsheet_instance.save_file(instance.pkl_file_path, file, sample_dir, library.instructions_link, table=library_tables[library.name])
+
+        for sample in self.barcode_sheet.barcodes:
+            for library in self.libraries:
+                sample_dir = multilib.library_directory(sample, library.name)
+                if sample_dir in tables:
+                    self.summarize_directory(instance, spreadsheet_instance, enrichment_instance, session_folder,
+                                             sample_dir, list(tables[sample_dir]), tables[sample_dir],
+                                             library.instructions_link, self.library_enrichment_file(library))
+
+    """
+    library_enrichment_file: library_spec --> str
+    -- Pre-insert file of one library: the -e file looked up in the library's
+    -- data directory (<pre dir>_<library>/<file>), None without -e
+    * @param [in] library (library_spec) - Library
+    * @param [out] enrichment_file (str) - Virtual pre-insert path for calc_enrichment
+    """
+    def library_enrichment_file(self, library):
+        if not self.enrichment_file:
+            return None
+        pre_dir = multilib.library_directory(os.path.basename(os.path.dirname(self.enrichment_file)), library.name)
+        return os.path.join(pre_dir, os.path.basename(self.enrichment_file))
+
+"""
+ * print_cache_report: dict --> None
+-- Prints what enforcing the cache cap did (see cache_manager.enforce)
+"""
+def print_cache_report(report):
+    limit = preview.format_bytes(report["limit"]) if report["limit"] is not None else "no limit"
+    print(color.BOLD + f"Cache: {preview.format_bytes(report['before'])} --> {preview.format_bytes(report['after'])} of {limit}" + color.END)
+    if report["compressed"]:
+        print(f"  Compressed {report['compressed']} cold artifacts, saving {preview.format_bytes(report['saved'])}")
+    for path, kind, size in report["evicted"]:
+        print(f"  Evicted {kind} {path} ({preview.format_bytes(size)})")
+    if report["over_limit"]:
+        print(color.RED + "  Still over the limit: the rest are session metadata and tables, which are always kept" + color.END)
+
+"""
+ * print_cache_usage: str --> None
+-- Prints the cache usage per session and shared folder, enforcing the cap first if there is one
+ * @param [in] limit_mb (str) - -cl value in MB, None to use CAPGENIE_CACHE_LIMIT
+"""
+def print_cache_usage(limit_mb=None):
+    manager = cache_manager.cache_manager(cache_manager.cache_limit(limit_mb))
+    if manager.limit is not None:
+        print_cache_report(manager.enforce())
+    usage = manager.usage()
+    print(color.BOLD + f"Cache folder {manager.cache_folder}: {preview.format_bytes(sum(owner['total'] for owner in usage.values()))}" + color.END)
+    for name, owner in usage.items():
+        kinds = ", ".join(f"{kind} {preview.format_bytes(size)}" for kind, size in owner.items() if kind not in ("total", "last_used"))
+        print(f"  {name or '(top level)'}: {preview.format_bytes(owner['total'])}, last used "
+              f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(owner['last_used']))} ({kinds})")
+
+"""
+ * print_lookup: str --> None
+-- Prints every sample of every session that lists a peptide, updating the
+-- cross-session peptide index first (see peptide_index.py)
+ * @param [in] query (str) - Peptide, or a prefix ending in *
+"""
+def print_lookup(query):
+    index = peptide_index()
+    report = index.update()
+    if report["indexed"] or report["removed"]:
+        print(f"Indexed {len(report['indexed'])} sessions ({report['hits']:,} rows), dropped {len(report['removed'])}")
+    start = time.perf_counter()
+    table = index.lookup(query.rstrip("*").upper(), prefix=query.endswith("*"))
+    elapsed = time.perf_counter() - start
+    index.close()
+    if table.empty:
+        print(f"{query} is in none of the {len(report['indexed']) + len(report['unchanged'])} indexed sessions")
+        return
+    table["File"] = table["File"].fillna("(average)")
+    table["Count"] = table["Count"].astype("Int64")
+    table = table.astype(object).where(table.notna(), "") # Blank where a sample has no count or enrichment
+    print(color.BOLD + f"{query}: {table.Peptide.nunique():,} peptides in {table.Session.nunique():,} sessions ({elapsed * 1000:.1f} ms)" + color.END)
+    print(table.to_string(index=False))
 
 def main():
     args = parser.parse_args()
+    threads.configure(args.threads)
+    if args.serve:
+        from capgenie.daemon import serve # daemon.py imports this module
+        serve(args.serve, [args.capsidfile] if args.capsidfile else [])
+        return
+    if args.cache_usage:
+        print_cache_usage(args.cache_limit)
+        return
+    if args.lookup:
+        print_lookup(args.lookup)
+        return
+    if not args.folder:
+        parser.error("the following arguments are required: -f/--folder")
     cap_genie(args).run_pipeline()
     
 if __name__ == "__main__":
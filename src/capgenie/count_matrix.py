@@ -0,0 +1,266 @@
+# File that holds every count table of a session as one sparse samples x
+# peptides count matrix. Peptides are stored once in a shared dictionary and
+# referred to by integer ids, samples (one per counted FASTQ file) carry their
+# metadata (data directory, file, kind of table, total count). The per file
+# tables, averages and enrichments are then vectorized operations on the CSR
+# matrix, and comparing data directories is a single sparse product instead of
+# loading and joining one pickle per file.
+#
+# Peptides a table lists with a count of 0 are kept as explicit zeros, so
+# "present in a replicate" means the same as in the per file tables (see
+# search_aav9.decimal_table, which keeps zeros).
+
+import pickle as pkl
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from scipy import sparse
+from capgenie import ranking
+
+MATRIX_VERSION = 1
+
+
+class count_matrix:
+    def __init__(self):
+        self.peptides = [] # Peptide id --> peptide
+        self.peptide_ids = {} # Peptide --> id
+        self.samples = [] # Sample metadata: sample, directory, file, kind, total
+        self._rows = [] # Per sample (peptide ids, counts)
+        self._matrix = None # CSR matrix, built on first use
+
+    # Sample name of a file of a data directory
+    @staticmethod
+    def sample_name(directory, file):
+        return f"{directory}/{file}"
+
+    def _peptide_id(self, peptide):
+        id = self.peptide_ids.get(peptide)
+        if id is None:
+            id = self.peptide_ids[peptide] = len(self.peptides)
+            self.peptides.append(peptide)
+        return id
+
+    def _index(self, sample):
+        for row, metadata in enumerate(self.samples):
+            if metadata["sample"] == sample:
+                return row
+        return None
+
+    """
+    add: str, str, DataFrame, str --> int
+    -- Adds the count table of a file as a sample, replacing the sample if the
+    -- file was added before
+    * @param [in] directory (str) - Data directory
+    * @param [in] file (str) - FASTQ file name
+    * @param [in] table (DataFrame) - Count table (Peptide, Count, Decimal)
+    * @param [in] kind (str) - Instructions key of the table (count_known_reads or unknown_reads)
+    * @param [out] row (int) - Row of the sample
+    ** A peptide listed twice (e.g. translated tables) keeps its last count, like the per file dict lookups
+    """
+    def add(self, directory, file, table, kind="count_known_reads"):
+        values = dict(zip(table.Peptide, table.Count))
+        ids = np.fromiter((self._peptide_id(peptide) for peptide in values), dtype=np.int64, count=len(values))
+        counts = np.fromiter(values.values(), dtype=np.int64, count=len(values))
+        metadata = {"sample": self.sample_name(directory, file), "directory": directory, "file": file,
+                    "kind": kind, "total": int(table.Count.sum())}
+
+        row = self._index(metadata["sample"])
+        if row is None:
+            row = len(self.samples)
+            self.samples.append(metadata)
+            self._rows.append((ids, counts))
+        else:
+            self.samples[row] = metadata
+            self._rows[row] = (ids, counts)
+        self._matrix = None
+        return row
+
+    """
+    remove: str, str --> None
+    -- Removes the sample of a file
+    """
+    def remove(self, directory, file):
+        row = self._index(self.sample_name(directory, file))
+        if row is not None:
+            del self.samples[row], self._rows[row]
+            self._matrix = None
+
+    """
+    update_directory: str, dict, str, list --> None
+    -- Makes the samples of a data directory (of one kind) exactly its files
+    * @param [in] directory (str) - Data directory
+    * @param [in] tables (dict) - File name --> count table, added or replaced
+    * @param [in] kind (str) - Instructions key of the tables
+    * @param [in] files (list) - Every file of the directory, the keys of tables by default.
+    -- Samples of other files are removed, samples of listed files without a table are kept
+    """
+    def update_directory(self, directory, tables, kind="count_known_reads", files=None):
+        files = list(tables) if files is None else files
+        for metadata in [m for m in self.samples if m["directory"] == directory and m["kind"] == kind and m["file"] not in files]:
+            self.remove(directory, metadata["file"])
+        for file, table in tables.items():
+            self.add(directory, file, table, kind)
+
+    # samples x peptides CSR matrix of counts
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            lengths = [len(ids) for ids, _ in self._rows]
+            indptr = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+            indices = np.concatenate([ids for ids, _ in self._rows]) if self._rows else np.zeros(0, dtype=np.int64)
+            data = np.concatenate([counts for _, counts in self._rows]) if self._rows else np.zeros(0, dtype=np.int64)
+            # Built from its arrays, so explicit zeros are kept
+            self._matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(self.samples), len(self.peptides)))
+        return self._matrix
+
+    """
+    rows: str, str --> ndarray
+    -- Rows of the samples of a data directory and/or kind
+    * @param [in] directory (str) - Data directory, None for all
+    * @param [in] kind (str) - Instructions key, None for all
+    * @param [out] rows (ndarray) - Row numbers, in the order the samples were added
+    """
+    def rows(self, directory=None, kind=None):
+        return np.array([row for row, metadata in enumerate(self.samples)
+                         if (directory is None or metadata["directory"] == directory) and (kind is None or metadata["kind"] == kind)],
+                        dtype=np.int64)
+
+    """
+    decimals: ndarray --> csr_matrix
+    -- Decimal (count / total count of the sample) of the given rows
+    * @param [in] rows (ndarray) - Row numbers, None for all
+    * @param [out] decimals (csr_matrix) - len(rows) x peptides, same sparsity as the counts
+    """
+    def decimals(self, rows=None):
+        counts = self.matrix if rows is None else self.matrix[rows]
+        totals = np.array([metadata["total"] for metadata in self.samples], dtype=float)
+        totals = totals if rows is None else totals[rows]
+        scale = np.divide(1.0, totals, out=np.zeros_like(totals), where=totals != 0)
+        return sparse.csr_matrix((counts.data * np.repeat(scale, np.diff(counts.indptr)), counts.indices, counts.indptr),
+                                 shape=counts.shape)
+
+    """
+    _dense_columns: csr_matrix, ndarray --> ndarray
+    -- Stored entries of the given peptide columns as a dense array, NaN where a
+    -- sample doesn't list the peptide
+    """
+    def _dense_columns(self, values, columns):
+        dense = np.full((values.shape[0], len(columns)), np.nan)
+        rows = np.repeat(np.arange(values.shape[0]), np.diff(values.indptr))
+        keep = np.isin(values.indices, columns)
+        dense[rows[keep], np.searchsorted(columns, values.indices[keep])] = values.data[keep]
+        return dense
+
+    """
+    table: str, str --> DataFrame
+    -- The count table of a sample
+    * @param [out] table (DataFrame) - Peptide, Count and Decimal, by count (ties in insertion order)
+    """
+    def table(self, directory, file):
+        row = self._index(self.sample_name(directory, file))
+        if row is None:
+            raise KeyError(f"No sample {self.sample_name(directory, file)}")
+        ids, counts = self._rows[row]
+        total = self.samples[row]["total"]
+        df = DataFrame({"Peptide": [self.peptides[id] for id in ids], "Count": counts})
+        df["Decimal"] = df["Count"] / total if total else 0.0
+        return df.iloc[ranking.rank_order(counts)].reset_index(drop=True) # Stored in rank order, so usually unchanged
+
+    """
+    average: str, str --> DataFrame
+    -- Average table of a data directory, the same table as search_aav9.avg_table
+    * @param [in] directory (str) - Data directory
+    * @param [in] kind (str) - Instructions key, None for all
+    * @param [out] merged_df (DataFrame) - One column per file plus Average Decimal, indexed by Peptide
+    """
+    def average(self, directory, kind=None):
+        rows = self.rows(directory, kind)
+        values = self.decimals(rows)
+        counts = np.bincount(values.indices, minlength=len(self.peptides))
+        sums = np.bincount(values.indices, weights=values.data, minlength=len(self.peptides))
+        present = np.flatnonzero(counts)
+
+        merged_df = DataFrame(self._dense_columns(values, present).T, columns=[self.samples[row]["file"] for row in rows],
+                              index=pd.Index([self.peptides[id] for id in present], name="Peptide"))
+        merged_df["Average Decimal"] = sums[present] / counts[present]
+        return merged_df.sort_values("Average Decimal", ascending=False)
+
+    """
+    enrichment: str, str, str, str --> DataFrame
+    -- Enrichment of the files of a data directory against a pre insert sample,
+    -- the same table as enrichment.enrichment_table
+    * @param [in] directory (str) - Data directory
+    * @param [in] pre_directory (str) - Data directory of the pre insert file
+    * @param [in] pre_file (str) - Pre insert file name (it is left out of directory)
+    * @param [in] kind (str) - Instructions key, None for all
+    * @param [out] df (DataFrame) - One enrichment column per file plus Average_Enrichment, indexed by Peptide
+    """
+    def enrichment(self, directory, pre_directory, pre_file, kind=None):
+        pre_row = self._index(self.sample_name(pre_directory, pre_file))
+        if pre_row is None:
+            raise KeyError(f"No sample {self.sample_name(pre_directory, pre_file)}")
+        rows = np.array([row for row in self.rows(directory, kind) if row != pre_row], dtype=np.int64)
+        pre = self.decimals(np.array([pre_row])).toarray()[0]
+        scale = np.divide(1.0, pre, out=np.zeros_like(pre), where=pre != 0)
+
+        values = self.decimals(rows)
+        keep = pre[values.indices] != 0 # Only peptides seen in the pre insert file
+        ratios = sparse.csr_matrix((values.data * scale[values.indices] * keep, values.indices, values.indptr), shape=values.shape)
+        counts = np.bincount(values.indices, weights=keep, minlength=len(self.peptides))
+        sums = np.bincount(values.indices, weights=ratios.data, minlength=len(self.peptides))
+        present = np.flatnonzero(counts)
+
+        df = DataFrame(self._dense_columns(ratios, present).T, columns=[self.samples[row]["file"] for row in rows],
+                       index=pd.Index([self.peptides[id] for id in present], name="Peptide"))
+        df["Average_Enrichment"] = sums[present] / counts[present]
+        return df.sort_values("Average_Enrichment", ascending=False)
+
+    """
+    directory_averages: str --> DataFrame
+    -- Average Decimal of every peptide in every data directory, in one sparse product
+    * @param [in] kind (str) - Instructions key, None for all
+    * @param [out] df (DataFrame) - Peptides x data directories, NaN where a directory never lists the peptide
+    """
+    def directory_averages(self, kind=None):
+        rows = self.rows(None, kind)
+        directories = list(dict.fromkeys(self.samples[row]["directory"] for row in rows))
+        groups = sparse.csr_matrix((np.ones(len(rows)), ([directories.index(self.samples[row]["directory"]) for row in rows],
+                                                         np.arange(len(rows)))), shape=(len(directories), len(rows)))
+        values = self.decimals(rows)
+        listed = sparse.csr_matrix((np.ones(len(values.data)), values.indices, values.indptr), shape=values.shape)
+        sums = (groups @ values).toarray()
+        counts = (groups @ listed).toarray()
+        present = np.flatnonzero(counts.sum(axis=0))
+
+        averages = np.divide(sums[:, present], counts[:, present], out=np.full((len(directories), len(present)), np.nan),
+                             where=counts[:, present] != 0)
+        return DataFrame(averages.T, columns=directories, index=pd.Index([self.peptides[id] for id in present], name="Peptide"))
+
+    """
+    save: str --> None
+    -- Pickles the matrix (peptides, sample metadata and CSR arrays)
+    """
+    def save(self, path):
+        matrix = self.matrix
+        with open(path, "wb") as f:
+            pkl.dump({"version": MATRIX_VERSION, "peptides": self.peptides, "samples": self.samples,
+                      "indptr": matrix.indptr, "indices": matrix.indices, "data": matrix.data}, f)
+
+    """
+    load: cls, str --> count_matrix
+    -- Loads a matrix written by save
+    """
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            content = pkl.load(f)
+        if content.get("version") != MATRIX_VERSION:
+            raise ValueError(f"{path} is not a version {MATRIX_VERSION} count matrix")
+        instance = cls()
+        instance.peptides = content["peptides"]
+        instance.peptide_ids = {peptide: id for id, peptide in enumerate(instance.peptides)}
+        instance.samples = content["samples"]
+        indptr, indices, data = content["indptr"], content["indices"], content["data"]
+        instance._rows = [(indices[indptr[row]:indptr[row + 1]].astype(np.int64), data[indptr[row]:indptr[row + 1]].astype(np.int64))
+                          for row in range(len(instance.samples))]
+        return instance
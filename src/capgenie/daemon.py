@@ -0,0 +1,288 @@
+# File that keeps capgenie running as a warm worker for the desktop app. Heavy
+# imports (pandas, plotly, umap, Biopython) and compiled library indexes are
+# loaded once, then jobs are read as JSON lines from stdin or a local socket and
+# progress/results are streamed back as JSON-lines events:
+#
+#   {"id": 1, "command": "run", "args": ["-f", "project", "-cf", "capsids.csv", "-ses", "run1"]}
+#   {"id": 2, "command": "count", "fastq_file": "a.fastq", "options": {"capsid_file": "capsids.csv"}}
+#   {"id": 3, "command": "load_library", "capsid_file": "capsids.csv"}
+#   {"id": 4, "command": "ping"}
+#   {"id": 5, "command": "shutdown"}
+#
+# Every job answers with job_start, any stage_start/stage_end events from its
+# telemetry, and then job_done (with a result) or job_error.
+#
+# Jobs read and write arbitrary paths as the user running the worker, so a
+# socket only accepts that user. A Unix socket is created with 0600
+# permissions. A TCP port (for platforms without Unix sockets) is reachable by
+# every local user, so each connection's first line has to be
+# {"token": "..."} with the token printed to stderr when the worker starts
+# (or set beforehand in CAPGENIE_WORKER_TOKEN by the app that launches it).
+
+import hmac
+import json
+import os
+import secrets
+import socketserver
+import stat
+import sys
+import time
+import traceback
+from capgenie import cli
+from capgenie import api
+from capgenie.library import library_index
+from capgenie.telemetry import telemetry
+
+TOKEN_ENV = "CAPGENIE_WORKER_TOKEN" # Token TCP clients authenticate with, generated when unset
+
+
+class worker_service:
+    def __init__(self):
+        self.jobs_run = 0
+        self.running = True
+        self.started = time.time()
+        self.commands = {
+            "run": self.run_job,
+            "count": self.count_job,
+            "load_library": self.load_library_job,
+            "ping": self.ping_job,
+            "shutdown": self.shutdown_job,
+        }
+
+    """
+    handle: dict, callable --> None
+    -- Runs one job and sends its events
+    * @param [in] job (dict) - Parsed job, {"id": ..., "command": ..., ...}
+    * @param [in] send (callable) - Writes one event dict to the client
+    * @param [out] None - Sends job_start, stage events and job_done/job_error
+    ** Errors (including argparse exits) are reported, the worker keeps running
+    """
+    def handle(self, job, send):
+        job_id = job.get("id")
+        command = job.get("command", "run")
+        emit = lambda payload: send({**payload, "id": job_id})
+
+        emit({"event": "job_start", "time": time.time(), "command": command})
+        start = time.perf_counter()
+        try:
+            if command not in self.commands:
+                raise ValueError(f"Unknown command: {command} (expected one of {', '.join(self.commands)})")
+            result = self.commands[command](job, emit)
+        except SystemExit as e:
+            emit({"event": "job_error", "time": time.time(), "error": f"Exited with status {e.code}"})
+        except Exception as e:
+            emit({"event": "job_error", "time": time.time(), "error": str(e), "traceback": traceback.format_exc()})
+        else:
+            emit({"event": "job_done", "time": time.time(), "wall_time": time.perf_counter() - start, "result": result})
+        self.jobs_run += 1
+
+    """
+    run_job: dict, callable --> dict
+    -- Runs the full CLI pipeline with the job's command line arguments
+    * @param [in] job (dict) - {"args": [...]} with the same flags as the CLI
+    * @param [in] emit (callable) - Event sender for this job
+    * @param [out] result (dict) - Session name and output directory
+    ** The worker can't prompt, so -ses/--session is required
+    """
+    def run_job(self, job, emit):
+        args = cli.parser.parse_args(job.get("args", []))
+        if not args.folder:
+            raise ValueError("Jobs must pass -f/--folder")
+        if not args.session and not args.clear_cache:
+            raise ValueError("Jobs must pass -ses/--session, the worker can't prompt for a session")
+        app = cli.cap_genie(args)
+        app.telemetry.listeners.append(emit)
+        app.run_pipeline()
+        return {"session": args.session, "output": args.output}
+
+    """
+    count_job: dict, callable --> dict
+    -- Counts one FASTQ file with api.count, without creating a session
+    * @param [in] job (dict) - {"fastq_file": ..., "options": {...}, "output": optional path, "limit": optional rows}
+    * @param [in] emit (callable) - Event sender for this job
+    * @param [out] result (dict) - Row count, saved path and the table rows
+    """
+    def count_job(self, job, emit):
+        options = dict(job.get("options", {}))
+        if options.get("flanks"):
+            options["flanks"] = tuple(options["flanks"])
+        job_telemetry = telemetry()
+        job_telemetry.listeners.append(emit)
+        with job_telemetry.stage("counting", file=os.path.basename(job["fastq_file"]), bytes=os.path.getsize(job["fastq_file"])):
+            table = api.count(job["fastq_file"], telemetry_instance=job_telemetry, **options)
+        result = {"rows": len(table), "output": None}
+        if job.get("output"):
+            result["output"] = api.save(table, job["output"])
+        limit = job.get("limit")
+        result["table"] = (table.head(limit) if limit is not None else table).to_dict(orient="records")
+        return result
+
+    """
+    load_library_job: dict, callable --> dict
+    -- Compiles (or loads) a capsid library index and keeps it warm
+    * @param [in] job (dict) - {"capsid_file": ...}
+    * @param [in] emit (callable) - Event sender for this job
+    * @param [out] result (dict) - Index digest and number of variants
+    """
+    def load_library_job(self, job, emit):
+        index = library_index.load(job["capsid_file"])
+        index.automaton # Loaded lazily, do it now so the next job is warm
+        return {"sha256": index.digest, "num_variants": index.meta["num_variants"]}
+
+    """
+    ping_job: dict, callable --> dict
+    -- Health check
+    * @param [out] result (dict) - Process id, uptime and number of jobs run
+    """
+    def ping_job(self, job, emit):
+        return {"pid": os.getpid(), "uptime": time.time() - self.started, "jobs_run": self.jobs_run}
+
+    """
+    shutdown_job: dict, callable --> dict
+    -- Stops the worker after this job
+    """
+    def shutdown_job(self, job, emit):
+        self.running = False
+        return {"jobs_run": self.jobs_run}
+
+    """
+    serve_lines: iterable, callable --> None
+    -- Runs every JSON job line until the input ends or a shutdown job
+    * @param [in] lines (iterable) - Text lines, one job per line
+    * @param [in] send (callable) - Writes one event dict to the client
+    """
+    def serve_lines(self, lines, send):
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                send({"event": "job_error", "id": None, "time": time.time(), "error": f"Invalid JSON job: {e}"})
+                continue
+            self.handle(job, send)
+            if not self.running:
+                return
+
+
+"""
+ * serve_stdin: worker_service --> None
+-- Serves jobs from stdin and writes events to stdout
+ * @param [in] service (worker_service) - The warm worker
+ * @param [out] None
+** Anything else printed to stdout (Python prints and the native extensions'
+** std::cout) is moved to stderr, so stdout only carries JSON events
+"""
+def serve_stdin(service):
+    sys.stdout.flush()
+    events = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def send(payload):
+        events.write(json.dumps(payload, default=str) + "\n")
+        events.flush()
+
+    send({"event": "ready", "id": None, "time": time.time(), "pid": os.getpid()})
+    service.serve_lines(sys.stdin, send)
+
+"""
+ * authenticated: str, str --> bool
+-- Checks the first line of a TCP connection against the worker's token
+ * @param [in] line (str) - First line the client sent, {"token": "..."}
+ * @param [in] token (str) - The worker's token
+ * @param [out] valid (bool) - Whether the client sent the token
+"""
+def authenticated(line, token):
+    try:
+        sent = json.loads(line).get("token")
+    except (ValueError, AttributeError):
+        return False
+    return isinstance(sent, str) and hmac.compare_digest(sent.encode(), token.encode())
+
+"""
+ * unix_server: str, type --> UnixStreamServer
+-- Binds a Unix socket only the current user can connect to
+ * @param [in] address (str) - Socket path
+ * @param [in] handler (type) - Request handler class
+ * @param [out] server (UnixStreamServer) - The bound server
+** Only a stale socket is replaced, any other file at the path is an error
+"""
+def unix_server(address, handler):
+    try:
+        mode = os.lstat(address).st_mode
+    except FileNotFoundError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"{address} exists and is not a socket")
+        os.remove(address) # Stale socket from a previous worker
+    umask = os.umask(0o177) # The socket is 0600 from the moment it is bound
+    try:
+        server = socketserver.UnixStreamServer(address, handler)
+    finally:
+        os.umask(umask)
+    os.chmod(address, 0o600)
+    return server
+
+"""
+ * serve_socket: worker_service, str --> None
+-- Serves jobs over a local socket, one connection at a time
+ * @param [in] service (worker_service) - The warm worker
+ * @param [in] address (str) - A port number (bound to 127.0.0.1, token required) or a Unix socket path (0600)
+ * @param [out] None
+"""
+def serve_socket(service, address):
+    token = None
+    if address.isdigit():
+        token = os.environ.get(TOKEN_ENV) or secrets.token_urlsafe(32)
+
+    class job_handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def send(payload):
+                self.wfile.write((json.dumps(payload, default=str) + "\n").encode())
+                self.wfile.flush()
+
+            lines = (line.decode() for line in self.rfile)
+            if token is not None and not authenticated(next(lines, ""), token):
+                send({"event": "job_error", "id": None, "time": time.time(), "error": "Missing or wrong token"})
+                return
+            send({"event": "ready", "id": None, "time": time.time(), "pid": os.getpid()})
+            service.serve_lines(lines, send)
+
+    if address.isdigit():
+        socketserver.TCPServer.allow_reuse_address = True
+        server = socketserver.TCPServer(("127.0.0.1", int(address)), job_handler)
+        shown = "from " + TOKEN_ENV if os.environ.get(TOKEN_ENV) else token
+        print(f"capgenie worker listening on 127.0.0.1:{address}, token {shown}", file=sys.stderr)
+    else:
+        server = unix_server(address, job_handler)
+        print(f"capgenie worker listening on {address}", file=sys.stderr)
+
+    try:
+        while service.running:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if not address.isdigit():
+            try:
+                if stat.S_ISSOCK(os.lstat(address).st_mode):
+                    os.remove(address)
+            except FileNotFoundError:
+                pass
+
+"""
+ * serve: str, list --> None
+-- Starts the warm worker
+ * @param [in] address (str) - "-" for stdin/stdout, otherwise a port or Unix socket path
+ * @param [in] capsid_files (list) - Capsid files whose library indexes are loaded up front
+ * @param [out] None
+"""
+def serve(address="-", capsid_files=()):
+    service = worker_service()
+    for capsid_file in capsid_files:
+        library_index.load(capsid_file).automaton
+    if address == "-":
+        serve_stdin(service)
+    else:
+        serve_socket(service, address)
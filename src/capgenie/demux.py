@@ -0,0 +1,140 @@
+# File that demultiplexes pooled FASTQ files by inline sample barcodes. A barcode
+# sheet (CSV with Sample and Barcode columns) maps the barcode at the start of
+# each read to a sample. Lookups tolerate mismatches: every barcode variant
+# within the allowed Hamming distance is precomputed into one dictionary, and
+# variants that two samples would share are dropped so no read is assigned to
+# the wrong sample.
+#
+# Demultiplexing works on the collapsed unique reads (see fastq.collapse_reads),
+# so the pooled file is read once and every sample's reads go straight to the
+# counting engines (multilib.tagged_matcher) without writing per-sample files.
+
+import csv
+from collections import Counter
+from itertools import combinations, product
+
+BASES = "ACGTN"
+
+
+class barcode_sheet:
+    """
+    __init__: dict, int --> barcode_sheet
+    -- Builds the mismatch tolerant lookup table of a set of barcodes
+    * @param [in] barcodes (dict) - Sample name --> barcode sequence
+    * @param [in] mismatches (int) - Allowed mismatches per barcode (Hamming distance)
+    """
+    def __init__(self, barcodes, mismatches=1):
+        self.barcodes = {sample: barcode.upper() for sample, barcode in barcodes.items()}
+        self.mismatches = int(mismatches)
+        self.lengths = sorted({len(barcode) for barcode in self.barcodes.values()}, reverse=True)
+
+        duplicates = Counter(self.barcodes.values())
+        shared = sorted(barcode for barcode, count in duplicates.items() if count > 1)
+        if shared:
+            raise ValueError(f"Barcodes used by more than one sample: {', '.join(shared)}")
+
+        self.lookup = {}
+        ambiguous = set()
+        for sample, barcode in self.barcodes.items():
+            for variant in self.variants(barcode, self.mismatches):
+                if self.lookup.get(variant, sample) != sample:
+                    ambiguous.add(variant)
+                self.lookup[variant] = sample
+        for variant in ambiguous:
+            del self.lookup[variant]
+        for sample, barcode in self.barcodes.items(): # An exact match always wins
+            self.lookup[barcode] = sample
+        self.num_ambiguous = len(ambiguous)
+
+    """
+    load: cls, str, int --> barcode_sheet
+    -- Reads a barcode sheet
+    * @param [in] path (str) - CSV file with Sample,Barcode rows (the header is optional)
+    * @param [in] mismatches (int) - Allowed mismatches per barcode
+    * @param [out] sheet (barcode_sheet) - The sheet
+    """
+    @classmethod
+    def load(cls, path, mismatches=1):
+        barcodes = {}
+        with open(path, newline="") as f:
+            for row in csv.reader(f):
+                row = [cell.strip() for cell in row]
+                if len(row) < 2 or not row[0] or row[0].startswith("#"):
+                    continue
+                if row[0].lower() == "sample" and row[1].lower() == "barcode":
+                    continue
+                if row[0] in barcodes:
+                    raise ValueError(f"Sample '{row[0]}' is listed twice in {path}")
+                barcodes[row[0]] = row[1]
+        if not barcodes:
+            raise ValueError(f"No Sample,Barcode rows found in {path}")
+        return cls(barcodes, mismatches)
+
+    """
+    variants: cls, str, int --> generator
+    -- Yields every sequence within the given Hamming distance of a barcode
+    * @param [in] barcode (str) - Barcode sequence
+    * @param [in] mismatches (int) - Maximum Hamming distance
+    * @param [out] variants (generator) - Variant sequences, the barcode itself first
+    """
+    @classmethod
+    def variants(cls, barcode, mismatches):
+        yield barcode
+        for distance in range(1, mismatches + 1):
+            for positions in combinations(range(len(barcode)), distance):
+                choices = [[base for base in BASES if base != barcode[i]] for i in positions]
+                for bases in product(*choices):
+                    variant = list(barcode)
+                    for i, base in zip(positions, bases):
+                        variant[i] = base
+                    yield "".join(variant)
+
+    """
+    assign: str --> tuple
+    -- Finds the sample of a read from the barcode at its start
+    * @param [in] read (str) - Read sequence
+    * @param [out] assignment (tuple) - (sample, barcode length), (None, 0) if unassigned
+    ** Longer barcodes are tried first when the sheet mixes lengths
+    """
+    def assign(self, read):
+        for length in self.lengths:
+            sample = self.lookup.get(read[:length])
+            if sample is not None:
+                return sample, length
+        return None, 0
+
+    """
+    split: dict --> tuple
+    -- Splits a unique read table into one table per sample, with the barcodes trimmed
+    * @param [in] unique_reads (dict) - Read sequence --> multiplicity
+    * @param [out] result (tuple) - ({sample: {read: multiplicity}}, unassigned read count)
+    ** Every sample of the sheet is present, even without reads
+    """
+    def split(self, unique_reads):
+        samples = {sample: Counter() for sample in self.barcodes}
+        unassigned = 0
+        for read, multiplicity in unique_reads.items():
+            sample, length = self.assign(read)
+            if sample is None:
+                unassigned += multiplicity
+            else:
+                samples[sample][read[length:]] += multiplicity
+        return samples, unassigned
+
+    """
+    count: tagged_matcher, dict --> Counter
+    -- Demultiplexes a unique read table and counts every sample with the
+    -- libraries of a tagged matcher
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] unique_reads (dict) - Read sequence --> multiplicity
+    * @param [out] counts (Counter) - (sample, library, sequence) --> count, plus the reads
+    -- of every sample under (sample, None, None) and unassigned reads under (None, None, None)
+    """
+    def count(self, matcher, unique_reads):
+        samples, unassigned = self.split(unique_reads)
+        counts = Counter({(None, None, None): unassigned})
+        for sample, reads in samples.items():
+            counts[(sample, None, None)] = sum(reads.values())
+            for (name, key), count in matcher.count(reads).items():
+                counts[(sample, name, key)] += count
+        return counts
@@ -13,20 +13,24 @@
 #include <filesystem>
 #include <cstring>
 #include <cstdint>
+#include <string_view>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 #include "platform_compat.h"
+#include "sequence_view.h"
+#include "simd.h"
+#include "thread_pool.h"
 
 namespace py = pybind11;
 
-#define NUM_THREADS 10  // Adjust based on CPU cores
-int QUALITY_THRESHOLD = 30;  // Min average quality score to keep
-
-std::mutex output_mutex;
-std::atomic<long long> total_quality_sum(0);
-std::atomic<size_t> total_chars(0);
-std::atomic<size_t> low_quality_reads(0);
-std::atomic<size_t> num_reads(0);
-// Variables for storing read quality data
+// Read quality counters of one denoise call, shared by the chunks of that call
+struct QualityCounts {
+    int threshold = 30; // Min average quality score to keep
+    std::atomic<long long> total_quality_sum{0};
+    std::atomic<size_t> total_chars{0};
+    std::atomic<size_t> low_quality_reads{0};
+    std::atomic<size_t> num_reads{0};
+};
 
 /**
  * joinPaths: const char*, const char* --> std::string
@@ -64,56 +68,102 @@ std::string joinPaths(const char* path1, const char* path2) {
 }
 
 /**
- * process_chunk: const char*, size_t, size_t, std::ofstream& --> void
+ * process_chunk: const char*, size_t, size_t, QualityCounts&, std::string*, std::vector<uint8_t>* --> void
 -- Processes a chunk of FASTQ data and filters reads based on quality threshold
  * @param [in] data (const char*) - Memory-mapped file data
- * @param [in] start (size_t) - Starting position in the data
- * @param [in] end (size_t) - Ending position in the data
- * @param [in/out] output (std::ofstream&) - Output file stream for high-quality reads
- * @param [out] None - Writes high-quality reads to output stream
-** Processes FASTQ chunk and filters by quality score
+ * @param [in] start (size_t) - Starting position in the data (start of a record)
+ * @param [in] end (size_t) - Ending position in the data (start of the next chunk's first record)
+ * @param [in/out] counts (QualityCounts&) - Threshold and counters of the call the chunk belongs to
+ * @param [in/out] high_quality_reads (std::string*) - Receives the high-quality reads of the chunk, may be null
+ * @param [in/out] passes (std::vector<uint8_t>*) - Receives 1 (kept) or 0 (filtered) per read, may be null
+ * @param [out] None - Appends high-quality reads to high_quality_reads
+** Processes FASTQ chunk and filters by quality score. Lines are found with
+** memchr and quality lines summed with the SIMD kernels in simd.h
 */
-void process_chunk(const char* data, size_t start, size_t end, std::ofstream& output) {
+void process_chunk(const char* data, size_t start, size_t end, QualityCounts& counts, std::string* high_quality_reads, std::vector<uint8_t>* passes = nullptr) {
     size_t i = start;
-    std::string high_quality_reads = "";
-
-    while (i < end) {
-        // Read FASTQ entry
-        size_t entry_start = i;
-        std::string id_line, seq_line, plus_line, quality_line;
-        
-        if (i < end) while (i < end && data[i] != '\n') id_line += data[i++];
-        i++;
-
-        if (i < end) while (i < end && data[i] != '\n') seq_line += data[i++];
-        i++;
 
-        if (i < end) while (i < end && data[i] != '\n') plus_line += data[i++];
+    // Next line of the entry as a view into data, empty once the chunk is used up
+    auto next_line = [&](std::string_view& line) {
+        if (i < end) {
+            const char* line_end = simd::find_newline(data + i, data + end);
+            line = std::string_view(data + i, line_end - (data + i));
+            i = line_end - data;
+        } else {
+            line = std::string_view();
+        }
         i++;
+    };
 
-        if (i < end) while (i < end && data[i] != '\n') quality_line += data[i++];
-        i++;
+    while (i < end) {
+        // Read FASTQ entry
+        std::string_view id_line, seq_line, plus_line, quality_line;
+        next_line(id_line);
+        next_line(seq_line);
+        next_line(plus_line);
+        next_line(quality_line);
 
         // Compute average quality score
-        long long total_quality = 0;
-        for (char q : quality_line) {
-            total_quality += (q - 33);
-        }
+        long long total_quality = simd::quality_sum(quality_line.data(), quality_line.size());
         double avg_quality = (quality_line.empty()) ? 0 : (double)total_quality / quality_line.size();
-        total_quality_sum += total_quality;
-        total_chars += quality_line.size();
+        counts.total_quality_sum += total_quality;
+        counts.total_chars += quality_line.size();
         // If average quality is above threshold, store the entry
-        if (avg_quality > QUALITY_THRESHOLD) {
-            high_quality_reads += id_line + "\n" + seq_line + "\n" + plus_line + "\n" + quality_line + "\n";
-        } else {
-            low_quality_reads++;
+        bool keep = avg_quality > counts.threshold;
+        if (passes) passes->push_back(keep);
+        if (keep && high_quality_reads) {
+            for (std::string_view line : {id_line, seq_line, plus_line, quality_line}) {
+                high_quality_reads->append(line);
+                *high_quality_reads += '\n';
+            }
+        } else if (!keep) {
+            counts.low_quality_reads++;
         }
-        num_reads++;
+        counts.num_reads++;
     }
+}
 
-    std::lock_guard<std::mutex> lock(output_mutex);
-    output << high_quality_reads;
+/**
+ * next_record_start: const char*, size_t, size_t --> size_t
+-- Moves a position forward to the start of the next FASTQ record
+ * @param [in] data (const char*) - Memory-mapped file data
+ * @param [in] size (size_t) - Number of bytes
+ * @param [in] pos (size_t) - Position to start looking from
+ * @param [out] record_start (size_t) - Start of the next record, or size
+** A line starting with '@' is only a header if the line after the next one
+** starts with '+', since quality lines can start with '@' too
+*/
+size_t next_record_start(const char* data, size_t size, size_t pos) {
+    const char* end = data + size;
+    if (pos == 0) return 0;
+    if (pos < size && data[pos - 1] != '\n') pos = simd::find_newline(data + pos, end) - data + 1;
+    while (pos < size) {
+        if (data[pos] == '@') {
+            const char* seq_end = simd::find_newline(data + pos, end);
+            const char* plus_end = seq_end < end ? simd::find_newline(seq_end + 1, end) : end;
+            if (plus_end + 1 < end && plus_end[1] == '+') return pos;
+        }
+        pos = simd::find_newline(data + pos, end) - data + 1;
+    }
+    return size;
+}
 
+/**
+ * chunk_bounds: const char*, size_t --> std::vector<size_t>
+-- Splits FASTQ data into record aligned chunks, a few per pool thread so
+-- uneven chunks balance out
+ * @param [in] data (const char*) - FASTQ data
+ * @param [in] size (size_t) - Number of bytes
+ * @param [out] bounds (std::vector<size_t>) - Chunk c is [bounds[c], bounds[c + 1])
+*/
+std::vector<size_t> chunk_bounds(const char* data, size_t size) {
+    const size_t min_chunk = 1 << 20;
+    size_t chunk_size = std::max(min_chunk, size / (thread_pool::shared().num_threads() * 4) + 1);
+    std::vector<size_t> bounds = {0};
+    while (bounds.back() < size) {
+        bounds.push_back(next_record_start(data, size, std::min(size, bounds.back() + chunk_size)));
+    }
+    return bounds;
 }
 
 struct DenoiseResult {
@@ -126,42 +176,70 @@ struct DenoiseResult {
 };
 
 /**
- * clear_pointers: None --> void
--- Clears global atomic variables for next function usage
- * @param [out] None - Resets global variables to zero
-** Resets global counters for next denoise operation
-*/
-void clear_pointers() {
-    //Clear for next function usage
-    total_quality_sum = 0;
-    total_chars = 0;
-    low_quality_reads = 0;
-    num_reads = 0;
-}
-
-/**
- * denoise: const char*, const char*, const char*, int --> DenoiseResult
--- Filters low-quality reads from a FASTQ file based on quality threshold
- * @param [in] filename (const char*) - Name of the output file
- * @param [in] file_path (const char*) - Path to the input FASTQ file
- * @param [in] output_path (const char*) - Path for output directory
+ * denoise_data: const char*, size_t, std::string, int --> DenoiseResult
+-- Filters low-quality reads from FASTQ data that is already in memory
+ * @param [in] data (const char*) - Start of the FASTQ records
+ * @param [in] size (size_t) - Number of bytes
+ * @param [in] output_filename (const std::string&) - Path of the filtered FASTQ file
  * @param [in] threshold (int) - Quality threshold for filtering
  * @param [out] result (DenoiseResult) - Statistics about the denoising process
-** Main denoising function that filters FASTQ reads by quality
+** Shared by the file and buffer entry points, the data is never copied. Every
+** call keeps its own counters, so calls without the GIL can run concurrently
 */
-DenoiseResult denoise(const char* filename, const char* file_path, const char* output_path, int threshold) {
-    clear_pointers();
-    std::string output_filename = joinPaths(output_path, filename);
-    std::cout << file_path << std::endl;
-
+DenoiseResult denoise_data(const char* data, size_t size, const std::string& output_filename, int threshold) {
     DenoiseResult result;
+    QualityCounts counts;
+    counts.threshold = threshold;
+
+    // Open output file
+
+    std::ofstream output(output_filename, std::ios::out);
+    if (!output.is_open()) {
+        std::cerr << "Error opening output file!\n";
+        return result;
+    }
 
-    QUALITY_THRESHOLD = threshold;
+    // Chunks are written in file order, so the output doesn't depend on the
+    // number of threads
+    std::vector<size_t> bounds = chunk_bounds(data, size);
+    std::vector<std::string> chunk_output(bounds.size() - 1);
+    thread_pool::shared().parallel_for(chunk_output.size(), [&](size_t c) {
+        process_chunk(data, bounds[c], bounds[c + 1], counts, &chunk_output[c]);
+    });
+
+    for (std::string& chunk : chunk_output) {
+        output << chunk;
+        std::string().swap(chunk);
+    }
+    output.close();
 
+    double avg_quality_per_char = counts.total_chars ? (double)counts.total_quality_sum / counts.total_chars : 0;
+    std::cout << "Average quality of file: " << avg_quality_per_char << "\n";
+    std::cout << "Number of reads below threshold: " << counts.low_quality_reads << "\n";
+    std::cout << "Percentage of low quality reads: " << ((double)counts.low_quality_reads*100 / counts.num_reads) << "\n";
+    std::cout << "Filtered reads saved to " << output_filename << std::endl;
+    
+    result.low_quality_reads = counts.low_quality_reads;
+    result.total_chars = counts.total_chars;
+    result.avg_quality = avg_quality_per_char;
+    result.num_reads = counts.num_reads;
+    result.threshold = counts.threshold;
+    result.output_filename = output_filename;
+    return result;
+}
+
+/**
+ * map_file: const char*, size_t& --> char*
+-- Memory maps a whole file read-only
+ * @param [in] file_path (const char*) - Path to the file
+ * @param [out] file_size (size_t&) - Size of the file
+ * @param [out] data (char*) - The mapping (munmap it), nullptr on error
+*/
+char* map_file(const char* file_path, size_t& file_size) {
     int fd = open(file_path, O_RDONLY);
     if (fd < 0) {
         std::cerr << "Error opening file!\n";
-        return result;
+        return nullptr;
     }
 
     // Get file size
@@ -169,62 +247,128 @@ DenoiseResult denoise(const char* filename, const char* file_path, const char* o
     if (fstat(fd, &sb) == -1) {
         std::cerr << "Error getting file size!\n";
         fd_close(fd);
-        return result;
+        return nullptr;
     }
-    size_t file_size = sb.st_size;
+    file_size = sb.st_size;
     char* data = (char*)mmap(nullptr, file_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    fd_close(fd);
     if (data == MAP_FAILED) {
         std::cerr << "Error memory-mapping file!\n";
-        fd_close(fd);
-        return result;
+        return nullptr;
     }
-    fd_close(fd);
+    return data;
+}
 
-    // Open output file
+/**
+ * denoise: const char*, const char*, const char*, int --> DenoiseResult
+-- Filters low-quality reads from a FASTQ file based on quality threshold
+ * @param [in] filename (const char*) - Name of the output file
+ * @param [in] file_path (const char*) - Path to the input FASTQ file
+ * @param [in] output_path (const char*) - Path for output directory
+ * @param [in] threshold (int) - Quality threshold for filtering
+ * @param [out] result (DenoiseResult) - Statistics about the denoising process
+** Main denoising function that filters FASTQ reads by quality
+*/
+DenoiseResult denoise(const char* filename, const char* file_path, const char* output_path, int threshold) {
+    std::string output_filename = joinPaths(output_path, filename);
+    std::cout << file_path << std::endl;
 
-    std::ofstream output(output_filename, std::ios::out);
-    if (!output.is_open()) {
-        std::cerr << "Error opening output file!\n";
-        munmap(data, file_size);
-        return result;
-    }
+    DenoiseResult result;
 
-    // Determine chunk size for threads
-    size_t chunk_size = file_size / NUM_THREADS;
-    std::vector<std::thread> threads;
+    size_t file_size = 0;
+    char* data = map_file(file_path, file_size);
+    if (!data) return result;
 
-    for (int i = 0; i < NUM_THREADS; ++i) {
-        size_t start = i * chunk_size;
-        size_t end = (i == NUM_THREADS - 1) ? file_size : (i + 1) * chunk_size;
+    result = denoise_data(data, file_size, output_filename, threshold);
+    munmap(data, file_size);
+    return result;
+}
 
-        while (start > 0 && data[start - 1] != '\n') start++;
-        while (end < file_size && data[end] != '\n') end++;
+/**
+ * denoise_buffer: const char*, py::object, const char*, int --> DenoiseResult
+-- Filters low-quality reads from FASTQ records held in a Python buffer
+ * @param [in] filename (const char*) - Name of the output file
+ * @param [in] data (py::object) - bytes, mmap, memoryview or uint8 array of whole FASTQ records
+ * @param [in] output_path (const char*) - Path for output directory
+ * @param [in] threshold (int) - Quality threshold for filtering
+ * @param [out] result (DenoiseResult) - Statistics about the denoising process
+** The buffer is read in place and the GIL is released while filtering
+*/
+DenoiseResult denoise_buffer(const char* filename, py::object data, const char* output_path, int threshold) {
+    std::string output_filename = joinPaths(output_path, filename);
+
+    sequence_view buffer(data);
+    py::gil_scoped_release release;
+    return denoise_data(buffer.data(), buffer.size(), output_filename, threshold);
+}
 
-        //run process_chunk for each chunk and connect it to mutex output
-        
-        threads.emplace_back(process_chunk, data, start, end, std::ref(output));
+struct MaskResult {
+    DenoiseResult stats;
+    std::string bitmap; // Bit i (least significant first) is set when read i passes
+    std::vector<uint64_t> checkpoint_offsets; // Byte offset of every chunk
+    std::vector<uint64_t> checkpoint_reads; // Index of the first read of every chunk
+};
+
+/**
+ * denoise_mask_data: const char*, size_t, int --> MaskResult
+-- Applies the denoise quality filter without writing any reads, recording
+-- a pass/fail bit per read instead (see quality_mask.py)
+ * @param [in] data (const char*) - Start of the FASTQ records
+ * @param [in] size (size_t) - Number of bytes
+ * @param [in] threshold (int) - Quality threshold for filtering
+ * @param [out] result (MaskResult) - Statistics, bitmap and chunk checkpoints
+** The chunk checkpoints let readers of a byte range find the read index of
+** its first record by scanning at most one chunk. Every call keeps its own
+** counters, so calls without the GIL can run concurrently
+*/
+MaskResult denoise_mask_data(const char* data, size_t size, int threshold) {
+    MaskResult result;
+    QualityCounts counts;
+    counts.threshold = threshold;
+    std::vector<size_t> bounds = chunk_bounds(data, size);
+    std::vector<std::vector<uint8_t>> chunk_passes(bounds.size() - 1);
+    thread_pool::shared().parallel_for(chunk_passes.size(), [&](size_t c) {
+        process_chunk(data, bounds[c], bounds[c + 1], counts, nullptr, &chunk_passes[c]);
+    });
+
+    result.bitmap.assign((counts.num_reads + 7) / 8, '\0');
+    uint64_t read = 0;
+    for (size_t c = 0; c < chunk_passes.size(); ++c) {
+        result.checkpoint_offsets.push_back(bounds[c]);
+        result.checkpoint_reads.push_back(read);
+        for (uint8_t keep : chunk_passes[c]) {
+            if (keep) result.bitmap[read >> 3] |= static_cast<char>(1 << (read & 7));
+            ++read;
+        }
+        std::vector<uint8_t>().swap(chunk_passes[c]);
     }
 
-    // Join threads
-    for (auto& t : threads) {
-        t.join();
+    result.stats.low_quality_reads = counts.low_quality_reads;
+    result.stats.total_chars = counts.total_chars;
+    result.stats.avg_quality = counts.total_chars ? (double)counts.total_quality_sum / counts.total_chars : 0;
+    result.stats.num_reads = counts.num_reads;
+    result.stats.threshold = counts.threshold;
+    return result;
+}
+
+/**
+ * denoise_mask: const char*, int --> MaskResult
+-- Records which reads of a FASTQ file pass the quality threshold (see denoise_mask_data)
+ * @param [in] file_path (const char*) - Path to the input FASTQ file
+ * @param [in] threshold (int) - Quality threshold for filtering
+ * @param [out] result (MaskResult) - Statistics, bitmap and chunk checkpoints
+*/
+MaskResult denoise_mask(const char* file_path, int threshold) {
+    size_t file_size = 0;
+    char* data = map_file(file_path, file_size);
+    if (!data) throw std::runtime_error(std::string("Can't read ") + file_path);
+
+    MaskResult result;
+    {
+        py::gil_scoped_release release;
+        result = denoise_mask_data(data, file_size, threshold);
     }
-    output.close();
     munmap(data, file_size);
-
-    double avg_quality_per_char = total_chars ? (double)total_quality_sum / total_chars : 0;
-    std::cout << "Average quality of file: " << avg_quality_per_char << "\n";
-    std::cout << "Number of reads below threshold: " << low_quality_reads << "\n";
-    std::cout << "Percentage of low quality reads: " << ((double)low_quality_reads*100 / num_reads) << "\n";
-    std::cout << "Filtered reads saved to " << output_filename << std::endl;
-    
-    result.low_quality_reads = low_quality_reads;
-    result.total_chars = total_chars;
-    result.avg_quality = avg_quality_per_char;
-    result.num_reads = num_reads;
-    result.threshold = QUALITY_THRESHOLD;
-    result.output_filename = output_filename;
-    clear_pointers();
     return result;
 }
 
@@ -239,6 +383,19 @@ PYBIND11_MODULE(denoise, m) {
         .def_readwrite("output_filename", &DenoiseResult::output_filename)
         .def_readwrite("low_quality_reads", &DenoiseResult::low_quality_reads);
 
+    py::class_<MaskResult>(m, "MaskResult")
+        .def_readonly("stats", &MaskResult::stats)
+        .def_property_readonly("bitmap", [](const MaskResult& r) { return py::bytes(r.bitmap); })
+        .def_readonly("checkpoint_offsets", &MaskResult::checkpoint_offsets)
+        .def_readonly("checkpoint_reads", &MaskResult::checkpoint_reads);
+
+    m.def("set_num_threads", [](size_t n) { thread_pool::shared().set_num_threads(n); },
+          "Resizes the shared worker pool", py::arg("num_threads"));
+    m.def("get_num_threads", []() { return thread_pool::shared().num_threads(); }, "Size of the shared worker pool");
     m.def("denoise", &denoise, "Filter low-quality reads from a FASTQ file",
           py::arg("filename"), py::arg("file_path"), py::arg("output_path"), py::arg("threshold"));
+    m.def("denoise_buffer", &denoise_buffer, "Filter low-quality reads from a FASTQ buffer without copying",
+          py::arg("filename"), py::arg("data"), py::arg("output_path"), py::arg("threshold"));
+    m.def("denoise_mask", &denoise_mask, "Record a pass/fail bit per read instead of writing a filtered FASTQ",
+          py::arg("file_path"), py::arg("threshold"));
 }
\ No newline at end of file
@@ -36,7 +36,44 @@ class enrichment:
         return float(x.strip('%'))/100
 
     """
-    calc_enrichment: str, str, list, str, str --> str
+    enrichment_table: cls, DataFrame, dict --> DataFrame
+    -- Calculates the enrichment of every table against the pre insert table
+    * @param [in] pre_insert_table (DataFrame) - Count table (Peptide, Decimal) of the pre insert file
+    * @param [in] tables (dict) - File name --> count table of every other file
+    * @param [out] df (DataFrame) - One enrichment column per file plus Average_Enrichment, indexed by Peptide
+    ** Only peptides seen in the pre insert file are kept
+    """
+    @classmethod
+    def enrichment_table(cls, pre_insert_table, tables):
+        pre_insert_dict = dict(zip(pre_insert_table.Peptide, pre_insert_table.Decimal))
+        pre_insert_dict = {x:y for x,y in pre_insert_dict.items() if y != 0}
+
+        new_enrichment_dict = {}
+        columns = []
+
+        for file, file_dict in tables.items():
+            obj_dict = dict(zip(file_dict.Peptide, file_dict.Decimal))
+
+            for key, pre_insert_value in pre_insert_dict.items():
+                if key not in obj_dict:
+                    pass
+                else:
+                    if key not in new_enrichment_dict:
+                        new_enrichment_dict[key] = [obj_dict[key]/pre_insert_value]
+                    else:
+                        new_enrichment_dict[key].append(obj_dict[key]/pre_insert_value)
+            columns.append(file)
+
+        df = DataFrame.from_dict(new_enrichment_dict, orient='index', columns = columns)
+        df.index.name = "Peptide"
+        cols = df.columns.tolist()
+        df = df[cols]
+        df['Average_Enrichment'] = df[cols].mean(axis=1)
+        df = df.sort_values("Average_Enrichment", ascending=False)
+        return df
+
+    """
+    calc_enrichment: str, str, list, str, str, dict, replicate_aggregate --> str
     -- Calculates the enrichment of all fastq files and saves them into 
     excel sheets and .pkl
     * @param [in] pre_insert (str) - The pre insert file used for calculating enrichment
@@ -44,44 +81,36 @@ class enrichment:
     * @param [in] files (list) - List of files to process
     * @param [in] data_directory (str) - Data directory path
     * @param [in] instruction_name (str) - Instruction name for file extension
+    * @param [in] tables (dict) - Optional file name --> table already in memory, skips reloading the pkls
+    * @param [in] aggregate (replicate_aggregate) - Optional running aggregate of the files (see aggregate.py),
+    only the pre insert peptides are then looked up in it
     * @param [out] result (str) - Name of the generated enrichment file
     ** Calculates enrichment factors for peptide data
     """
 
-    def calc_enrichment(self, pre_insert, session_folder, files, data_directory, instruction_name):
+    def calc_enrichment(self, pre_insert, session_folder, files, data_directory, instruction_name, tables=None, aggregate=None):
         if instruction_name == "count_known_reads":
             file_ext = "variants_"
         else:
             file_ext = "unknown_variants_"
         pre_insert_path = os.path.join(os.path.basename(os.path.dirname(pre_insert)), f"{file_ext}{os.path.basename(pre_insert)}").replace(".fastq", ".pkl")
-        pre_insert_dict = pkl.load(open(os.path.join(self.cache_folder, session_folder, "pkl_files", pre_insert_path), "rb"))
-        pre_insert_dict = dict(zip(pre_insert_dict.Peptide, pre_insert_dict.Decimal))
-        pre_insert_dict = {x:y for x,y in pre_insert_dict.items() if y != 0}
+        pre_insert_table = pkl.load(open(os.path.join(self.cache_folder, session_folder, "pkl_files", pre_insert_path), "rb"))
 
-        new_enrichment_dict = {}
-        columns = []
+        if aggregate is not None:
+            exclude = [file for file in files if os.path.basename(pre_insert).replace(".fastq", "") in file]
+            df = aggregate.enrichment_table(pre_insert_table, exclude)
+            df.to_pickle(os.path.join(self.cache_folder, session_folder, "pkl_files", data_directory, f"average_enrichment_{data_directory}.pkl"))
+            return f"average_enrichment_{data_directory}.fastq"
 
+        tables = tables if tables else {}
+        file_tables = {}
         for file in files:
             if os.path.basename(pre_insert).replace(".fastq", "") not in file:
-                file_dict = pd.read_pickle(os.path.join(self.cache_folder, session_folder, "pkl_files", data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl"))
-                obj_dict = dict(zip(file_dict.Peptide, file_dict.Decimal))
-
-                for key, pre_insert_value in pre_insert_dict.items():
-                    if key not in obj_dict:
-                        pass
-                    else:
-                        if key not in new_enrichment_dict:
-                            new_enrichment_dict[key] = [obj_dict[key]/pre_insert_value]
-                        else:
-                            new_enrichment_dict[key].append(obj_dict[key]/pre_insert_value)
-                columns.append(file)
-                
+                if file in tables:
+                    file_tables[file] = tables[file]
+                else:
+                    file_tables[file] = pd.read_pickle(os.path.join(self.cache_folder, session_folder, "pkl_files", data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl"))
 
-        df = DataFrame.from_dict(new_enrichment_dict, orient='index', columns = columns)
-        df.index.name = "Peptide"
-        cols = df.columns.tolist()
-        df = df[cols]
-        df['Average_Enrichment'] = df[cols].mean(axis=1)
-        df = df.sort_values("Average_Enrichment", ascending=False)
+        df = self.enrichment_table(pre_insert_table, file_tables)
         df.to_pickle(os.path.join(self.cache_folder, session_folder, "pkl_files", data_directory, f"average_enrichment_{data_directory}.pkl")) 
         return f"average_enrichment_{data_directory}.fastq"
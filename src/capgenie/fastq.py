@@ -0,0 +1,179 @@
+# File that streams sequences out of FASTQ files and collapses duplicate reads
+# into a unique sequence --> multiplicity table, so matching only runs once per
+# distinct read.
+
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+import mmap
+import os
+
+READ_BUFFER = 1 << 20 # 1 MB text buffer for FASTQ reads
+_scans = {} # (path, size, mtime, parts) --> scan, so planning, previews and estimates share one pass
+
+
+"""
+ * iter_reads: str, int, int, str --> generator
+-- Yields the sequence line of every record in a FASTQ file, or of the
+-- records that start inside the byte range [start, end)
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] start (int) - Byte offset of the first record (must be record aligned)
+ * @param [in] end (int) - Records starting at or after this offset are skipped
+ * @param [in] mask (str) - Optional quality mask file, reads failing it are skipped (see quality_mask.py)
+ * @param [out] reads (generator) - Sequence strings without line endings
+** Only the second line of every 4-line record is returned. Reads come from
+** the binary read cache when the file has a current one (see readcache.py)
+"""
+def iter_reads(fastq_file, start=0, end=None, mask=None):
+    if mask is not None:
+        from capgenie import quality_mask
+        qmask = quality_mask.load(mask, fastq_file)
+        yield from qmask.filter(iter_reads(fastq_file, start, end), qmask.first_read(fastq_file, start))
+        return
+
+    from capgenie import readcache # Imports the native cache folder lookup
+    cache = readcache.open_cache(fastq_file)
+    if cache is not None:
+        try:
+            yield from cache.iter_reads(start, end)
+        finally:
+            cache.close()
+        return
+
+    if start == 0 and end is None:
+        with open(fastq_file, "r", buffering=READ_BUFFER) as f:
+            for line in islice(f, 1, None, 4):
+                yield line.rstrip("\r\n")
+        return
+
+    with open(fastq_file, "rb", buffering=READ_BUFFER) as f:
+        f.seek(start)
+        pos = start
+        line_number = 0
+        for line in f:
+            if line_number % 4 == 0 and end is not None and pos >= end:
+                break
+            if line_number % 4 == 1:
+                yield line.decode().rstrip("\r\n")
+            pos += len(line)
+            line_number += 1
+
+"""
+ * record_start: file, int --> int
+-- Finds the offset of the first FASTQ record starting at or after offset
+ * @param [in] f (file) - FASTQ file opened in binary mode
+ * @param [in] offset (int) - Byte offset to search from
+ * @param [out] start (int) - Offset of the next record, or the file size
+** A record is a line starting with '@' whose third line starts with '+',
+** which can't be confused with a quality line that starts with '@'
+"""
+def record_start(f, offset):
+    f.seek(offset)
+    if offset > 0:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            f.readline() # Skip the rest of a partial line
+    while True:
+        pos = f.tell()
+        lines = [f.readline() for _ in range(3)]
+        if not lines[0]:
+            return pos
+        if lines[0].startswith(b"@") and lines[2].startswith(b"+"):
+            return pos
+        f.seek(pos + len(lines[0]))
+
+"""
+ * split_ranges: str, int --> list
+-- Splits a FASTQ file into record-aligned byte ranges of about equal size
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] num_parts (int) - Number of ranges wanted
+ * @param [out] ranges (list) - (start, end) byte ranges covering the file
+"""
+def split_ranges(fastq_file, num_parts):
+    size = os.path.getsize(fastq_file)
+    num_parts = max(1, num_parts)
+    with open(fastq_file, "rb") as f:
+        bounds = sorted(set([0] + [record_start(f, size * i // num_parts) for i in range(1, num_parts)] + [size]))
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+"""
+ * scan: str, int --> dict
+-- Reads a FASTQ file once natively (mani.fastq_scan) for its read count, read
+-- length histogram, mean quality, Phred encoding, compression and
+-- record-aligned split points
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] num_parts (int) - Number of byte ranges to find split points for
+ * @param [out] scan (dict) - See fastq_scan in mani.cpp, plus ranges: the (start, end)
+-- byte ranges between the split points, the same ranges split_ranges returns
+** Scans are kept for as long as the file's size and modification time don't change
+"""
+def scan(fastq_file, num_parts=1):
+    from capgenie import mani # Native scan, loaded on first use like the read cache
+    stat = os.stat(fastq_file)
+    key = (os.path.abspath(fastq_file), stat.st_size, stat.st_mtime_ns, max(1, num_parts))
+    if key not in _scans:
+        result = mani.fastq_scan(fastq_file, max(1, num_parts))
+        points = result["split_points"]
+        result["ranges"] = [(points[i], points[i + 1]) for i in range(len(points) - 1)]
+        _scans[key] = result
+    return _scans[key]
+
+"""
+ * map_range: str, int, int --> memoryview
+-- Context manager that memory maps the byte range [start, end) of a file and
+-- yields it as a read-only memoryview, ready to hand to the native extensions
+-- (filter_count_buffer, denoise_buffer, fuzzy_match_lines) without a copy
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] start (int) - First byte of the range
+ * @param [in] end (int) - End of the range (defaults to the end of the file)
+ * @param [out] view (memoryview) - The mapped bytes, released on exit
+"""
+@contextmanager
+def map_range(fastq_file, start=0, end=None):
+    size = os.path.getsize(fastq_file)
+    end = size if end is None else min(end, size)
+    if end <= start:
+        yield memoryview(b"") # mmap can't map an empty range
+        return
+    offset = start - start % mmap.ALLOCATIONGRANULARITY # mmap offsets must be aligned
+    with open(fastq_file, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), end - offset, offset=offset, access=mmap.ACCESS_READ)
+    base = memoryview(mapped)
+    view = base[start - offset:]
+    try:
+        yield view
+    finally:
+        view.release()
+        base.release()
+        mapped.close()
+
+"""
+ * collapse_reads: iterable, tuple --> Counter
+-- Collapses duplicate reads in one pass into a table of unique
+-- sequence --> number of reads with that sequence
+ * @param [in] reads (iterable) - Read sequences, e.g. from iter_reads
+ * @param [in] region (tuple) - Optional (start, end) slice of each read to keep
+ * @param [out] unique_reads (Counter) - Unique sequence to multiplicity, in first-seen order
+** Selection libraries are highly redundant so this is usually 10-100x smaller
+"""
+def collapse_reads(reads, region=None):
+    if region is not None:
+        start, end = region
+        reads = (read[start:end] for read in reads)
+    return Counter(reads)
+
+"""
+ * collapse_batches: iterable, int --> generator
+-- Collapses reads in batches of batch_size reads, so memory stays bounded
+-- even when almost every read is distinct
+ * @param [in] reads (iterable) - Read sequences, e.g. from iter_reads
+ * @param [in] batch_size (int) - Reads per batch
+ * @param [out] batches (generator) - One Counter per batch
+"""
+def collapse_batches(reads, batch_size):
+    reads = iter(reads)
+    while True:
+        batch = Counter(islice(reads, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -5,7 +5,10 @@
 #include <pybind11/stl.h>
 #include <fstream>
 #include <iostream>
+#include <cstdint>
 #include "platform_compat.h"
+#include "sequence_view.h"
+#include "simd.h"
 
 namespace py = pybind11;
 
@@ -21,8 +24,6 @@ struct FilterResult {
     int null_count = 0;
 };
 
-FilterResult result;
-
 
 /**
  * makeTranslationMap: std::string, std::string --> std::unordered_map<char, char>
@@ -86,13 +87,14 @@ std::unordered_map<char, char> translationMap = makeTranslationMap("ACGT", "TGCA
 
 
 /** 
-process_line: std::string, std::string --> void
+process_line: std::string, std::string, FilterResult& --> void
 -- Processes a line in the file and grabs AAV9 forward and reverse reads
 and saves it to the FilterCount result.
  * @param [in] line (std::string) - The current line from the file
  * @param [in] ref_seq (std::string) - The reference sequence
+ * @param [out] result (FilterResult&) - The result of the call that reads the line
 */
-void process_line(std::string line, std::string ref_seq) {
+void process_line(std::string line, const std::string& ref_seq, FilterResult& result) {
     result.dircheck = "fwd";
     if (line.find("GTGCTTCATTCCAAACCCTC") != std::string::npos) {
         result.reverse_count++;
@@ -173,35 +175,58 @@ void process_line(std::string line, std::string ref_seq) {
 }
 
 /**
-reset_result: FilterResult --> void
--- Resets all result pointers after file 
-has been processed
- * @param [in] result (FilterResult&) - The result struct to reset
+filter_count_data: const char*, size_t, std::string, const uint8_t*, size_t, uint64_t --> FilterResult
+-- Runs process_line over FastQ data that is already in memory
+ * @param [in] data (const char*) - Start of the FastQ records (record aligned)
+ * @param [in] size (size_t) - Number of bytes
+ * @param [in] ref_seq (const std::string&) - The reference sequence
+ * @param [in] mask (const uint8_t*) - Optional quality mask bitmap (see quality_mask.py), null to keep every read
+ * @param [in] mask_size (size_t) - Number of bytes in mask
+ * @param [in] first_read (uint64_t) - Read index of the first record of data in the mask
+ * @param [out] result (FilterResult) - The result struct to populate
+** Shared by the file and buffer entry points, the data is never copied. Every
+** call fills its own result, so calls without the GIL can run concurrently.
+** Reads whose mask bit is clear (or past the end of the mask) are skipped
+** and not counted in total_reads
 */
-void reset_result(FilterResult& result) {
-    result.forward_reads.clear();
-    result.reverse_reads.clear();
-    result.junk_reads.clear();
-    result.null_reads.clear();
-    result.aav9_reads.clear();
-    result.dircheck = "fwd";
-    result.total_reads = 0;
-    result.reverse_count = 0;
-    result.null_count = 0;
-}
+FilterResult filter_count_data(const char* data, size_t size, const std::string& ref_seq,
+                               const uint8_t* mask = nullptr, size_t mask_size = 0, uint64_t first_read = 0) {
+    FilterResult result;
 
+    const char* line_start = data;
+    const char* end_pos = data + size;
 
-/**
-reset_pointers: char*&, char*& --> void
--- Resets all pointers after file has been processed
- * @param [in] mapped_data (char*&) - The mapped data pointer
- * @param [in] line_start (char*&) - The start of the current line
- * @param [in] current_pos (char*&) - The current position in the file
-*/
-void reset_pointers(char*& mapped_data, char*& line_start, char*& current_pos) {
-    mapped_data = nullptr;
-    line_start = nullptr;
-    current_pos = nullptr;
+    int line_number = 0;
+
+    // Whether the read of the current sequence line passes the mask
+    auto passes = [&]() {
+        if (!mask) return true;
+        uint64_t read = first_read + line_number / 4;
+        return (read >> 3) < mask_size && (mask[read >> 3] >> (read & 7) & 1);
+    };
+
+    // Jump from newline to newline (memchr) instead of testing every byte
+    const char* current_pos;
+    while ((current_pos = simd::find_newline(line_start, end_pos)) < end_pos) {
+        if ((line_number + 3) % 4 == 0 && passes()) {
+            result.total_reads++;
+            std::string line(line_start, current_pos - line_start);
+            process_line(line, ref_seq, result);
+        }
+        line_start = current_pos + 1;
+        if ((line_number) % 1000000 == 0) {
+            std::cout << line_number << std::endl;
+        }
+        line_number++;
+    }
+    // Handle the last line if it doesn't end with a newline
+    if (line_start < end_pos && (line_number + 3) % 4 == 0 && passes()) {
+        result.total_reads++;
+        std::string line(line_start, end_pos - line_start);
+        process_line(line, ref_seq, result);
+    }
+
+    return result;
 }
 
 /**
@@ -212,7 +237,7 @@ filter_count: char*, char* --> FilterResult
  * @param [out] result (FilterResult) - The result struct to populate
 */
 FilterResult filter_count(const char* file, char* refseq) {
-    reset_result(result);
+    FilterResult result;
 
     int fd = open(file, O_RDONLY);
     if (fd == -1) {
@@ -227,6 +252,10 @@ FilterResult filter_count(const char* file, char* refseq) {
         return result;
     }
     size_t file_size = file_stat.st_size;
+    if (file_size == 0) {
+        fd_close(fd);
+        return result;
+    }
 
     char* mapped_data = (char*)mmap(nullptr, file_size, PROT_READ, MAP_PRIVATE, fd, 0);
     fd_close(fd); // File descriptor can be closed after mmap
@@ -236,49 +265,47 @@ FilterResult filter_count(const char* file, char* refseq) {
         return result;
     }
 
-    char* current_pos = mapped_data;
-    char* line_start = mapped_data;
-    char* end_pos = mapped_data + file_size;
-
-    int line_number = 0;
-
-    while (current_pos < end_pos) {
-        if (*current_pos == '\n') {
-            if ((line_number + 3) % 4 == 0) {
-                result.total_reads++;
-                std::string line(line_start, current_pos - line_start);
-                process_line(line, refseq);
-            }
-            line_start = current_pos + 1;
-            if ((line_number) % 1000000 == 0) {
-                std::cout << line_number << std::endl;
-            }
-            line_number++;
-        }
-        current_pos++;
-    }
-        // Handle the last line if it doesn't end with a newline
-    if (current_pos == end_pos && *line_start != '\n') {
-        if ((line_number + 3) % 4 == 0) {
-            std::string line(line_start, end_pos - line_start);
-            process_line(line, refseq);
-        }
-        return result;
-    }
+    result = filter_count_data(mapped_data, file_size, std::string(refseq));
 
     if (munmap(mapped_data, file_size) == -1) {
         std::cerr << "Error unmapping file." << std::endl;
-        return result;
     }
 
-    std::cout << result.forward_reads.size() << std::endl;
-    std::cout << result.reverse_reads.size() << std::endl;
-    std::cout << result.junk_reads.size() << std::endl;
-    std::cout << result.aav9_reads.size() << std::endl;
+    return result;
+}
 
-    reset_pointers(mapped_data, line_start, current_pos);
+/**
+filter_count_buffer: py::object, std::string --> FilterResult
+-- Runs process_line over FastQ records held in a Python buffer
+ * @param [in] data (py::object) - bytes, mmap, memoryview or uint8 array of whole FastQ records
+ * @param [in] refseq (const std::string&) - The reference sequence
+ * @param [out] result (FilterResult) - The result struct to populate
+** Lets callers pass a memory mapped slice of a file (e.g. one byte range of
+** a split file) straight through without a copy. Releases the GIL.
+*/
+FilterResult filter_count_buffer(py::object data, const std::string& refseq) {
+    sequence_view buffer(data);
+    py::gil_scoped_release release;
+    return filter_count_data(buffer.data(), buffer.size(), refseq);
+}
 
-    return result;
+/**
+filter_count_buffer: py::object, std::string, py::object, uint64_t --> FilterResult
+-- filter_count_buffer that skips the reads failing a quality mask
+ * @param [in] data (py::object) - bytes, mmap, memoryview or uint8 array of whole FastQ records
+ * @param [in] refseq (const std::string&) - The reference sequence
+ * @param [in] mask (py::object) - Bitmap of a quality mask (quality_mask.bitmap), bit i is set when read i passes
+ * @param [in] first_read (uint64_t) - Read index of the first record of data (quality_mask.first_read)
+ * @param [out] result (FilterResult) - The result struct to populate
+** The mask is applied while scanning, so a denoised file or byte range is
+** counted straight from its mapping. Releases the GIL.
+*/
+FilterResult filter_count_buffer_masked(py::object data, const std::string& refseq, py::object mask, uint64_t first_read) {
+    sequence_view buffer(data);
+    sequence_view bitmap(mask);
+    py::gil_scoped_release release;
+    return filter_count_data(buffer.data(), buffer.size(), refseq,
+                             reinterpret_cast<const uint8_t*>(bitmap.data()), bitmap.size(), first_read);
 }
 
 //implementation of PYBIND_11 module for filter_module
@@ -297,4 +324,8 @@ PYBIND11_MODULE(filter_module, m) {
 
     m.def("filter_count", &filter_count, "Filter reads from file",
           py::arg("file"), py::arg("refseq"));
+    m.def("filter_count_buffer", &filter_count_buffer, "Filter reads from a buffer without copying",
+          py::arg("data"), py::arg("refseq"));
+    m.def("filter_count_buffer", &filter_count_buffer_masked, "Filter the reads of a buffer that pass a quality mask",
+          py::arg("data"), py::arg("refseq"), py::arg("mask"), py::arg("first_read"));
 }
\ No newline at end of file
@@ -5,12 +5,21 @@
 #include <vector>
 #include <string>
 #include <unordered_map>
+#include <map>
 #include <thread>
 #include <mutex>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <edlib.h>
 #include <algorithm>
+#include <cstdint>
+#include <stdexcept>
+#include <string_view>
+#include <memory>
+#include <cstring>
+#include "sequence_view.h"
+#include "simd.h"
+#include "thread_pool.h"
 
 namespace py = pybind11;
 
@@ -73,73 +82,80 @@ int peptide_levenshtein_distance(const std::string& s1, const std::string& s2) {
 }
 
 /**
- * count_hamming_matches: std::string, std::string, int --> int
--- Counts all fuzzy matches (only substitutions) in the dna_seq string
--- and returns the number of matches where it is <= max_mismatches.
- * @param [in] query (std::string) - Query sequence to search for
- * @param [in] dna_seq (std::string) - DNA sequence to search in
+ * count_packed_matches: std::string, uint64_t, const char*, size_t, int --> size_t
+-- Counts the windows of seq within max_mismatches substitutions of query,
+-- comparing 2-bit packed bases with XOR + popcount (see simd.h)
+ * @param [in] query (std::string) - Query sequence (packable, <= 32 ACGT bases)
+ * @param [in] qword (uint64_t) - Packed query from simd::pack_bases
+ * @param [in] seq (const char*) - Start of the first window
+ * @param [in] windows (size_t) - Number of windows, seq holds windows + qlen - 1 bases
  * @param [in] max_mismatches (int) - Maximum number of allowed mismatches
- * @param [out] match_count (int) - Number of matches found
-** This is for only substitutions
+ * @param [out] match_count (size_t) - Number of matching windows
+** Windows with a non ACGT base (e.g. N) are compared byte by byte, so the
+** result is the same as the plain comparison
 */
-int count_hamming_matches(const std::string& query, const std::string& dna_seq, int max_mismatches) {
+size_t count_packed_matches(const std::string& query, uint64_t qword, const char* seq, size_t windows, int max_mismatches) {
+    static thread_local std::vector<uint64_t> words;
+    static thread_local std::vector<uint32_t> invalid;
     const size_t qlen = query.length();
-    const size_t dlen = dna_seq.length();
-    if (qlen > dlen) return 0;
+    const size_t block = 1 << 16; // Bounded scratch space for long sequences
 
-    int match_count = 0;
-    std::mutex mtx;
-    size_t num_threads = std::thread::hardware_concurrency();
-    std::vector<std::thread> threads;
-
-    auto worker = [&](size_t start, size_t end) {
-        int local_count = 0;
-        for (size_t i = start; i < end; ++i) {
-            int mismatches = 0;
-            for (size_t j = 0; j < qlen; ++j) {
-                if (dna_seq[i + j] != query[j]) {
-                    ++mismatches;
-                    if (mismatches > max_mismatches) break;
-                }
-            }
-            if (mismatches <= max_mismatches)
-                ++local_count;
+    size_t match_count = 0;
+    for (size_t start = 0; start < windows; start += block) {
+        size_t n = std::min(block, windows - start);
+        simd::pack_windows(seq + start, n + qlen - 1, qlen, words, invalid);
+        match_count += simd::count_within(words.data(), n, qword, max_mismatches);
+        for (uint32_t idx : invalid) {
+            match_count -= simd::packed_mismatches(words[idx], qword) <= max_mismatches;
+            match_count += simd::window_mismatches_within(seq + start + idx, query.data(), qlen, max_mismatches);
         }
-        std::lock_guard<std::mutex> lock(mtx);
-        match_count += local_count;
-    };
-
-    size_t total = dlen - qlen + 1;
-    size_t chunk = (total + num_threads - 1) / num_threads;
-
-    for (size_t t = 0; t < num_threads; ++t) {
-        size_t start = t * chunk;
-        size_t end = std::min(start + chunk, total);
-        if (start >= end) break;
-        threads.emplace_back(worker, start, end);
     }
+    return match_count;
+}
 
-    for (auto& th : threads) th.join();
+/**
+ * hamming_match_count_range: std::string, std::string_view, int, size_t, size_t --> int
+-- Counts the windows in [start, end) of dna_seq that are within max_mismatches
+-- substitutions of query. Task helper for count_sequence_matches.
+ * @param [in] query (std::string) - Query sequence to search for
+ * @param [in] dna_seq (std::string_view) - DNA sequence to search in
+ * @param [in] max_mismatches (int) - Maximum number of allowed mismatches
+ * @param [in] start (size_t) - First window
+ * @param [in] end (size_t) - One past the last window
+ * @param [out] match_count (int) - Number of matches found in this range
+** Queries of up to 32 ACGT bases use the packed kernels, anything else the
+** plain comparison
+*/
+int hamming_match_count_range(const std::string& query, std::string_view dna_seq, int max_mismatches, size_t start, size_t end) {
+    const size_t qlen = query.length();
+    uint64_t qword = 0;
+    if (simd::pack_bases(query.data(), qlen, qword)) {
+        return static_cast<int>(count_packed_matches(query, qword, dna_seq.data() + start, end - start, max_mismatches));
+    }
+    int match_count = 0;
+    for (size_t i = start; i < end; ++i) {
+        match_count += simd::window_mismatches_within(dna_seq.data() + i, query.data(), qlen, max_mismatches);
+    }
     return match_count;
 }
 
 /**
- * levenshtein_match_count_thread: std::string, std::string, int, size_t, size_t --> int
+ * levenshtein_match_count_thread: std::string, std::string_view, int, size_t, size_t --> int
 -- Returns the total number of levenshtein matches where it has less than
-max_mismatches. Uses EDLIB and is a thread helper for count_levenshtein_matches.
+max_mismatches. Uses EDLIB and is a task helper for count_sequence_matches.
 counts for only a part of the string.
  * @param [in] query (std::string) - Query sequence to search for
- * @param [in] dna (std::string) - DNA sequence to search in
+ * @param [in] dna (std::string_view) - DNA sequence to search in
  * @param [in] max_distance (int) - Maximum allowed edit distance
- * @param [in] start (size_t) - Starting position in the DNA sequence
- * @param [in] end (size_t) - Ending position in the DNA sequence
+ * @param [in] start (size_t) - First window
+ * @param [in] end (size_t) - One past the last window
  * @param [out] count (int) - Number of matches found in this chunk
 ** Forked from EDLIB docs
 */
-int levenshtein_match_count_thread(const std::string& query, const std::string& dna, int max_distance, size_t start, size_t end) {
+int levenshtein_match_count_thread(const std::string& query, std::string_view dna, int max_distance, size_t start, size_t end) {
     int count = 0;
     int qlen = query.size();
-    for (size_t i = start; i <= end - qlen; ++i) {
+    for (size_t i = start; i < end; ++i) {
         const char* window = dna.data() + i;
         EdlibAlignResult result = edlibAlign(
             query.c_str(), qlen,
@@ -155,65 +171,269 @@ int levenshtein_match_count_thread(const std::string& query, const std::string&
     }
     return count;
 }
+
 /**
- * count_levenstein_matches: std::string, std::string, int --> int
--- Parent function for levenshtein_match_count_thread that splits dna_seq into
-chunks and parallel processes levenshtein_match_count_thread.
- * @param [in] query (std::string) - Query sequence to search for
- * @param [in] dna_seq (std::string) - DNA sequence to search in
- * @param [in] max_distance (int) - Maximum allowed edit distance
- * @param [out] total_count (int) - Total number of matches found across all chunks
-** This is for substitutions + indels.
+ * count_sequence_matches: std::vector<std::string>, std::string_view, int, bool --> std::vector<int64_t>
+-- Counts the matching windows of every query in dna_seq on the shared thread pool
+ * @param [in] queries (std::vector<std::string>&) - Query sequences to search for
+ * @param [in] dna_seq (std::string_view) - DNA sequence to search in
+ * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
+ * @param [in] subOnly (bool) - If true, hamming; if false, edlib NW distance
+ * @param [out] counts (std::vector<int64_t>) - Match count of each query, in query order
+** Work is split into (query, window range) tasks: a large library gets about
+** one task per query, a few queries are split into window ranges so every
+** thread has work. No threads are created per query
 */
-int count_levenstein_matches(const std::string& query, const std::string& dna_seq, int max_distance) {
-    int total_count = 0;
-    std::vector<std::thread> threads;
-    int num_threads = 5;
-    std::vector<int> thread_counts(num_threads, 0);
-
-    size_t qlen = query.size();
-    size_t dlen = dna_seq.size();
-    size_t chunk_size = (dlen - qlen + 1) / num_threads;
-
-    for (int t = 0; t < num_threads; ++t) {
-        size_t start = t * chunk_size;
-        size_t end = (t == num_threads - 1) ? (dlen - qlen) : (start + chunk_size - 1);
-
-        threads.emplace_back([&, t, start, end]() {
-            thread_counts[t] = levenshtein_match_count_thread(query, dna_seq, max_distance, start, end);
-        });
-    }
+std::vector<int64_t> count_sequence_matches(const std::vector<std::string>& queries, std::string_view dna_seq, int max_mismatch, bool subOnly) {
+    struct task { size_t query; size_t start; size_t end; };
+    thread_pool& pool = thread_pool::shared();
+    const size_t min_windows = 4096; // Smaller ranges cost more to schedule than to scan
+    const size_t target_tasks = pool.num_threads() * 4;
+    const size_t ranges_per_query = std::max<size_t>(1, (target_tasks + queries.size() - 1) / std::max<size_t>(1, queries.size()));
 
-    for (auto& th : threads) {
-        th.join();
+    std::vector<task> tasks;
+    for (size_t q = 0; q < queries.size(); ++q) {
+        const size_t qlen = queries[q].size();
+        if (qlen == 0 || qlen > dna_seq.size()) continue;
+        const size_t windows = dna_seq.size() - qlen + 1;
+        const size_t ranges = std::max<size_t>(1, std::min(ranges_per_query, windows / min_windows));
+        const size_t chunk = (windows + ranges - 1) / ranges;
+        for (size_t start = 0; start < windows; start += chunk) {
+            tasks.push_back({q, start, std::min(start + chunk, windows)});
+        }
     }
 
-    for (int c : thread_counts) {
-        total_count += c;
-    }
+    std::vector<int64_t> task_counts(tasks.size(), 0);
+    pool.parallel_for(tasks.size(), [&](size_t t) {
+        const task& job = tasks[t];
+        task_counts[t] = subOnly
+            ? hamming_match_count_range(queries[job.query], dna_seq, max_mismatch, job.start, job.end)
+            : levenshtein_match_count_thread(queries[job.query], dna_seq, max_mismatch, job.start, job.end);
+    });
 
-    return total_count;
+    std::vector<int64_t> counts(queries.size(), 0);
+    for (size_t t = 0; t < tasks.size(); ++t) counts[tasks[t].query] += task_counts[t];
+    return counts;
 }
+
+/**
+ * count_hamming_matches: std::string, std::string_view, int --> int
+-- Counts all fuzzy matches (only substitutions) in the dna_seq string
+-- and returns the number of matches where it is <= max_mismatches.
+ * @param [in] query (std::string) - Query sequence to search for
+ * @param [in] dna_seq (std::string_view) - DNA sequence to search in
+ * @param [in] max_mismatches (int) - Maximum number of allowed mismatches
+ * @param [out] match_count (int) - Number of matches found
+** This is for only substitutions
+*/
+int count_hamming_matches(const std::string& query, std::string_view dna_seq, int max_mismatches) {
+    return static_cast<int>(count_sequence_matches({query}, dna_seq, max_mismatches, true)[0]);
+}
+
+/**
+ * count_levenstein_matches: std::string, std::string_view, int --> int
+-- Counts every window of dna_seq within max_distance edits of query
+ * @param [in] query (std::string) - Query sequence to search for
+ * @param [in] dna_seq (std::string_view) - DNA sequence to search in
+ * @param [in] max_distance (int) - Maximum allowed edit distance
+ * @param [out] total_count (int) - Total number of matches found across all chunks
+** This is for substitutions + indels.
+*/
+int count_levenstein_matches(const std::string& query, std::string_view dna_seq, int max_distance) {
+    return static_cast<int>(count_sequence_matches({query}, dna_seq, max_distance, false)[0]);
+}
+
 /**
- * fuzzy_match: std::vector<std::string>, std::string, int, bool --> std::unordered_map<std::string, int>
+ * fuzzy_match: std::vector<std::string>, py::object, int, bool --> std::unordered_map<std::string, int>
 -- Finds all the fuzzy matches of all queries in dna_seq. Has two modes,
 substitutions w/o indels, that are dictated by the boolean subOnly.
  * @param [in] queries (std::vector<std::string>&) - Vector of query sequences to search for
- * @param [in] dna_seq (std::string) - DNA sequence to search in
+ * @param [in] dna_seq (py::object) - DNA sequence to search in (str, bytes, mmap, memoryview, uint8 array)
  * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
  * @param [in] subOnly (bool) - If true, only allow substitutions; if false, allow indels too
  * @param [out] counts (std::unordered_map<std::string, int>) - Map of query sequences to their match counts
-** Function that is exported to PYBIND11
+** Function that is exported to PYBIND11. dna_seq is read in place and
+** the GIL is released while matching
 */
-std::unordered_map<std::string, int> fuzzy_match(std::vector<std::string>& queries, const std::string& dna_seq, int max_mismatch, bool subOnly) {
+std::unordered_map<std::string, int> fuzzy_match(std::vector<std::string>& queries, py::object dna_seq_obj, int max_mismatch, bool subOnly) {
     std::unordered_map<std::string, int> counts;
+    sequence_view dna(dna_seq_obj);
+    std::string_view dna_seq = dna.view;
+    py::gil_scoped_release release;
 
-    for (const auto& query : queries) {
+    std::vector<int64_t> query_counts = count_sequence_matches(queries, dna_seq, max_mismatch, subOnly);
+    for (size_t q = 0; q < queries.size(); ++q) {
+        counts[queries[q]] = static_cast<int>(query_counts[q]);
+    }
+    return counts;
+}
+
+/**
+ * count_window_matches: std::string, const char*, size_t, int, bool --> int
+-- Counts the windows of a single read that match query within max_mismatch.
+-- Same scoring as count_hamming_matches/levenshtein_match_count_thread, but
+-- on one read so matches can't span two reads.
+ * @param [in] query (std::string) - Query sequence to search for
+ * @param [in] read (const char*) - Read sequence to search in
+ * @param [in] rlen (size_t) - Length of the read
+ * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
+ * @param [in] subOnly (bool) - If true, hamming; if false, edlib NW distance
+ * @param [out] match_count (int) - Number of matching windows in the read
+*/
+int count_window_matches(const std::string& query, const char* read, size_t rlen, int max_mismatch, bool subOnly) {
+    const size_t qlen = query.length();
+    if (qlen == 0 || qlen > rlen) return 0;
+
+    int match_count = 0;
+    for (size_t i = 0; i + qlen <= rlen; ++i) {
         if (subOnly) {
-            counts[query] = count_hamming_matches(query, dna_seq, max_mismatch);
+            match_count += simd::window_mismatches_within(read + i, query.data(), qlen, max_mismatch);
         } else {
-            counts[query] = count_levenstein_matches(query, dna_seq, max_mismatch);
+            EdlibAlignResult result = edlibAlign(
+                query.c_str(), qlen,
+                read + i, qlen,
+                edlibNewAlignConfig(max_mismatch, EDLIB_MODE_NW, EDLIB_TASK_DISTANCE, nullptr, 0)
+            );
+            if (result.editDistance != -1 && result.editDistance <= max_mismatch) ++match_count;
+            edlibFreeAlignResult(result);
+        }
+    }
+    return match_count;
+}
+
+/**
+ * match_reads: std::vector<std::string>, std::vector<std::string_view>, const int64_t*, int, bool --> std::unordered_map<std::string, int64_t>
+-- Fuzzy matches every query against a table of unique reads. Each match is
+-- weighted by the number of times the read occurred in the FASTQ file, so
+-- duplicate reads are only scanned once.
+ * @param [in] queries (std::vector<std::string>&) - Query sequences to search for
+ * @param [in] reads (std::vector<std::string_view>&) - Unique read sequences (not copied)
+ * @param [in] weights (const int64_t*) - Multiplicity of each unique read, nullptr for 1
+ * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
+ * @param [in] subOnly (bool) - If true, only allow substitutions; if false, allow indels too
+ * @param [out] counts (std::unordered_map<std::string, int64_t>) - Map of query sequences to weighted match counts
+** Reads are split into tasks on the shared thread pool, each task keeps its
+** own counts. With
+** subOnly, queries of up to 32 ACGT bases are grouped by length: each read's
+** windows are packed once per length and compared against the whole group
+*/
+std::unordered_map<std::string, int64_t> match_reads(const std::vector<std::string>& queries, const std::vector<std::string_view>& reads,
+                                                      const int64_t* weights, int max_mismatch, bool subOnly) {
+    thread_pool& pool = thread_pool::shared();
+    const size_t num_tasks = std::min(reads.size(), pool.num_threads() * 4);
+    std::vector<std::vector<int64_t>> task_counts(num_tasks);
+
+    // Query length --> (query index, packed query), the rest is matched one by one
+    std::map<size_t, std::vector<std::pair<size_t, uint64_t>>> packed_groups;
+    std::vector<size_t> unpacked;
+    for (size_t q = 0; q < queries.size(); ++q) {
+        uint64_t qword = 0;
+        if (subOnly && simd::pack_bases(queries[q].data(), queries[q].size(), qword)) {
+            packed_groups[queries[q].size()].emplace_back(q, qword);
+        } else {
+            unpacked.push_back(q);
+        }
+    }
+
+    const size_t chunk = num_tasks ? (reads.size() + num_tasks - 1) / num_tasks : 0;
+    pool.parallel_for(num_tasks, [&](size_t t) {
+        size_t start = t * chunk;
+        size_t end = std::min(start + chunk, reads.size());
+        std::vector<int64_t>& local = task_counts[t];
+        local.assign(queries.size(), 0);
+        std::vector<uint64_t> words;
+        std::vector<uint32_t> invalid;
+        for (size_t r = start; r < end; ++r) {
+            std::string_view read = reads[r];
+            int64_t weight = weights ? weights[r] : 1;
+            for (const auto& [qlen, group] : packed_groups) {
+                size_t windows = simd::pack_windows(read.data(), read.size(), qlen, words, invalid);
+                if (!windows) continue;
+                for (const auto& [q, qword] : group) {
+                    int64_t hits = simd::count_within(words.data(), windows, qword, max_mismatch);
+                    for (uint32_t idx : invalid) {
+                        hits -= simd::packed_mismatches(words[idx], qword) <= max_mismatch;
+                        hits += simd::window_mismatches_within(read.data() + idx, queries[q].data(), qlen, max_mismatch);
+                    }
+                    if (hits) local[q] += hits * weight;
+                }
+            }
+            for (size_t q : unpacked) {
+                int hits = count_window_matches(queries[q], read.data(), read.size(), max_mismatch, subOnly);
+                if (hits) local[q] += hits * weight;
+            }
+        }
+    });
+
+    std::unordered_map<std::string, int64_t> counts;
+    for (size_t q = 0; q < queries.size(); ++q) {
+        int64_t total = 0;
+        for (const auto& local : task_counts) total += local[q];
+        counts[queries[q]] = total;
+    }
+    return counts;
+}
+
+/**
+ * fuzzy_match_reads: std::vector<std::string>, std::vector<std::string_view>, std::vector<int64_t>, int, bool --> std::unordered_map<std::string, int64_t>
+-- Fuzzy matches queries against a list of unique reads weighted by multiplicity
+ * @param [in] queries (std::vector<std::string>&) - Query sequences to search for
+ * @param [in] reads (std::vector<std::string_view>&) - Unique read sequences, str or bytes
+ * @param [in] weights (std::vector<int64_t>&) - Multiplicity of each unique read
+ * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
+ * @param [in] subOnly (bool) - If true, only allow substitutions; if false, allow indels too
+ * @param [out] counts (std::unordered_map<std::string, int64_t>) - Map of query sequences to weighted match counts
+** The reads are viewed in place in the Python strings, not copied
+*/
+std::unordered_map<std::string, int64_t> fuzzy_match_reads(const std::vector<std::string>& queries, const std::vector<std::string_view>& reads,
+                                                            const std::vector<int64_t>& weights, int max_mismatch, bool subOnly) {
+    if (reads.size() != weights.size()) {
+        throw std::invalid_argument("reads and weights must be the same length");
+    }
+    return match_reads(queries, reads, weights.data(), max_mismatch, subOnly);
+}
+
+/**
+ * fuzzy_match_lines: std::vector<std::string>, py::object, int, bool, py::object --> std::unordered_map<std::string, int64_t>
+-- Fuzzy matches queries against a batch of newline separated reads held in
+-- one buffer, e.g. a memory mapped file slice or a joined read batch
+ * @param [in] queries (std::vector<std::string>&) - Query sequences to search for
+ * @param [in] reads (py::object) - bytes, mmap, memoryview or uint8 array of reads separated by '\n'
+ * @param [in] max_mismatch (int) - Maximum number of allowed mismatches
+ * @param [in] subOnly (bool) - If true, only allow substitutions; if false, allow indels too
+ * @param [in] weights (py::object) - None, or an int64 buffer with one multiplicity per read
+ * @param [out] counts (std::unordered_map<std::string, int64_t>) - Map of query sequences to weighted match counts
+** Neither buffer is copied, and the GIL is released while matching
+*/
+std::unordered_map<std::string, int64_t> fuzzy_match_lines(const std::vector<std::string>& queries, py::object reads_obj,
+                                                            int max_mismatch, bool subOnly, py::object weights_obj) {
+    sequence_view buffer(reads_obj);
+    std::unique_ptr<sequence_view> weight_buffer;
+    if (!weights_obj.is_none()) weight_buffer = std::make_unique<sequence_view>(weights_obj);
+
+    std::unordered_map<std::string, int64_t> counts;
+    {
+        py::gil_scoped_release release;
+        std::vector<std::string_view> reads;
+        const char* pos = buffer.data();
+        const char* end = pos + buffer.size();
+        while (pos < end) {
+            const char* line_end = static_cast<const char*>(memchr(pos, '\n', end - pos));
+            if (!line_end) line_end = end;
+            size_t len = line_end - pos;
+            if (len && pos[len - 1] == '\r') --len;
+            reads.emplace_back(pos, len);
+            pos = line_end + 1;
+        }
+
+        const int64_t* weights = nullptr;
+        if (weight_buffer) {
+            if (weight_buffer->size() != reads.size() * sizeof(int64_t)) {
+                throw std::invalid_argument("weights must hold one int64 per read");
+            }
+            weights = reinterpret_cast<const int64_t*>(weight_buffer->data());
         }
+        counts = match_reads(queries, reads, weights, max_mismatch, subOnly);
     }
     return counts;
 }
@@ -222,6 +442,15 @@ PYBIND11_MODULE(fuzzy_match, m) {
     m.doc() = "FASTQ fuzzy matching using C++";
     m.def("fuzzy_match", &fuzzy_match, "Fuzzy matches with sub/sub+indels",
         py::arg("queries"), py::arg("dna_seq"), py::arg("max_mismatch"), py::arg("subOnly"));
+    m.def("fuzzy_match_reads", &fuzzy_match_reads, "Fuzzy matches unique reads weighted by multiplicity",
+        py::arg("queries"), py::arg("reads"), py::arg("weights"), py::arg("max_mismatch"), py::arg("subOnly"),
+        py::call_guard<py::gil_scoped_release>());
+    m.def("fuzzy_match_lines", &fuzzy_match_lines, "Fuzzy matches newline separated reads in a buffer without copying",
+        py::arg("queries"), py::arg("reads"), py::arg("max_mismatch"), py::arg("subOnly"), py::arg("weights") = py::none());
     m.def("peptide_levenshtein_distance", &peptide_levenshtein_distance, "Native Levenshtein",
     py::arg("s1"), py::arg("s2"));
+    m.def("set_num_threads", [](size_t n) { thread_pool::shared().set_num_threads(n); },
+        "Resizes the shared worker pool", py::arg("num_threads"));
+    m.def("get_num_threads", []() { return thread_pool::shared().num_threads(); }, "Size of the shared worker pool");
+    m.def("simd_level", &simd::level_name, "SIMD level picked for this CPU (avx2, sse4.2 or scalar)");
 }
\ No newline at end of file
@@ -0,0 +1,169 @@
+# File that compiles a capsid CSV into a persistent library index. The index is
+# keyed by the CSV's content hash and kept under the cache folder, so the peptide
+# map and Aho-Corasick automaton are built once and then loaded by every file,
+# run and worker process.
+
+import hashlib
+import json
+import os
+import pickle as pkl
+import shutil
+import tempfile
+import ahocorasick
+import numpy as np
+from capgenie import mani
+from capgenie import cache_manager
+
+INDEX_VERSION = 2 # Bump when the on-disk layout or peptide map logic changes
+
+_loaded = {} # In-process cache of opened indexes, keyed by content hash
+
+
+"""
+ * library_folder: None --> str
+-- Returns the folder compiled library indexes are stored in. It is hidden
+-- so it is never listed as a session.
+ * @param [out] folder (str) - Path to the library index folder
+"""
+def library_folder():
+    return os.path.join(os.path.expanduser(mani.get_cache_folder()), ".libraries")
+
+"""
+ * file_hash: str --> str
+-- Returns the sha256 of a capsid file's contents
+ * @param [in] capsid_file (str) - Path to capsid CSV
+ * @param [out] digest (str) - Hex digest
+"""
+def file_hash(capsid_file):
+    digest = hashlib.sha256()
+    digest.update(f"capgenie-library-v{INDEX_VERSION}".encode())
+    with open(capsid_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class library_index:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        # Memory mapped so worker processes share the pages
+        self.sequences = np.load(os.path.join(index_dir, "sequences.npy"), mmap_mode="r")
+        self.peptides = np.load(os.path.join(index_dir, "peptides.npy"), mmap_mode="r")
+        self._automaton = None
+        self._strand_automaton = None
+        self._peptide_map = None
+
+    # sha256 of the capsid file the index was built from
+    @property
+    def digest(self):
+        return self.meta["sha256"]
+
+    # Oriented sequence --> peptide, same as search_aav9.create_peptide_map
+    @property
+    def peptide_map(self):
+        if self._peptide_map is None:
+            self._peptide_map = {s.decode(): p.decode() for s, p in zip(self.sequences, self.peptides)}
+        return self._peptide_map
+
+    # Aho-Corasick automaton over the oriented sequences (value = sequence)
+    @property
+    def automaton(self):
+        if self._automaton is None:
+            self._automaton = ahocorasick.load(os.path.join(self.index_dir, "automaton.bin"), pkl.loads)
+        return self._automaton
+
+    # Automaton over both strands (value = (sequence, "+"|"-")), see
+    # search_aav9.strand_automaton. Built on first use and saved into the index
+    @property
+    def strand_automaton(self):
+        if self._strand_automaton is None:
+            path = os.path.join(self.index_dir, "strand_automaton.bin")
+            if os.path.exists(path):
+                self._strand_automaton = ahocorasick.load(path, pkl.loads)
+            else:
+                from capgenie.search_aav9 import search_aav9 # Avoids a circular import
+                self._strand_automaton = search_aav9.strand_automaton(self.peptide_map.keys())
+                try:
+                    fd, tmp_file = tempfile.mkstemp(prefix=".strand_", dir=self.index_dir)
+                    os.close(fd)
+                    self._strand_automaton.save(tmp_file, pkl.dumps)
+                    os.replace(tmp_file, path)
+                except OSError:
+                    pass # Read-only index, keep it in memory only
+        return self._strand_automaton
+
+    """
+    compile: cls, str, str --> library_index
+    -- Parses a capsid CSV once and writes the index into folder/<hash>
+    * @param [in] capsid_file (str) - Path to capsid CSV
+    * @param [in] folder (str) - Parent folder for indexes (defaults to library_folder())
+    * @param [out] index (library_index) - The compiled index
+    ** Written to a temporary folder and renamed, so concurrent workers are safe
+    """
+    @classmethod
+    def compile(cls, capsid_file, folder=None):
+        from capgenie.search_aav9 import search_aav9 # Avoids a circular import
+
+        folder = folder if folder else library_folder()
+        os.makedirs(folder, exist_ok=True)
+        digest = file_hash(capsid_file)
+        index_dir = os.path.join(folder, digest[:16])
+
+        peptide_map = search_aav9.create_peptide_map(capsid_file)
+        sequences = list(peptide_map.keys())
+        peptides = list(peptide_map.values())
+
+        tmp_dir = tempfile.mkdtemp(prefix=".build_", dir=folder)
+        try:
+            os.chmod(tmp_dir, 0o755) # mkdtemp is owner-only, indexes are shared
+            np.save(os.path.join(tmp_dir, "sequences.npy"), np.array([s.encode() for s in sequences], dtype=bytes))
+            np.save(os.path.join(tmp_dir, "peptides.npy"), np.array([p.encode() for p in peptides], dtype=bytes))
+
+            automaton = ahocorasick.Automaton()
+            for pattern in sequences:
+                automaton.add_word(pattern, pattern)
+            automaton.make_automaton()
+            automaton.save(os.path.join(tmp_dir, "automaton.bin"), pkl.dumps)
+
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump({
+                    "version": INDEX_VERSION,
+                    "sha256": digest,
+                    "capsid_file": os.path.abspath(capsid_file),
+                    "num_variants": len(sequences),
+                }, f, indent=4)
+
+            try:
+                os.rename(tmp_dir, index_dir)
+            except OSError:
+                # Another process finished the same index first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return cls(index_dir)
+
+    """
+    load: cls, str, str --> library_index
+    -- Returns the index for a capsid file, compiling it on first use
+    * @param [in] capsid_file (str) - Path to capsid CSV
+    * @param [in] folder (str) - Parent folder for indexes (defaults to library_folder())
+    * @param [out] index (library_index) - The loaded index
+    ** Indexes are cached per process, so repeated loads are free
+    """
+    @classmethod
+    def load(cls, capsid_file, folder=None):
+        digest = file_hash(capsid_file)
+        if digest in _loaded:
+            return _loaded[digest]
+        folder = folder if folder else library_folder()
+        index_dir = os.path.join(folder, digest[:16])
+        if os.path.exists(os.path.join(index_dir, "meta.json")):
+            index = cls(index_dir)
+            cache_manager.touch(os.path.join(index_dir, "meta.json"))
+        else:
+            index = cls.compile(capsid_file, folder)
+        _loaded[digest] = index
+        return index
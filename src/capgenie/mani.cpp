@@ -1,4 +1,5 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 #include <filesystem>
 #include <iostream>
 #include <cstdlib>
@@ -6,6 +7,13 @@
 #include <fstream>
 #include <sstream>
 #include <iomanip>
+#include <algorithm>
+#include <cstdint>
+#include <map>
+#include <vector>
+#include "platform_compat.h"
+#include "sequence_view.h"
+#include "simd.h"
 
 namespace py = pybind11;
 namespace fs = std::filesystem;
@@ -102,26 +110,218 @@ std::string fastqFileSize(std::string &filePath) {
     return formatBytes(file.tellg());
 }
 
+/**
+ * FastqScan: struct
+-- Everything fastq_scan learns about a FASTQ file in its one pass
+*/
+struct FastqScan {
+    uint64_t bytes = 0;
+    std::string compression = "none"; // gzip, bzip2, xz, zstd or none
+    uint64_t reads = 0; // Complete 4-line records
+    uint64_t malformed_reads = 0; // Records without '@'/'+' lines or with a quality line of another length
+    std::vector<uint64_t> length_histogram; // Read length --> reads
+    uint64_t bases = 0;
+    uint64_t quality_total = 0; // Sum of the raw quality characters
+    uint64_t quality_chars = 0;
+    int min_quality_char = 256;
+    int max_quality_char = -1;
+    bool complete = true; // Ends with a newline after a whole record
+    std::vector<uint64_t> split_points; // Record-aligned bounds of the byte ranges
+};
+
+/**
+ * compression_of: const unsigned char*, size_t --> std::string
+-- Names the compression of a file from its magic bytes
+ * @param [in] data (const unsigned char*) - Start of the file
+ * @param [in] size (size_t) - Number of bytes
+ * @param [out] compression (std::string) - gzip, bzip2, xz, zstd or none
+*/
+std::string compression_of(const unsigned char* data, size_t size) {
+    if (size >= 2 && data[0] == 0x1f && data[1] == 0x8b) return "gzip";
+    if (size >= 3 && data[0] == 'B' && data[1] == 'Z' && data[2] == 'h') return "bzip2";
+    if (size >= 6 && std::memcmp(data, "\xfd" "7zXZ\x00", 6) == 0) return "xz";
+    if (size >= 4 && data[0] == 0x28 && data[1] == 0xb5 && data[2] == 0x2f && data[3] == 0xfd) return "zstd";
+    return "none";
+}
+
+/**
+ * scan_data: const char*, size_t, size_t --> FastqScan
+-- Walks the records of FASTQ data once
+ * @param [in] data (const char*) - FASTQ data, starting at a record
+ * @param [in] size (size_t) - Number of bytes
+ * @param [in] num_parts (size_t) - Byte ranges to find split points for
+ * @param [out] scan (FastqScan) - Statistics and split points
+** Lines are found with memchr and quality lines summed with the SIMD kernels
+** in simd.h. A split point is the first record starting at or after
+** size * i / num_parts, the same offset fastq.record_start finds by seeking.
+** The quality range is only tracked until a character below ';' proves Phred+33
+*/
+FastqScan scan_data(const char* data, size_t size, size_t num_parts) {
+    FastqScan scan;
+    scan.bytes = size;
+    scan.compression = compression_of(reinterpret_cast<const unsigned char*>(data), size);
+    num_parts = std::max<size_t>(1, num_parts);
+    scan.split_points.push_back(0);
+    if (scan.compression != "none") {
+        scan.complete = false;
+        scan.split_points.push_back(size);
+        return scan;
+    }
+
+    const char* end = data + size;
+    size_t next_part = 1;
+    bool phred33 = false;
+    size_t i = 0;
+
+    // Next line as a view into data without its line ending, empty past the end
+    auto next_line = [&](std::string_view& line) {
+        if (i >= size) {
+            line = std::string_view();
+            return false;
+        }
+        const char* line_end = simd::find_newline(data + i, end);
+        size_t length = line_end - (data + i);
+        if (length && data[i + length - 1] == '\r') --length;
+        line = std::string_view(data + i, length);
+        i = line_end - data + 1;
+        return true;
+    };
+
+    while (i < size) {
+        while (next_part < num_parts && size * next_part / num_parts <= i) {
+            if (scan.split_points.back() != i) scan.split_points.push_back(i);
+            ++next_part;
+        }
+        std::string_view header, seq, plus, quality;
+        next_line(header);
+        next_line(seq);
+        next_line(plus);
+        if (!next_line(quality) || (i > size && quality.size() < seq.size())) {
+            scan.complete = false; // Partial last record, e.g. a file still being written
+            break;
+        }
+
+        if (header.empty() || header[0] != '@' || plus.empty() || plus[0] != '+' || seq.size() != quality.size()) {
+            ++scan.malformed_reads;
+        }
+        if (scan.length_histogram.size() <= seq.size()) scan.length_histogram.resize(seq.size() + 1, 0);
+        ++scan.length_histogram[seq.size()];
+        scan.bases += seq.size();
+        scan.quality_total += simd::quality_sum(quality.data(), quality.size(), 0);
+        scan.quality_chars += quality.size();
+        if (!phred33) {
+            for (unsigned char c : quality) {
+                scan.min_quality_char = std::min<int>(scan.min_quality_char, c);
+                scan.max_quality_char = std::max<int>(scan.max_quality_char, c);
+            }
+            phred33 = scan.min_quality_char < ';';
+        }
+        ++scan.reads;
+    }
+    if (size && data[size - 1] != '\n') scan.complete = false;
+    if (scan.split_points.back() != size) scan.split_points.push_back(size);
+    return scan;
+}
+
+/**
+ * scan_file: std::string, size_t --> FastqScan
+-- Memory maps a FASTQ file and scans it (see scan_data)
+ * @param [in] filePath (const std::string&) - Path to the FASTQ file
+ * @param [in] num_parts (size_t) - Byte ranges to find split points for
+ * @param [out] scan (FastqScan) - Statistics and split points
+** Throws std::runtime_error (RuntimeError in Python) if the file can't be opened or mapped
+*/
+FastqScan scan_file(const std::string& filePath, size_t num_parts) {
+    int fd = open(filePath.c_str(), O_RDONLY);
+    if (fd == -1) {
+        throw std::runtime_error("Failed to open file: " + filePath);
+    }
+    stat_t file_stat;
+    if (fstat(fd, &file_stat) == -1) {
+        fd_close(fd);
+        throw std::runtime_error("Failed to get the size of: " + filePath);
+    }
+    size_t file_size = file_stat.st_size;
+    if (file_size == 0) {
+        fd_close(fd);
+        return scan_data("", 0, num_parts); // mmap can't map an empty file
+    }
+
+    char* mapped_data = (char*)mmap(nullptr, file_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    fd_close(fd); // File descriptor can be closed after mmap
+    if (mapped_data == MAP_FAILED) {
+        throw std::runtime_error("Failed to map file: " + filePath);
+    }
+#ifndef PLATFORM_WINDOWS
+    madvise(mapped_data, file_size, MADV_SEQUENTIAL);
+#endif
+    FastqScan scan = scan_data(mapped_data, file_size, num_parts);
+    munmap(mapped_data, file_size);
+    return scan;
+}
+
+/**
+ * fastqScan: std::string, size_t --> py::dict
+-- Reads a FASTQ file once and returns its read statistics and a chunk plan
+ * @param [in] filePath (const std::string&) - Path to the FASTQ file
+ * @param [in] num_parts (size_t) - Number of record-aligned byte ranges to plan
+ * @param [out] scan (py::dict) - bytes, compression, reads, malformed_reads, complete,
+-- length_histogram (read length --> reads), mean_length, mean_quality (None without reads),
+-- phred_offset (33 or 64), phred_ambiguous and split_points (sorted record starts
+-- from 0 to the file size, at most num_parts + 1)
+** The Phred offset is 33 when a quality character is below ';', 64 when one is
+** above 'J' (the Phred+33 maximum of Illumina 1.8+) and none is below ';', and
+** 33 otherwise, with phred_ambiguous set. Compressed files are only
+** identified, their other statistics stay empty. Releases the GIL
+*/
+py::dict fastqScan(const std::string& filePath, size_t num_parts) {
+    FastqScan scan;
+    {
+        py::gil_scoped_release release;
+        scan = scan_file(filePath, num_parts);
+    }
+
+    bool phred33 = scan.min_quality_char < ';';
+    bool phred64 = !phred33 && scan.max_quality_char > 'J';
+    int offset = phred64 ? 64 : 33;
+
+    std::map<size_t, uint64_t> histogram;
+    for (size_t length = 0; length < scan.length_histogram.size(); ++length) {
+        if (scan.length_histogram[length]) histogram[length] = scan.length_histogram[length];
+    }
+
+    py::dict result;
+    result["bytes"] = scan.bytes;
+    result["compression"] = scan.compression;
+    result["reads"] = scan.reads;
+    result["malformed_reads"] = scan.malformed_reads;
+    result["complete"] = scan.complete;
+    result["length_histogram"] = histogram;
+    result["mean_length"] = scan.reads ? static_cast<double>(scan.bases) / scan.reads : 0.0;
+    result["mean_quality"] = scan.quality_chars ? py::cast(static_cast<double>(scan.quality_total) / scan.quality_chars - offset) : py::none();
+    result["phred_offset"] = offset;
+    result["phred_ambiguous"] = scan.reads > 0 && !phred33 && !phred64;
+    result["split_points"] = scan.split_points;
+    return result;
+}
+
 /**
  * fastqLineCount: std::string --> int
 -- Gets the number of reads a FastQ file
 -- has. (Only gives number of sequence lines)
  * @param [in] filename (const std::string&) - Path to the FASTQ file
  * @param [out] line_count (int) - Number of sequence reads in the file
-** Counts the number of sequences in a FASTQ file
+** Counts the complete records of a memory mapped scan (see fastqScan), -1 if
+** the file can't be opened
 */
-int fastqLineCount(const std::string& filename) {
-    std::ifstream file(filename);
-    if (!file.is_open()) {
-        std::cerr << "Failed to open file: " << filename << std::endl;
+long long fastqLineCount(const std::string& filename) {
+    try {
+        py::gil_scoped_release release;
+        return static_cast<long long>(scan_file(filename, 1).reads);
+    } catch (const std::runtime_error& e) {
+        std::cerr << e.what() << std::endl;
         return -1;
     }
-    int lineCount = 0;
-    std::string line;
-    while (std::getline(file, line)) {
-        ++lineCount;
-    }
-    return lineCount / 4; // For each DNA SEQ
 }
 
 /**
@@ -243,6 +443,50 @@ void pprint_csv(const std::string& filepath) {
     }
 }
 
+/**
+ * unpack_reads: py::object x4, size_t, size_t --> py::list
+-- Decodes reads [first, last) of a binary read cache (see readcache.py)
+ * @param [in] packed (py::object) - 2-bit packed bases, 4 per byte, first base in the high bits
+ * @param [in] base_offsets (py::object) - uint64 offset of every read in the bases (reads + 1 entries)
+ * @param [in] exception_positions (py::object) - Sorted uint64 positions of bases that aren't ACGT
+ * @param [in] exception_bases (py::object) - The characters at those positions
+ * @param [in] first (size_t) - First read
+ * @param [in] last (size_t) - Last read + 1
+ * @param [out] reads (py::list) - Read strings, exactly as in the source FASTQ file
+*/
+py::list unpack_reads(py::object packed, py::object base_offsets, py::object exception_positions, py::object exception_bases, size_t first, size_t last) {
+    static const char BASES[] = "ACGT";
+    sequence_view bases(packed), offset_view(base_offsets), position_view(exception_positions), exception_view(exception_bases);
+    const uint64_t* offsets = reinterpret_cast<const uint64_t*>(offset_view.data());
+    const uint64_t* positions = reinterpret_cast<const uint64_t*>(position_view.data());
+    const unsigned char* data = reinterpret_cast<const unsigned char*>(bases.data());
+    size_t num_exceptions = std::min(position_view.size() / 8, exception_view.size());
+
+    size_t num_offsets = offset_view.size() / 8;
+    if (last < first || last + 1 > num_offsets || (offsets[last] + 3) / 4 > bases.size()) {
+        throw std::out_of_range("Read range outside of the read cache");
+    }
+
+    py::list reads(last - first);
+    if (last == first) return reads;
+    size_t e = std::lower_bound(positions, positions + num_exceptions, offsets[first]) - positions;
+    std::string read;
+    for (size_t i = first; i < last; ++i) {
+        uint64_t start = offsets[i], end = offsets[i + 1];
+        read.resize(end - start);
+        for (uint64_t pos = start; pos < end; ++pos) {
+            read[pos - start] = BASES[(data[pos >> 2] >> (6 - 2 * (pos & 3))) & 3];
+        }
+        for (; e < num_exceptions && positions[e] < end; ++e) {
+            read[positions[e] - start] = exception_view.data()[e];
+        }
+        PyObject* str = PyUnicode_DecodeLatin1(read.data(), static_cast<Py_ssize_t>(read.size()), nullptr);
+        if (!str) throw py::error_already_set();
+        PyList_SET_ITEM(reads.ptr(), static_cast<Py_ssize_t>(i - first), str);
+    }
+    return reads;
+}
+
 PYBIND11_MODULE(mani, m) {
     m.doc() = "CapGenie utility functions for cache and file handling";
 
@@ -250,7 +494,12 @@ PYBIND11_MODULE(mani, m) {
     m.def("clear_cache_folder", &clear_cache_folder, "Deletes contents of the cache folder");
     m.def("fastq_file_size", &fastqFileSize, "Returns the size of a FASTQ file in bytes");
     m.def("fastq_line_count", &fastqLineCount, "Returns the number of sequences in a FASTQ file");
+    m.def("fastq_scan", &fastqScan, "Scans a FASTQ file once for read statistics and record-aligned split points",
+          py::arg("file_path"), py::arg("num_parts") = 1);
     m.def("split_string", &split_string, "Splits a string by a given delimiter");
     m.def("format_element", &format_element, "Formats a string to be centered in a given width");
     m.def("pprint_csv", &pprint_csv, "Pretty prints a peptide CSV file");
+    m.def("unpack_reads", &unpack_reads, "Decodes a range of reads of a binary read cache",
+          py::arg("packed"), py::arg("base_offsets"), py::arg("exception_positions"), py::arg("exception_bases"),
+          py::arg("first"), py::arg("last"));
 }
\ No newline at end of file
@@ -0,0 +1,195 @@
+# File that counts a single large FASTQ file with several worker processes.
+# The coordinator splits the file into record-aligned byte ranges and writes one
+# JSON task per range into a work folder. Workers only need the task file and
+# the shared inputs next to it, and write their partial counts back into the
+# folder, so the same protocol works across nodes on a shared filesystem:
+#
+#   python -m capgenie.mapreduce <work_dir>/tasks/task_0003.json
+#
+# The coordinator then merges the partial count tables in range order.
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import pickle as pkl
+import shutil
+import sys
+from capgenie import fastq
+from capgenie import threads
+
+
+"""
+ * load_shared: str, str --> any
+-- Loads a shared input (automaton, query list, ...) written by the coordinator
+ * @param [in] work_dir (str) - Work folder of the job
+ * @param [in] name (str) - Name of the shared input
+ * @param [out] value (any) - Unpickled value
+"""
+def load_shared(work_dir, name):
+    with open(os.path.join(work_dir, "shared", f"{name}.pkl"), "rb") as f:
+        return pkl.load(f)
+
+"""
+ * count_range: dict --> tuple
+-- Counts the reads of one byte range
+ * @param [in] task (dict) - Task description (see map_reduce)
+ * @param [out] result (tuple) - (partial counts, reads, unique reads)
+** mode "known": Aho-Corasick counts per automaton value (sequence, or
+** (sequence, strand) for a strand automaton)
+** mode "flank": insert counts between two flanks, keyed by (insert, strand)
+** when task["both_strands"] is set (same for "filter")
+** mode "fuzzy": fuzzy_match_reads counts per query
+** mode "libraries": multilib.tagged_matcher counts, keyed by (library, sequence)
+** mode "demux": demux.barcode_sheet counts, keyed by (sample, library, sequence)
+** mode "filter": filter_count forward inserts, the mapped range is passed
+** to the extension as is
+** Reads failing task["mask"] (a quality mask file) are skipped in every mode
+** The native thread pools get task["threads"] threads, so workers x threads
+** stays within the configured budget
+"""
+def count_range(task):
+    from capgenie.search_aav9 import search_aav9 # Heavy import, only in workers
+    from capgenie import fuzzy_match
+    from capgenie import filter_module
+    from capgenie import quality_mask
+    threads.configure(task.get("threads"))
+
+    if task["mode"] == "filter":
+        with fastq.map_range(task["fastq_file"], task["start"], task["end"]) as view:
+            if task.get("mask"): # The scanner skips the failing reads itself
+                mask = quality_mask.load(task["mask"], task["fastq_file"])
+                result = filter_module.filter_count_buffer(view, task["refseq"], mask.bitmap, mask.first_read(task["fastq_file"], task["start"]))
+            else:
+                result = filter_module.filter_count_buffer(view, task["refseq"])
+        if task.get("both_strands"):
+            inserts = Counter((read, "+") for read in result.forward_reads)
+            inserts.update((read, "-") for read in result.reverse_reads)
+            return inserts, result.total_reads, result.total_reads
+        return Counter(result.forward_reads), result.total_reads, result.total_reads
+
+    unique_reads = fastq.collapse_reads(fastq.iter_reads(task["fastq_file"], task["start"], task["end"], task.get("mask")))
+    counts = Counter()
+
+    if task["mode"] == "known":
+        automaton = load_shared(task["work_dir"], "automaton")
+        for read, multiplicity in unique_reads.items():
+            for end_pos, pattern in automaton.iter(read):
+                counts[pattern] += multiplicity
+    elif task["mode"] == "flank":
+        both_strands = task.get("both_strands", False)
+        A = search_aav9.flank_automaton(task["upstream"], task["downstream"], both_strands)
+        inserts = search_aav9.stranded_flank_inserts if both_strands else search_aav9.flank_inserts
+        for dna_seq, multiplicity in unique_reads.items():
+            for read in inserts(A, dna_seq):
+                counts[read] += multiplicity
+    elif task["mode"] == "fuzzy":
+        queries = load_shared(task["work_dir"], "queries")
+        counts.update(fuzzy_match.fuzzy_match_reads(queries, list(unique_reads.keys()), list(unique_reads.values()),
+                                                    task["mismatches"], task["subOnly"]))
+    elif task["mode"] == "libraries":
+        counts = load_shared(task["work_dir"], "matcher").count(unique_reads)
+    elif task["mode"] == "demux":
+        counts = load_shared(task["work_dir"], "sheet").count(load_shared(task["work_dir"], "matcher"), unique_reads)
+    else:
+        raise ValueError(f"Unknown map/reduce mode: {task['mode']}")
+
+    return counts, sum(unique_reads.values()), len(unique_reads)
+
+"""
+ * run_task: str --> str
+-- Worker entry point. Runs a task file and writes its result next to it.
+ * @param [in] task_file (str) - Path to a task JSON file
+ * @param [out] result_file (str) - Path of the written result pickle
+** The result is written to a temporary name and renamed, so a coordinator
+** polling the folder never sees a half written file
+"""
+def run_task(task_file):
+    with open(task_file) as f:
+        task = json.load(f)
+    result = count_range(task)
+    tmp_file = task["output"] + ".tmp"
+    with open(tmp_file, "wb") as f:
+        pkl.dump(result, f)
+    os.replace(tmp_file, task["output"])
+    return task["output"]
+
+"""
+ * write_tasks: str, dict, int, str, dict --> list
+-- Splits the file and writes one task JSON per byte range into work_dir
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] params (dict) - Mode and mode specific parameters
+ * @param [in] num_parts (int) - Number of byte ranges
+ * @param [in] work_dir (str) - Work folder (shared between nodes)
+ * @param [in] shared (dict) - Name --> object written once for all workers
+ * @param [out] task_files (list) - Task file paths, in range order
+"""
+def write_tasks(fastq_file, params, num_parts, work_dir, shared=None):
+    for folder in ["tasks", "results", "shared"]:
+        os.makedirs(os.path.join(work_dir, folder), exist_ok=True)
+    for name, value in (shared or {}).items():
+        with open(os.path.join(work_dir, "shared", f"{name}.pkl"), "wb") as f:
+            pkl.dump(value, f)
+
+    task_files = []
+    for idx, (start, end) in enumerate(fastq.split_ranges(fastq_file, num_parts)):
+        task = {
+            **params,
+            "task_id": idx,
+            "fastq_file": os.path.abspath(fastq_file),
+            "start": start,
+            "end": end,
+            "work_dir": os.path.abspath(work_dir),
+            "output": os.path.abspath(os.path.join(work_dir, "results", f"result_{idx:04d}.pkl")),
+        }
+        task_file = os.path.join(work_dir, "tasks", f"task_{idx:04d}.json")
+        with open(task_file, "w") as f:
+            json.dump(task, f, indent=4)
+        task_files.append(task_file)
+    return task_files
+
+"""
+ * reduce_results: list --> tuple
+-- Merges the partial count tables of every range in range order
+ * @param [in] result_files (list) - Result pickles, in range order
+ * @param [out] merged (tuple) - (counts, reads, unique reads)
+** Merging in range order keeps first-seen order identical to a serial pass
+"""
+def reduce_results(result_files):
+    counts = Counter()
+    num_reads = 0
+    num_unique = 0
+    for result_file in result_files:
+        with open(result_file, "rb") as f:
+            partial, reads, unique = pkl.load(f)
+        counts.update(partial)
+        num_reads += reads
+        num_unique += unique # Reads repeated across ranges are counted once per range
+    return counts, num_reads, num_unique
+
+"""
+ * map_reduce: str, dict, int, str, dict --> tuple
+-- Counts one FASTQ file with a local process pool
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] params (dict) - {"mode": "known"|"flank"|"fuzzy"|"filter"|"libraries"|"demux", ...mode parameters}
+ * @param [in] workers (int) - Number of worker processes
+ * @param [in] work_dir (str) - Work folder, removed afterwards
+ * @param [in] shared (dict) - Shared inputs, e.g. {"automaton": A} or {"queries": [...]}
+ * @param [in] ranges (int) - Number of byte ranges, one per worker by default. More ranges
+-- than workers stream the file through the pool, so a worker only holds one small range
+ * @param [out] merged (tuple) - (counts, reads, unique reads)
+"""
+def map_reduce(fastq_file, params, workers, work_dir, shared=None, ranges=None):
+    params = {"threads": max(1, threads.current() // workers), **params} # Workers share the thread budget
+    try:
+        task_files = write_tasks(fastq_file, params, max(workers, ranges or 0), work_dir, shared)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            result_files = list(pool.map(run_task, task_files))
+        return reduce_results(result_files)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    for task_file in sys.argv[1:]:
+        print(run_task(task_file))
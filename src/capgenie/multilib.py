@@ -0,0 +1,164 @@
+# File that counts several capsid libraries and insert designs in one pass over
+# each FASTQ file. Every library is described by a spec string:
+#
+#   capsids.csv                          known variants, named after the file
+#   AAV9=capsids_aav9.csv                known variants with an explicit name
+#   7mer=flanks:AGAGTGCCCAA:GCACAGGCG    unknown inserts between two flanks (12-25 nt)
+#   9mer=flanks:AGAGTGCCCAA:GCACAGGCG:27-27
+#
+# The specs are compiled into one tagged_matcher: a single Aho-Corasick
+# automaton holds the sequences of every capsid library and the flanks of every
+# insert design, each word tagged with the libraries it belongs to. Fuzzy
+# (mismatch) queries of all capsid libraries go through one fuzzy_match_reads
+# call. Counts come back keyed by (library name, sequence) and are split into
+# one count table per library.
+
+import os
+from collections import Counter
+import ahocorasick
+from capgenie.library import library_index
+from capgenie import fuzzy_match
+
+SEQUENCE_TAG = 0 # Library sequence, flanks use 1 (upstream) and 2 (downstream)
+
+
+class library_spec:
+    def __init__(self, name, kind, capsid_file=None, upstream=None, downstream=None, min_length=12, max_length=25):
+        self.name = name
+        self.kind = kind # "capsid" or "flanks"
+        self.capsid_file = capsid_file
+        self.upstream = upstream
+        self.downstream = downstream
+        self.min_length = min_length
+        self.max_length = max_length
+        self.peptide_map = None # Filled by tagged_matcher for capsid libraries
+
+    # Instructions key and pkl prefix, the same as the single library pipeline
+    @property
+    def instructions_link(self):
+        return "count_known_reads" if self.kind == "capsid" else "unknown_reads"
+
+    @property
+    def file_prefix(self):
+        return "variants_" if self.kind == "capsid" else "unknown_variants_"
+
+    """
+    parse: cls, str --> library_spec
+    -- Parses a library spec string (see the top of this file)
+    * @param [in] spec (str) - "[name=]capsids.csv" or "name=flanks:UP:DOWN[:MIN-MAX]"
+    * @param [out] library (library_spec) - Parsed spec
+    """
+    @classmethod
+    def parse(cls, spec):
+        name, _, definition = spec.rpartition("=")
+        if definition.startswith("flanks:"):
+            parts = definition.split(":")[1:]
+            if len(parts) not in (2, 3) or not all(parts) or not name:
+                raise ValueError(f"Invalid flank library '{spec}', expected name=flanks:UPSTREAM:DOWNSTREAM[:MIN-MAX]")
+            min_length, max_length = 12, 25
+            if len(parts) == 3:
+                try:
+                    min_length, max_length = (int(x) for x in parts[2].split("-"))
+                except ValueError:
+                    raise ValueError(f"Invalid insert length range '{parts[2]}' in '{spec}', expected MIN-MAX")
+            return cls(name, "flanks", upstream=parts[0].upper(), downstream=parts[1].upper(), min_length=min_length, max_length=max_length)
+
+        if not os.path.exists(definition):
+            raise ValueError(f"Capsid file '{definition}' of library '{spec}' does not exist")
+        name = name if name else os.path.splitext(os.path.basename(definition))[0]
+        return cls(name, "capsid", capsid_file=definition)
+
+
+"""
+ * parse_libraries: list --> list
+-- Parses library specs and checks the names are unique
+ * @param [in] specs (list) - Spec strings or library_spec objects
+ * @param [out] libraries (list) - library_spec objects, in the given order
+"""
+def parse_libraries(specs):
+    libraries = [spec if isinstance(spec, library_spec) else library_spec.parse(spec) for spec in specs]
+    names = [library.name for library in libraries]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Library names must be unique: {', '.join(duplicates)}")
+    return libraries
+
+"""
+ * library_directory: str, str --> str
+-- Folder name the tables of one library are stored under, next to the other
+-- data directories (pkl_files/<data directory>_<library>), so averaging,
+-- enrichment and charts work per library unchanged
+ * @param [in] data_directory (str) - Data directory name
+ * @param [in] name (str) - Library name, "" for the single unnamed library of a
+-- -cf/-unk run that is demultiplexed (see demux.py)
+ * @param [out] folder (str) - Library data directory name
+"""
+def library_directory(data_directory, name):
+    return f"{data_directory}_{name}" if name else data_directory
+
+
+class tagged_matcher:
+    """
+    __init__: list, int, bool --> tagged_matcher
+    -- Compiles every library into one tagged automaton (and one fuzzy query list)
+    * @param [in] libraries (list) - library_spec objects (or spec strings)
+    * @param [in] mismatches (int) - Allowed mismatches for capsid libraries, 0 = exact
+    * @param [in] subOnly (bool) - Substitutions only, False allows indels too
+    """
+    def __init__(self, libraries, mismatches=0, subOnly=True):
+        self.libraries = parse_libraries(libraries)
+        self.mismatches = int(mismatches)
+        self.subOnly = subOnly
+        self.queries = {} # Fuzzy query --> names of the libraries it belongs to
+
+        words = {} # Word --> [(library name, tag)]
+        for library in self.libraries:
+            if library.kind == "capsid":
+                library.peptide_map = library_index.load(library.capsid_file).peptide_map
+                for seq in library.peptide_map:
+                    if self.mismatches:
+                        self.queries.setdefault(seq, []).append(library.name)
+                    else:
+                        words.setdefault(seq, []).append((library.name, SEQUENCE_TAG))
+            else:
+                words.setdefault(library.upstream, []).append((library.name, 1))
+                words.setdefault(library.downstream, []).append((library.name, 2))
+
+        self.automaton = ahocorasick.Automaton()
+        for word, tags in words.items():
+            self.automaton.add_word(word, (word, len(word), tags))
+        self.automaton.make_automaton()
+
+    """
+    count: dict --> Counter
+    -- Counts every library in a table of unique reads
+    * @param [in] unique_reads (dict) - Read sequence --> multiplicity
+    * @param [out] counts (Counter) - (library name, sequence or insert) --> count
+    """
+    def count(self, unique_reads):
+        from capgenie.search_aav9 import search_aav9 # Avoids a circular import
+
+        flank_libraries = {library.name: library for library in self.libraries if library.kind == "flanks"}
+        counts = Counter()
+
+        for read, multiplicity in unique_reads.items():
+            positions = {}
+            for end, (word, length, tags) in self.automaton.iter(read):
+                for name, tag in tags:
+                    if tag == SEQUENCE_TAG:
+                        counts[(name, word)] += multiplicity
+                    else:
+                        positions.setdefault(name, ([], []))[tag - 1].append((end - length + 1, end))
+            for name, (f1_pos, f2_pos) in positions.items():
+                library = flank_libraries[name]
+                for read_start, read_end in search_aav9.pair_flanks(f1_pos, f2_pos, library.min_length, library.max_length):
+                    counts[(name, read[read_start:read_end])] += multiplicity
+
+        if self.queries and unique_reads:
+            hits = fuzzy_match.fuzzy_match_reads(list(self.queries), list(unique_reads.keys()), list(unique_reads.values()),
+                                                 self.mismatches, self.subOnly)
+            for seq, count in hits.items():
+                if count:
+                    for name in self.queries[seq]:
+                        counts[(name, seq)] += count
+        return counts
@@ -0,0 +1,307 @@
+# File that keeps a persistent SQLite index of every peptide of every session
+# in the cache folder, so "how did peptide X do across all our selections?" is
+# one indexed query instead of unpickling every average and enrichment table.
+#
+# For every session the index holds one sample per counted file (count,
+# Decimal and the file's enrichment) and one per data directory (Average
+# Decimal and Average_Enrichment, file NULL). Counts come from the session's
+# count matrix (see count_matrix.py), averages and enrichments from the
+# average_<dir>.pkl and average_enrichment_<dir>.pkl tables. Sessions saved
+# before the count matrix existed only get the Decimals of their average tables.
+#
+# The index is updated incrementally: a session is (re)indexed when the
+# modification times or sizes of its tables changed since it was indexed, in
+# one transaction, and sessions that were deleted are dropped. Peptides are
+# stored once with a unique index, so exact and prefix lookups are B-tree range
+# scans that take milliseconds whatever the number of sessions.
+
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from capgenie import mani
+from capgenie.count_matrix import count_matrix
+
+INDEX_VERSION = 1 # PRAGMA user_version, an index of another version is rebuilt
+INDEX_FOLDER = ".index" # Hidden folder of the cache folder, kept by cache_manager.py
+INDEX_FILE = "peptides.sqlite"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, signature TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS peptides (id INTEGER PRIMARY KEY, peptide TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, session INTEGER NOT NULL, directory TEXT NOT NULL,
+                                    file TEXT, kind TEXT, total INTEGER);
+CREATE TABLE IF NOT EXISTS hits (peptide INTEGER NOT NULL, sample INTEGER NOT NULL, count INTEGER, decimal REAL,
+                                 enrichment REAL, PRIMARY KEY (peptide, sample)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samples_session ON samples (session);
+CREATE INDEX IF NOT EXISTS hits_sample ON hits (sample);
+"""
+LOOKUP_COLUMNS = ["Peptide", "Session", "Directory", "File", "Kind", "Count", "Decimal", "Enrichment"]
+
+
+"""
+ * _value: float --> float
+-- A table value as stored in the index, None for NaN
+"""
+def _value(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+"""
+ * _read_table: str --> DataFrame
+-- An average or enrichment table, None if the session doesn't have it
+"""
+def _read_table(path):
+    return pd.read_pickle(path) if os.path.exists(path) else None
+
+
+class peptide_index:
+    def __init__(self, path=None, cache_folder=None):
+        self.cache_folder = cache_folder if cache_folder else os.path.expanduser(mani.get_cache_folder())
+        self.path = path if path else os.path.join(self.cache_folder, INDEX_FOLDER, INDEX_FILE)
+        self._connection = None
+
+    """
+    exists: str --> bool
+    -- Whether the index of a cache folder has been built, so runs only keep an
+    -- index up to date that someone looks peptides up in
+    """
+    @staticmethod
+    def exists(cache_folder=None):
+        cache_folder = cache_folder if cache_folder else os.path.expanduser(mani.get_cache_folder())
+        return os.path.exists(os.path.join(cache_folder, INDEX_FOLDER, INDEX_FILE))
+
+    # SQLite connection, opened (and the schema created or rebuilt) on first use
+    @property
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Autocommit, transactions are explicit. The timeout waits out another run's update
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL") # Lookups don't wait for an update
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            if self._connection.execute("PRAGMA user_version").fetchone()[0] not in (0, INDEX_VERSION):
+                for table in ("hits", "samples", "peptides", "sessions"):
+                    self._connection.execute(f"DROP TABLE IF EXISTS {table}")
+            self._connection.executescript(SCHEMA)
+            self._connection.execute(f"PRAGMA user_version={INDEX_VERSION}")
+        return self._connection
+
+    """
+    close: None --> None
+    -- Closes the connection
+    """
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    """
+    sessions: None --> dict
+    -- Sessions of the cache folder
+    * @param [out] sessions (dict) - Session name --> session folder, for folders with pkl files
+    """
+    def sessions(self):
+        found = {}
+        for entry in sorted(os.scandir(self.cache_folder), key=lambda entry: entry.name) if os.path.isdir(self.cache_folder) else []:
+            if not entry.name.startswith(".") and entry.is_dir() and os.path.isdir(os.path.join(entry.path, "pkl_files")):
+                found[entry.name] = entry.path
+        return found
+
+    """
+    signature: str --> str
+    -- Fingerprint of the tables of a session the index reads
+    * @param [in] session_dir (str) - Session folder
+    * @param [out] signature (str) - Changes whenever the count matrix or an average or
+    -- enrichment table is written, added or removed
+    ** Only stats files, so checking hundreds of sessions is cheap
+    """
+    def signature(self, session_dir):
+        pkl_folder = os.path.join(session_dir, "pkl_files")
+        parts = []
+        for entry in sorted(os.scandir(pkl_folder), key=lambda entry: entry.name):
+            paths = [entry.path] if entry.name == "count_matrix.pkl" else []
+            if entry.is_dir():
+                paths = [os.path.join(entry.path, f"{prefix}_{entry.name}.pkl") for prefix in ("average", "average_enrichment")]
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                parts.append(f"{os.path.relpath(path, pkl_folder)}:{stat.st_mtime_ns}:{stat.st_size}")
+        return "|".join(parts)
+
+    """
+    session_samples: str --> list
+    -- Reads the samples of a session from its tables
+    * @param [in] session_dir (str) - Session folder
+    * @param [out] samples (list) - (directory, file or None for the directory's average, kind, total,
+    -- {peptide: (count, decimal, enrichment)})
+    """
+    def session_samples(self, session_dir):
+        pkl_folder = os.path.join(session_dir, "pkl_files")
+        matrix_path = os.path.join(pkl_folder, "count_matrix.pkl")
+        matrix = count_matrix.load(matrix_path) if os.path.exists(matrix_path) else None
+        directories = sorted(entry.name for entry in os.scandir(pkl_folder) if entry.is_dir())
+        if matrix is not None:
+            directories = sorted(set(directories) | {metadata["directory"] for metadata in matrix.samples})
+
+        samples = []
+        for directory in directories:
+            average = _read_table(os.path.join(pkl_folder, directory, f"average_{directory}.pkl"))
+            enrichment = _read_table(os.path.join(pkl_folder, directory, f"average_enrichment_{directory}.pkl"))
+            enrichments = {}
+            if enrichment is not None:
+                enrichments = {column: enrichment[column].to_dict() for column in enrichment.columns}
+
+            files = []
+            if matrix is not None:
+                for row in matrix.rows(directory):
+                    metadata = matrix.samples[row]
+                    table = matrix.table(directory, metadata["file"])
+                    file_enrichment = enrichments.get(metadata["file"], {})
+                    hits = {peptide: (count, decimal, _value(file_enrichment.get(peptide)))
+                            for peptide, count, decimal in zip(table.Peptide.tolist(), table.Count.tolist(), table.Decimal.tolist())}
+                    files.append((directory, metadata["file"], metadata["kind"], metadata["total"], hits))
+            elif average is not None: # Older session: the Decimals of its average table
+                for column in average.columns:
+                    if column == "Average Decimal":
+                        continue
+                    file_enrichment = enrichments.get(column, {})
+                    hits = {peptide: (None, _value(decimal), _value(file_enrichment.get(peptide)))
+                            for peptide, decimal in average[column].items() if not np.isnan(decimal)}
+                    files.append((directory, column, None, None, hits))
+            samples.extend(files)
+
+            if average is not None or enrichment is not None:
+                decimals = average["Average Decimal"].to_dict() if average is not None and "Average Decimal" in average else {}
+                average_enrichment = enrichments.get("Average_Enrichment", {})
+                hits = {peptide: (None, _value(decimals.get(peptide)), _value(average_enrichment.get(peptide)))
+                        for peptide in set(decimals) | set(average_enrichment)}
+                kind = files[0][2] if files else None
+                samples.append((directory, None, kind, None, hits))
+        return samples
+
+    """
+    _peptide_ids: set --> dict
+    -- Ids of peptides, adding the new ones
+    """
+    def _peptide_ids(self, peptides):
+        connection = self.connection
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS new_peptides (peptide TEXT PRIMARY KEY)")
+        connection.execute("DELETE FROM temp.new_peptides")
+        connection.executemany("INSERT OR IGNORE INTO temp.new_peptides VALUES (?)", ((peptide,) for peptide in peptides))
+        connection.execute("INSERT OR IGNORE INTO peptides (peptide) SELECT peptide FROM temp.new_peptides")
+        ids = dict(connection.execute("SELECT p.peptide, p.id FROM peptides p JOIN temp.new_peptides n ON p.peptide = n.peptide"))
+        connection.execute("DELETE FROM temp.new_peptides")
+        return ids
+
+    """
+    _drop_session: int --> None
+    -- Deletes the samples and hits of a session (inside the caller's transaction)
+    """
+    def _drop_session(self, session_id):
+        self.connection.execute("DELETE FROM hits WHERE sample IN (SELECT id FROM samples WHERE session = ?)", (session_id,))
+        self.connection.execute("DELETE FROM samples WHERE session = ?", (session_id,))
+        self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    """
+    index_session: str, str, str --> int
+    -- (Re)indexes one session in a single transaction
+    * @param [in] name (str) - Session name
+    * @param [in] session_dir (str) - Session folder
+    * @param [in] signature (str) - Its signature, computed when None
+    * @param [out] hits (int) - Number of (peptide, sample) rows indexed
+    """
+    def index_session(self, name, session_dir, signature=None):
+        signature = self.signature(session_dir) if signature is None else signature
+        samples = self.session_samples(session_dir) # Read before locking the index
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            existing = connection.execute("SELECT id FROM sessions WHERE name = ?", (name,)).fetchone()
+            if existing:
+                self._drop_session(existing[0])
+            session_id = connection.execute("INSERT INTO sessions (name, signature) VALUES (?, ?)", (name, signature)).lastrowid
+            ids = self._peptide_ids({peptide for sample in samples for peptide in sample[4]})
+            total_hits = 0
+            for directory, file, kind, total, hits in samples:
+                sample_id = connection.execute("INSERT INTO samples (session, directory, file, kind, total) VALUES (?, ?, ?, ?, ?)",
+                                               (session_id, directory, file, kind, total)).lastrowid
+                # In key order, so the rows are appended along the B-tree instead of scattered over it
+                connection.executemany("INSERT INTO hits VALUES (?, ?, ?, ?, ?)",
+                                       sorted((ids[peptide], sample_id, count, decimal, enrichment)
+                                              for peptide, (count, decimal, enrichment) in hits.items()))
+                total_hits += len(hits)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return total_hits
+
+    """
+    update: list --> dict
+    -- Brings the index up to date with the cache folder
+    * @param [in] names (list) - Sessions to check, None for every session (sessions that
+    -- no longer exist are then dropped as well)
+    * @param [out] report (dict) - indexed, unchanged and removed (session names), hits (rows indexed)
+    """
+    def update(self, names=None):
+        sessions = self.sessions()
+        if names is not None:
+            sessions = {name: path for name, path in sessions.items() if name in names}
+        connection = self.connection
+        indexed = dict(connection.execute("SELECT name, signature FROM sessions"))
+        report = {"indexed": [], "unchanged": [], "removed": [], "hits": 0}
+
+        for name, session_dir in sessions.items():
+            signature = self.signature(session_dir)
+            if indexed.get(name) == signature:
+                report["unchanged"].append(name)
+                continue
+            report["hits"] += self.index_session(name, session_dir, signature)
+            report["indexed"].append(name)
+
+        gone = [name for name in indexed if name not in sessions and (names is None or name in names)]
+        if gone:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for name in gone:
+                    self._drop_session(connection.execute("SELECT id FROM sessions WHERE name = ?", (name,)).fetchone()[0])
+                connection.execute("DELETE FROM peptides WHERE NOT EXISTS (SELECT 1 FROM hits WHERE hits.peptide = peptides.id)")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            report["removed"] = gone
+        return report
+
+    """
+    lookup: str, bool, list, int --> DataFrame
+    -- Every sample of every indexed session that lists a peptide
+    * @param [in] peptide (str) - Peptide, or prefix with prefix=True
+    * @param [in] prefix (bool) - Match every peptide starting with peptide
+    * @param [in] sessions (list) - Session names to restrict the lookup to, None for all
+    * @param [in] limit (int) - Most peptides to return with prefix=True, None for all
+    * @param [out] table (DataFrame) - LOOKUP_COLUMNS, File is None for a directory's
+    -- average (Average Decimal, Average_Enrichment), sorted by peptide, session, directory
+    ** Doesn't update the index, see update
+    """
+    def lookup(self, peptide, prefix=False, sessions=None, limit=None):
+        if prefix and peptide:
+            # Range on the unique peptide index (LIKE wouldn't use it case-sensitively)
+            condition, parameters = "p.peptide >= ? AND p.peptide < ?", [peptide, peptide[:-1] + chr(ord(peptide[-1]) + 1)]
+        elif prefix:
+            condition, parameters = "1", []
+        else:
+            condition, parameters = "p.peptide = ?", [peptide]
+        peptides = f"SELECT id, peptide FROM peptides p WHERE {condition} ORDER BY p.peptide"
+        if limit is not None:
+            peptides += f" LIMIT {int(limit)}"
+        query = (f"SELECT p.peptide, se.name, s.directory, s.file, s.kind, h.count, h.decimal, h.enrichment "
+                 f"FROM ({peptides}) p JOIN hits h ON h.peptide = p.id JOIN samples s ON s.id = h.sample "
+                 f"JOIN sessions se ON se.id = s.session")
+        if sessions is not None:
+            query += f" WHERE se.name IN ({', '.join('?' * len(sessions))})"
+            parameters += list(sessions)
+        query += " ORDER BY p.peptide, se.name, s.directory, s.file IS NULL, s.file"
+        return DataFrame(self.connection.execute(query, parameters).fetchall(), columns=LOOKUP_COLUMNS)
@@ -0,0 +1,242 @@
+# File that plans how every FASTQ file is counted under a memory budget
+# (-ml/--memory_limit), instead of finding out by running out of memory. The
+# footprint of an engine is estimated from the file's scan (size, reads and read
+# length, see fastq.scan), the library size and an even sample of the file's
+# reads (see preview.py):
+#
+#   - collapsing keeps one Counter entry per distinct read (known, fuzzy,
+#     flank, library and demultiplexing engines), projected from the sample's
+#     read multiplicities (preview.projected_unique)
+#   - filter_count (-rf) keeps every read's insert in native and Python vectors
+#   - the merged result holds one entry per variant: the library for capsid
+#     engines, up to one per distinct read for inserts
+#
+# and one of three paths is picked per file:
+#
+#   in_memory   - the whole file at once, in this process or one byte range per -j worker
+#   streaming   - more byte ranges than workers (mapreduce.map_reduce(..., ranges)), so a
+#                 worker only holds one small range; workers are dropped before ranges grow
+#   out_of_core - flank counting spills inserts to disk shards (shards.py) under a budget,
+#                 for when even the merged inserts don't fit
+#
+# Estimates are deliberately on the high side, so the measured peak (reported
+# next to the plan) should come in under them.
+
+import sys
+from capgenie import fastq
+from capgenie import preview
+from capgenie import telemetry as telemetry_module
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+MB = 1024 * 1024
+SAMPLE_READS = 20000 # Reads sampled per file to project its distinct reads
+UNIQUE_READ_BYTES = 100 # Counter entry and string header of a collapsed read, plus its length
+VARIANT_BYTES = 150 # Counter entry of a merged variant or insert, including the string
+FILTER_READ_BYTES = 120 # filter_count: native and Python copies of one read's insert
+LIBRARY_BASE_BYTES = 100 # Aho-Corasick automaton and fuzzy queries per library base
+WORKER_BYTES = 80 * MB # Interpreter and imports of a map/reduce worker process
+MAX_RANGES = 1024 # Most byte ranges a file is split into
+OUT_OF_CORE_SHARE = 0.6 # Share of the free budget given to the shard counter (the rest holds its read batches)
+MOTIF_BYTES_PER_CELL = 24 # One-hot float64 matrix plus the float32 copies UMAP makes, per cell
+
+
+"""
+ * current_rss: None --> int
+-- Resident set size of this process right now, in bytes
+** Falls back to the peak (telemetry.peak_rss) where /proc isn't available
+"""
+def current_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return telemetry_module.peak_rss() or 0
+
+"""
+ * worker_peak_rss: None --> int
+-- Largest peak RSS of any finished worker process so far, in bytes (0 if unknown)
+"""
+def worker_peak_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class memory_planner:
+    """
+    __init__: float, str, int, int, int, bool, float --> memory_planner
+    -- Planner for one run
+    * @param [in] limit_mb (float) - Memory budget of the run in MB
+    * @param [in] engine (str) - "known", "fuzzy", "flank", "filter", "libraries" or "demux"
+    * @param [in] library_sequences (int) - Sequences of the capsid libraries (0 for unknown variants)
+    * @param [in] library_bases (int) - Total bases of those sequences
+    * @param [in] max_workers (int) - Most worker processes per file (-j)
+    * @param [in] inserts (bool) - Whether the engine counts inserts (flank, filter or a flank library),
+    -- so the merged result grows with the distinct reads instead of the library
+    * @param [in] out_of_core_mb (float) - Out-of-core budget given with -ooc, None to let the planner choose
+    """
+    def __init__(self, limit_mb, engine, library_sequences=0, library_bases=0, max_workers=1, inserts=False, out_of_core_mb=None):
+        self.limit = int(float(limit_mb) * MB)
+        self.engine = engine
+        self.library_sequences = int(library_sequences)
+        self.library_bytes = int(library_bases) * LIBRARY_BASE_BYTES
+        self.max_workers = max(1, int(max_workers))
+        self.inserts = inserts or engine in ("flank", "filter")
+        self.out_of_core = int(float(out_of_core_mb) * MB) if out_of_core_mb else None
+        self.plans = {} # FASTQ path --> plan
+
+    """
+    profile: str --> dict
+    -- Scans a FASTQ file and projects what its counting footprint depends on
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [out] profile (dict) - size, reads, read_length (mean) of the file (fastq.scan),
+    -- and project(fraction), the projected distinct reads of a share of the file
+    ** Only the distinct reads are projected from an even sample
+    """
+    def profile(self, fastq_file):
+        file_scan = fastq.scan(fastq_file)
+        reads = [record.split(b"\n", 2)[1].rstrip(b"\r") for record in preview.sample_records(fastq_file, SAMPLE_READS)]
+        unique_reads = fastq.collapse_reads(reads)
+        scale = file_scan["reads"] / len(reads) if reads else 1.0
+        return {"size": file_scan["bytes"], "reads": file_scan["reads"], "read_length": file_scan["mean_length"],
+                "project": lambda fraction: preview.projected_unique(unique_reads, scale * fraction) if unique_reads else 0.0}
+
+    """
+    working_set: dict, float --> int
+    -- Bytes an engine holds while counting a share of the file
+    * @param [in] profile (dict) - From profile()
+    * @param [in] fraction (float) - Share of the file (one byte range)
+    * @param [out] size (int) - Bytes
+    ** Quality masks add nothing, the engines skip failing reads while scanning
+    """
+    def working_set(self, profile, fraction):
+        unique = profile["project"](fraction)
+        if self.engine == "filter":
+            return int(profile["reads"] * fraction * FILTER_READ_BYTES + unique * VARIANT_BYTES)
+        size = unique * (UNIQUE_READ_BYTES + profile["read_length"])
+        if self.engine == "fuzzy":
+            size *= 1.5 # Key and value lists handed to the native matcher, plus its own copies
+        if self.inserts:
+            size += unique * VARIANT_BYTES
+        return int(size)
+
+    """
+    merged: dict --> int
+    -- Bytes of the merged result of a file
+    """
+    def merged(self, profile):
+        if self.inserts:
+            return int(profile["project"](1.0) * VARIANT_BYTES)
+        return self.library_sequences * VARIANT_BYTES
+
+    """
+    plan_file: str --> dict
+    -- Picks the path, worker count and byte ranges of one file under the budget
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [out] plan (dict) - file, path (in_memory, streaming or out_of_core), workers, ranges,
+    -- out_of_core_budget (bytes or None), estimated_rss (bytes, the run), estimated_worker_rss (bytes
+    -- of one worker process, beyond the pages it shares with this one), budget (bytes) and over_budget
+    ** The budget left for counting is the limit minus what the process holds already
+    ** (imports, library). Paths are tried from the fastest: the whole file in memory,
+    ** then streaming with as many workers as fit, then out of core (flank only).
+    ** When nothing fits, the smallest plan is kept and flagged over_budget
+    """
+    def plan_file(self, fastq_file):
+        profile = self.profile(fastq_file)
+        baseline = current_rss()
+        available = self.limit - baseline
+        merged = self.merged(profile)
+        plan = {"file": fastq_file, "engine": self.engine, "budget": self.limit, "baseline_rss": baseline,
+                "reads": profile["reads"], "unique_reads": int(profile["project"](1.0)), "out_of_core_budget": self.out_of_core}
+
+        candidates = [] # (path, workers, ranges, estimated bytes over the baseline, out-of-core budget, bytes per worker), fastest first
+        if self.out_of_core is None or self.engine != "flank":
+            if self.max_workers == 1:
+                candidates.append(("in_memory", 1, 0, self.working_set(profile, 1.0) + merged, None, 0))
+            else:
+                workers = self.max_workers
+                per_worker = WORKER_BYTES + self.library_bytes + self.working_set(profile, 1 / workers)
+                candidates.append(("in_memory", workers, 0, merged + workers * per_worker, None, per_worker))
+            for workers in range(self.max_workers, 0, -1):
+                ranges = max(2, workers)
+                while ranges <= MAX_RANGES:
+                    per_worker = WORKER_BYTES + self.library_bytes + self.working_set(profile, 1 / ranges)
+                    candidates.append(("streaming", workers, ranges, merged + workers * per_worker, None, per_worker))
+                    ranges *= 2
+        if self.engine == "flank":
+            budget = self.out_of_core if self.out_of_core else max(int(available * OUT_OF_CORE_SHARE), 16 * MB)
+            # Read batches of budget / 1024 reads are collapsed next to the shards (see search_aav9._flank_table_out_of_core)
+            batch = max(1000, budget // 1024) * (UNIQUE_READ_BYTES + profile["read_length"])
+            candidates.append(("out_of_core", 1, 0, budget + batch, budget, 0))
+
+        fitting = [candidate for candidate in candidates if candidate[3] <= available]
+        path, workers, ranges, estimate, out_of_core, per_worker = fitting[0] if fitting else min(candidates, key=lambda candidate: candidate[3])
+        plan.update({"path": path, "workers": workers, "ranges": ranges, "estimated_rss": baseline + estimate,
+                     "estimated_worker_rss": per_worker, "out_of_core_budget": out_of_core, "over_budget": not fitting})
+        self.plans[fastq_file] = plan
+        return plan
+
+    """
+    apply: search_aav9, str --> dict
+    -- Plans a file (once) and configures the instance to count it that way
+    * @param [in] instance (search_aav9) - Instance that counts the file
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [out] plan (dict) - The plan (see plan_file)
+    """
+    def apply(self, instance, fastq_file):
+        plan = self.plans.get(fastq_file) or self.plan_file(fastq_file)
+        instance.workers = plan["workers"]
+        instance.ranges = plan["ranges"]
+        if self.engine == "flank":
+            instance.out_of_core_budget = plan["out_of_core_budget"]
+        return plan
+
+    """
+    describe: dict --> str
+    -- One line summary of a plan
+    """
+    @staticmethod
+    def describe(plan):
+        workers = f"{plan['workers']} worker{'s' if plan['workers'] > 1 else ''}"
+        if plan["path"] == "out_of_core":
+            how = f"out of core with a {preview.format_bytes(plan['out_of_core_budget'])} shard budget"
+        elif plan["path"] == "streaming":
+            how = f"streaming {plan['ranges']} byte ranges through {workers}"
+        else:
+            how = f"in memory on {workers}" if plan["workers"] > 1 else "in memory"
+        warning = " (OVER BUDGET, smallest plan)" if plan["over_budget"] else ""
+        return (f"{how}, {plan['reads']:,} reads, ~{plan['unique_reads']:,} distinct, estimated peak "
+                f"{preview.format_bytes(plan['estimated_rss'])} of {preview.format_bytes(plan['budget'])}{warning}")
+
+    """
+    record: dict, dict --> None
+    -- Adds the plan and the measured worker peak to the telemetry record of a counting stage
+    """
+    def record(self, record, plan):
+        record.update({"memory_path": plan["path"], "workers": plan["workers"], "ranges": plan["ranges"],
+                       "estimated_rss": plan["estimated_rss"], "memory_budget": plan["budget"]})
+        if plan["workers"] > 1 or plan["ranges"] > 1:
+            record["estimated_worker_rss"] = plan["estimated_worker_rss"]
+            record["worker_peak_rss"] = worker_peak_rss()
+
+    """
+    motif_sample: int, int --> int
+    -- Most library sequences the motif clustering (UMAP on one-hot encodings,
+    -- see motif.py) can take under the budget
+    * @param [in] sequences (int) - Number of sequences
+    * @param [in] length (int) - Sequence length
+    * @param [out] sample (int) - sequences if they fit, otherwise the number to subsample (at least 100)
+    """
+    def motif_sample(self, sequences, length):
+        per_sequence = max(1, length) * 20 * MOTIF_BYTES_PER_CELL + 5 * 64 # One-hot rows plus the neighbour graph
+        fits = max(0, self.limit - current_rss()) // per_sequence
+        return int(sequences if sequences <= fits else max(100, fits))
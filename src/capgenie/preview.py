@@ -0,0 +1,206 @@
+# File that previews a run on a small sample of every FASTQ file, so flanks,
+# refseq, capsid file and quality threshold can be checked in seconds before a
+# full run. The sample is taken as record-aligned windows spread evenly over the
+# file (not its head, whose reads come from the first tiles of the flow cell),
+# counted by the same engine as the full run, and reported as estimated
+# frequencies with Wilson score intervals plus the projected full-run time and
+# memory.
+#
+# The intervals treat the sampled reads as independent draws, which holds as long
+# as the read order in the file doesn't follow the variants.
+
+import math
+import os
+import numpy as np
+from capgenie import fastq
+from capgenie import telemetry as telemetry_module
+
+WINDOWS = 64 # Windows a sample is spread over
+Z_95 = 1.959963984540054 # Normal quantile of a 95% interval
+
+
+"""
+ * sample_records: str, int, int --> generator
+-- Yields an even sample of the records of a FASTQ file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] reads (int) - Reads to sample
+ * @param [in] windows (int) - Number of evenly spaced windows the reads are taken from
+ * @param [out] records (generator) - Whole records (bytes, ending in a newline), in file order
+** A window stops at the start of the next one, so a file with fewer reads than
+** asked for is yielded whole
+"""
+def sample_records(fastq_file, reads, windows=WINDOWS):
+    size = os.path.getsize(fastq_file)
+    windows = max(1, min(windows, reads))
+    per_window = math.ceil(reads / windows)
+    sampled = 0
+    with open(fastq_file, "rb") as f:
+        starts = sorted(set(fastq.record_start(f, size * i // windows) for i in range(windows)))
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else size
+            f.seek(start)
+            pos = start
+            for _ in range(per_window):
+                if pos >= end or sampled >= reads:
+                    break
+                record = [f.readline() for _ in range(4)]
+                if not record[0]:
+                    break
+                pos += sum(len(line) for line in record)
+                sampled += 1
+                yield b"".join(line if line.endswith(b"\n") else line + b"\n" for line in record if line)
+
+"""
+ * sample_stats: str, int, int --> dict
+-- Reads and bytes of a sample and what they say about the whole file
+ * @param [out] sample (dict) - reads and bytes sampled, size of the file, file_reads
+-- (counted by fastq.scan) and fraction of its reads in the sample
+"""
+def sample_stats(fastq_file, reads, sampled_bytes):
+    file_scan = fastq.scan(fastq_file)
+    return {"reads": reads, "bytes": sampled_bytes, "size": file_scan["bytes"], "file_reads": file_scan["reads"],
+            "fraction": reads / file_scan["reads"] if file_scan["reads"] else 1.0}
+
+"""
+ * sample_fastq: str, int, str, int --> dict
+-- Writes an even sample of the reads of a FASTQ file (see sample_records) to a new FASTQ file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] reads (int) - Reads to sample
+ * @param [in] path (str) - Path of the sample file
+ * @param [in] windows (int) - Number of evenly spaced windows the reads are taken from
+ * @param [out] sample (dict) - See sample_stats
+"""
+def sample_fastq(fastq_file, reads, path, windows=WINDOWS):
+    sampled = sampled_bytes = 0
+    with open(path, "wb") as out:
+        for record in sample_records(fastq_file, reads, windows):
+            out.write(record)
+            sampled += 1
+            sampled_bytes += len(record)
+    return sample_stats(fastq_file, sampled, sampled_bytes)
+
+"""
+ * wilson_interval: ndarray, int, float --> tuple
+-- Wilson score interval of binomial proportions
+ * @param [in] counts (ndarray) - Successes
+ * @param [in] n (int) - Trials
+ * @param [in] z (float) - Normal quantile, 95% by default
+ * @param [out] interval (tuple) - (low, high) ndarrays, 0 and 1 for n = 0
+** Unlike the normal approximation it stays inside [0, 1] and is usable for
+** the rare variants a sample sees only a few times
+"""
+def wilson_interval(counts, n, z=Z_95):
+    counts = np.asarray(counts, dtype=float)
+    if n <= 0:
+        return np.zeros_like(counts), np.ones_like(counts)
+    p = counts / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return np.clip(center - half, 0.0, 1.0), np.clip(center + half, 0.0, 1.0)
+
+"""
+ * estimate_table: DataFrame --> DataFrame
+-- Adds 95% intervals of the Decimal of every variant of a sample's count table
+ * @param [in] table (DataFrame) - Count table (Peptide, Count, Decimal) of the sample
+ * @param [out] table (DataFrame) - Copy with Decimal Low and Decimal High columns
+** The trials are the matches of the sample (the total of Count), as Decimal is
+** a share of the matches
+"""
+def estimate_table(table):
+    table = table.copy()
+    low, high = wilson_interval(table["Count"].to_numpy(), int(table["Count"].sum()))
+    table["Decimal Low"] = low
+    table["Decimal High"] = high
+    return table
+
+"""
+ * projected_unique: Counter, float --> float
+-- Projects the distinct reads of the full file from the sample's read multiplicities
+ * @param [in] unique_reads (Counter) - Sequence --> reads in the sample (fastq.collapse_reads)
+ * @param [in] scale (float) - Full file reads / sampled reads
+ * @param [out] unique (float) - Chao1 richness estimate, at most the linear scale up
+** Libraries saturate (few singletons) and project to their size, while reads
+** that are almost all distinct grow with the file
+"""
+def projected_unique(unique_reads, scale):
+    observed = len(unique_reads)
+    multiplicities = np.bincount(np.fromiter(unique_reads.values(), dtype=np.int64, count=observed), minlength=3) if observed else np.zeros(3, dtype=np.int64)
+    f1, f2 = int(multiplicities[1]), int(multiplicities[2])
+    chao1 = observed + (f1 * f1 / (2 * f2) if f2 else f1 * (f1 - 1) / 2)
+    return min(chao1, observed * max(scale, 1.0))
+
+"""
+ * format_share: int, int --> str
+-- Share of n with its 95% interval, e.g. "78.0% [76.8%, 79.1%]"
+"""
+def format_share(count, n):
+    if not n:
+        return "n/a"
+    low, high = wilson_interval([count], n)
+    return f"{count / n:.1%} [{low[0]:.1%}, {high[0]:.1%}]"
+
+"""
+ * format_seconds: float --> str
+-- Duration as seconds, minutes or hours
+"""
+def format_seconds(seconds):
+    if seconds < 120:
+        return f"{seconds:.1f} s"
+    if seconds < 7200:
+        return f"{seconds / 60:.1f} min"
+    return f"{seconds / 3600:.1f} h"
+
+"""
+ * format_bytes: int --> str
+-- Size in KB, MB or GB
+"""
+def format_bytes(size):
+    if size < 1 << 20:
+        return f"{size / 1024:.0f} KB"
+    if size < 1 << 30:
+        return f"{size / (1 << 20):.0f} MB"
+    return f"{size / (1 << 30):.1f} GB"
+
+
+class preview_run:
+    def __init__(self, telemetry_instance=None):
+        self.telemetry = telemetry_instance if telemetry_instance is not None else telemetry_module.telemetry()
+
+    """
+    measure: str, dict, callable --> tuple
+    -- Runs one stage on a sample and projects its time and memory to the full file
+    * @param [in] name (str) - Stage name (preview_counting, preview_denoise)
+    * @param [in] sample (dict) - Sample from sample_fastq
+    * @param [in] run (callable) - Runs the stage on the sample, returns its result
+    * @param [out] measured (tuple) - (result, record) with projected_time (seconds, scaled by the file's reads)
+    -- and the sample's baseline_rss and growth_rss (bytes) added to the record
+    """
+    def measure(self, name, sample, run):
+        telemetry_module.reset_peak_rss()
+        baseline = telemetry_module.peak_rss() or 0
+        with self.telemetry.stage(name, bytes=sample["bytes"], reads=sample["reads"]) as record:
+            result = run()
+        record["projected_time"] = record["wall_time"] * sample["file_reads"] / sample["reads"] if sample["reads"] else 0.0
+        record["baseline_rss"] = baseline
+        record["growth_rss"] = max((record["peak_rss"] or baseline) - baseline, 0)
+        return result, record
+
+    """
+    project_memory: dict, dict, Counter, int --> int
+    -- Projected peak memory of counting the full file
+    * @param [in] record (dict) - Counting record from measure
+    * @param [in] sample (dict) - Sample from sample_fastq
+    * @param [in] unique_reads (Counter) - Read multiplicities of the sample
+    * @param [in] budget (int) - Out-of-core budget in bytes, None for in memory
+    * @param [out] peak (int) - Bytes
+    ** The memory counting adds on top of the process grows with the distinct
+    ** reads (they are collapsed before matching), so the sample's growth is
+    ** scaled by projected_unique. Out of core, the growth is capped by the budget
+    """
+    def project_memory(self, record, sample, unique_reads, budget=None):
+        scale = sample["file_reads"] / sample["reads"] if sample["reads"] else 1.0
+        growth = record["growth_rss"] * projected_unique(unique_reads, scale) / max(len(unique_reads), 1)
+        if budget:
+            growth = min(growth, budget)
+        return int(record["baseline_rss"] + growth)
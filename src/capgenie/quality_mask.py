@@ -0,0 +1,150 @@
+# File that stores denoising results as a per-read pass/fail bitmap instead of a
+# filtered copy of the FASTQ file. A mask file holds one bit per read of the
+# original file (set when the read's average quality is above the threshold)
+# and the byte offset / read index of every denoise chunk, so a reader of any
+# record aligned byte range (see mapreduce.py) finds the read index of its first
+# record by scanning at most one chunk. The counting engines skip failing reads
+# while reading the original file (fastq.iter_reads(..., mask=...), or the
+# bitmap handed to filter_count_buffer), so denoising costs kilobytes of disk
+# instead of a full copy of every input.
+
+import os
+import struct
+import numpy as np
+from capgenie import denoise
+from capgenie import cache_manager
+
+MAGIC = b"CGQMASK1"
+HEADER = struct.Struct("<8sIiQQQQ") # magic, version, threshold, reads, checkpoints, source size, source mtime
+MASK_VERSION = 1
+BATCH = 1 << 16 # Reads filtered per batch
+
+
+"""
+ * mask_path: str, str --> str
+-- Returns the path of the mask file of a FASTQ file
+ * @param [in] folder (str) - Folder masks are written to (e.g. inside the session)
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [out] path (str) - <folder>/<file>.qmask
+"""
+def mask_path(folder, fastq_file):
+    return os.path.join(folder, f"{os.path.basename(fastq_file)}.qmask")
+
+"""
+ * build: str, str, int --> DenoiseResult
+-- Denoises a FASTQ file into a mask file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] path (str) - Path of the mask file
+ * @param [in] threshold (int) - Minimum average read quality
+ * @param [out] stats (DenoiseResult) - Same statistics as denoise.denoise, output_filename is the mask file
+"""
+def build(fastq_file, path, threshold):
+    result = denoise.denoise_mask(fastq_file, int(threshold))
+    stat = os.stat(fastq_file)
+    checkpoints = np.array([result.checkpoint_offsets, result.checkpoint_reads], dtype=np.uint64).T.reshape(-1)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, MASK_VERSION, int(threshold), result.stats.num_reads, len(result.checkpoint_offsets),
+                            stat.st_size, stat.st_mtime_ns))
+        f.write(checkpoints.tobytes())
+        f.write(result.bitmap)
+    os.replace(tmp_path, path)
+
+    stats = result.stats
+    stats.output_filename = path
+    return stats
+
+
+class quality_mask:
+    """
+    __init__: str --> quality_mask
+    -- Loads a mask file
+    * @param [in] path (str) - Mask file written by build
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, self.threshold, self.num_reads, num_checkpoints, self.source_size, self.source_mtime = HEADER.unpack_from(data)
+        if magic != MAGIC or version != MASK_VERSION:
+            raise ValueError(f"{path} is not a version {MASK_VERSION} quality mask")
+        checkpoints = np.frombuffer(data, np.uint64, 2 * num_checkpoints, HEADER.size).reshape(-1, 2)
+        self.checkpoint_offsets = checkpoints[:, 0]
+        self.checkpoint_reads = checkpoints[:, 1]
+        self.bitmap = np.frombuffer(data, np.uint8, (self.num_reads + 7) // 8, HEADER.size + 16 * num_checkpoints)
+
+    @property
+    def num_passing(self):
+        return int(np.unpackbits(self.bitmap, bitorder="little")[:self.num_reads].sum())
+
+    """
+    check: str --> None
+    -- Raises ValueError if the FASTQ file changed since the mask was built
+    """
+    def check(self, fastq_file):
+        stat = os.stat(fastq_file)
+        if (stat.st_size, stat.st_mtime_ns) != (self.source_size, self.source_mtime):
+            raise ValueError(f"{fastq_file} changed since its quality mask {self.path} was built")
+
+    """
+    first_read: str, int --> int
+    -- Read index of the record starting at a byte offset
+    * @param [in] fastq_file (str) - Path to the FASTQ file the mask was built from
+    * @param [in] start (int) - Record aligned byte offset
+    * @param [out] index (int) - Index of that record
+    ** Counts the lines between the closest chunk checkpoint and start
+    """
+    def first_read(self, fastq_file, start):
+        if start == 0 or not len(self.checkpoint_offsets):
+            return 0
+        c = int(np.searchsorted(self.checkpoint_offsets, start, "right")) - 1
+        offset, index = int(self.checkpoint_offsets[c]), int(self.checkpoint_reads[c])
+        with open(fastq_file, "rb") as f:
+            f.seek(offset)
+            lines = f.read(start - offset).count(b"\n")
+        return index + lines // 4
+
+    """
+    passes: int, int --> ndarray
+    -- Pass/fail flags of reads [first, first + count)
+    * @param [out] flags (ndarray) - bool per read, reads past the end of the mask fail
+    """
+    def passes(self, first, count):
+        flags = np.zeros(count, dtype=bool)
+        last = min(first + count, self.num_reads)
+        if last > first:
+            bits = np.unpackbits(self.bitmap[first // 8:(last + 7) // 8], bitorder="little")
+            flags[:last - first] = bits[first % 8:first % 8 + last - first]
+        return flags
+
+    """
+    filter: iterable, int --> generator
+    -- Drops the failing reads from a stream of reads
+    * @param [in] reads (iterable) - Reads in file order, e.g. from fastq.iter_reads
+    * @param [in] first (int) - Read index of the first read in the stream
+    * @param [out] reads (generator) - The passing reads
+    """
+    def filter(self, reads, first=0):
+        reads = iter(reads)
+        index = first
+        while True:
+            batch = [read for _, read in zip(range(BATCH), reads)]
+            if not batch:
+                return
+            flags = self.passes(index, len(batch)).tolist()
+            yield from (read for read, keep in zip(batch, flags) if keep)
+            index += len(batch)
+
+
+"""
+ * load: str, str --> quality_mask
+-- Loads the mask of a FASTQ file and checks it still matches the file
+ * @param [in] path (str) - Mask file
+ * @param [in] fastq_file (str) - The FASTQ file it was built from
+ * @param [out] mask (quality_mask) - The mask
+"""
+def load(path, fastq_file):
+    mask = quality_mask(path)
+    mask.check(fastq_file)
+    cache_manager.touch(path)
+    return mask
@@ -0,0 +1,103 @@
+# File with the array based ordering used by the counting paths. Count tables
+# are ranked with a stable numpy argsort of their counts instead of sorting
+# Python (key, count) tuples, and the top of a table is fetched with a partial
+# selection (argpartition) instead of a full sort. Every function gives exactly
+# the order the tuple sorts gave, ties included, so tables are unchanged.
+#
+# Saved count tables are in rank order (their row number is their rank), so
+# top() on them is a head() and never sorts.
+
+from collections import OrderedDict
+import numpy as np
+
+RANK_COLUMNS = ("Average_Enrichment", "Average Decimal", "Decimal", "Count") # Default column of top()
+
+
+"""
+ * rank_order: ndarray --> ndarray
+-- Stable descending order of counts, the order of
+-- sorted(items, key=count, reverse=True) (ties keep their position)
+ * @param [in] counts (ndarray) - Counts
+ * @param [out] order (ndarray) - Indices, highest count first
+"""
+def rank_order(counts):
+    counts = np.asarray(counts)
+    if counts.dtype.kind in "iub" and len(counts) and counts.min() >= 0:
+        return np.argsort(-counts.astype(np.int64), kind="stable")
+    # Reversing twice keeps ties in their original order for any dtype
+    return len(counts) - 1 - np.argsort(counts[::-1], kind="stable")[::-1]
+
+"""
+ * ranked: dict --> tuple
+-- Count table as arrays in rank order
+ * @param [in] counts (dict) - Key --> count (e.g. a Counter)
+ * @param [out] ranked (tuple) - (keys (list), counts (ndarray)), highest count first,
+-- ties in insertion order
+"""
+def ranked(counts):
+    values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    order = rank_order(values)
+    keys = list(counts.keys())
+    return [keys[i] for i in order], values[order]
+
+"""
+ * ranked_dict: dict --> dict
+-- Same as dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+ * @param [in] counts (dict) - Key --> count
+ * @param [out] ranked (dict) - The same items in rank order
+"""
+def ranked_dict(counts):
+    keys, values = ranked(counts)
+    return dict(zip(keys, values.tolist()))
+
+"""
+ * ranked_by_key: dict --> OrderedDict
+-- Same as sorting the items by (-count, key), i.e. ties ordered by key
+ * @param [in] counts (dict) - Key --> count
+ * @param [out] ranked (OrderedDict) - The same items in that order
+"""
+def ranked_by_key(counts):
+    if not counts:
+        return OrderedDict()
+    keys = np.array(list(counts.keys()))
+    values = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    order = np.lexsort((keys, -values))
+    return OrderedDict(zip(keys[order].tolist(), values[order].tolist()))
+
+"""
+ * top_k: ndarray, int --> ndarray
+-- Indices of the k largest values without sorting the rest, the first k of rank_order
+ * @param [in] values (ndarray) - Values
+ * @param [in] k (int) - Number of indices
+ * @param [out] indices (ndarray) - Highest value first, ties in index order
+** argpartition finds the k-th largest value, every larger value is taken and
+** the ties at the boundary are filled in index order, then only these k are sorted
+"""
+def top_k(values, k):
+    values = np.asarray(values)
+    if k >= len(values):
+        return rank_order(values)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    kth = values[np.argpartition(values, len(values) - k)[len(values) - k]]
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[:k - len(above)]
+    selected = np.sort(np.concatenate((above, ties)))
+    return selected[rank_order(values[selected])]
+
+"""
+ * top: DataFrame, int, str --> DataFrame
+-- The n rows of a table with the largest values in a column
+ * @param [in] table (DataFrame) - Count, average or enrichment table
+ * @param [in] n (int) - Number of rows
+ * @param [in] column (str) - Column to rank by, by default the first of RANK_COLUMNS the table has
+ * @param [out] rows (DataFrame) - Highest first
+** Tables saved in rank order are just cut, others are partially selected
+"""
+def top(table, n, column=None):
+    if column is None:
+        column = next((c for c in RANK_COLUMNS if c in table.columns), table.columns[-1])
+    values = table[column]
+    if values.is_monotonic_decreasing:
+        return table.iloc[:n]
+    return table.iloc[top_k(values.to_numpy(), n)]
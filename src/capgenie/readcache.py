@@ -0,0 +1,269 @@
+# File that converts FASTQ files once into a compact binary read cache, so
+# repeated analyses of the same file (other flanks, capsid files or mismatch
+# settings) skip text parsing and read about a quarter of the bytes. A cache
+# file holds:
+#
+#   packed       2-bit packed bases (A=0, C=1, G=2, T=3), 4 bases per byte
+#   exceptions   positions and characters of every other base (N, lowercase, ...)
+#   base index   offset of every read in the packed bases
+#   record index byte offset of every record in the source FASTQ, so byte
+#                ranges (see mapreduce.py) map to read ranges
+#   quality      mean Phred score of every read, one byte per read, only when
+#                asked for (convert(..., quality=True)), as no engine reads it
+#
+# Caches live in the hidden .reads cache folder, are keyed by the FASTQ path and
+# are only used while the FASTQ's size and modification time are unchanged.
+# The file is memory mapped, so worker processes share its pages.
+# Reads are decoded natively (mani.unpack_reads).
+# fastq.iter_reads uses a valid cache automatically, which covers every engine
+# that counts collapsed reads. filter_count and denoise scan the text natively.
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+from itertools import islice
+import numpy as np
+from capgenie import mani
+from capgenie import cache_manager
+
+MAGIC = b"CGREADS1"
+HEADER = struct.Struct("<8sIIQQQQQQQQQQ") # magic, version, flags, reads, bases, exceptions, source size, source mtime, 5 section offsets
+CACHE_VERSION = 1
+FLAG_QUALITY = 1
+CONVERT_BATCH = 1 << 18 # Records per conversion batch
+DECODE_BATCH = 1 << 16 # Reads decoded per batch
+
+ENCODE = np.zeros(256, dtype=np.uint8)
+VALID = np.zeros(256, dtype=bool)
+for _code, _base in enumerate(b"ACGT"):
+    ENCODE[_base] = _code
+    VALID[_base] = True
+
+
+"""
+ * cache_folder: None --> str
+-- Returns the folder read caches are stored in. It is hidden so it is never
+-- listed as a session.
+ * @param [out] folder (str) - Path to the read cache folder
+"""
+def cache_folder():
+    return os.path.join(os.path.expanduser(mani.get_cache_folder()), ".reads")
+
+"""
+ * cache_path: str --> str
+-- Returns the cache file of a FASTQ file
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [out] path (str) - Path of its cache file (may not exist)
+"""
+def cache_path(fastq_file):
+    digest = hashlib.sha256(os.path.abspath(fastq_file).encode()).hexdigest()[:32]
+    return os.path.join(cache_folder(), f"{digest}.cgr")
+
+"""
+ * _source_stamp: str --> tuple
+-- Size and modification time a cache must match to be used
+"""
+def _source_stamp(fastq_file):
+    stat = os.stat(fastq_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class read_cache:
+    """
+    __init__: str --> read_cache
+    -- Memory maps a cache file
+    * @param [in] path (str) - Cache file written by convert
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.flags, self.num_reads, self.num_bases, num_exceptions, self.source_size, self.source_mtime,
+         packed_at, bases_at, records_at, exceptions_at, quality_at) = HEADER.unpack_from(self._mapped)
+        if magic != MAGIC or version != CACHE_VERSION:
+            self._mapped.close()
+            raise ValueError(f"{path} is not a version {CACHE_VERSION} read cache")
+
+        n = self.num_reads
+        self.packed = np.frombuffer(self._mapped, np.uint8, (self.num_bases + 3) // 4, packed_at)
+        self.base_offsets = np.frombuffer(self._mapped, np.uint64, n + 1, bases_at)
+        self.record_offsets = np.frombuffer(self._mapped, np.uint64, n + 1, records_at)
+        self.exception_positions = np.frombuffer(self._mapped, np.uint64, num_exceptions, exceptions_at)
+        self.exception_bases = np.frombuffer(self._mapped, np.uint8, num_exceptions, exceptions_at + 8 * num_exceptions)
+        self.quality = np.frombuffer(self._mapped, np.uint8, n, quality_at) if self.flags & FLAG_QUALITY else None
+
+    """
+    matches: str --> bool
+    -- Whether the cache was built from the current version of a FASTQ file
+    """
+    def matches(self, fastq_file):
+        return (self.source_size, self.source_mtime) == _source_stamp(fastq_file)
+
+    """
+    read_range: int, int --> tuple
+    -- Maps a byte range of the source FASTQ to a read range
+    * @param [in] start (int) - Byte offset, records starting before it are skipped
+    * @param [in] end (int) - Records starting at or after this offset are skipped, None for the end
+    * @param [out] reads (tuple) - (first read, last read + 1)
+    """
+    def read_range(self, start=0, end=None):
+        starts = self.record_offsets[:self.num_reads]
+        first = int(np.searchsorted(starts, start, "left")) if start else 0
+        last = self.num_reads if end is None else int(np.searchsorted(starts, end, "left"))
+        return first, max(first, last)
+
+    """
+    decode: int, int --> list
+    -- Decodes reads [first, last) back into strings
+    * @param [in] first (int) - First read
+    * @param [in] last (int) - Last read + 1
+    * @param [out] reads (list) - Read sequences, exactly as in the FASTQ file
+    """
+    def decode(self, first, last):
+        return mani.unpack_reads(self.packed, self.base_offsets, self.exception_positions, self.exception_bases, first, last)
+
+    """
+    iter_reads: int, int --> generator
+    -- Same reads as fastq.iter_reads on the source file, without parsing text
+    * @param [in] start (int) - Byte offset of the first record in the source FASTQ
+    * @param [in] end (int) - Records starting at or after this offset are skipped
+    * @param [out] reads (generator) - Read sequences
+    """
+    def iter_reads(self, start=0, end=None):
+        first, last = self.read_range(start, end)
+        for batch in range(first, last, DECODE_BATCH):
+            yield from self.decode(batch, min(last, batch + DECODE_BATCH))
+
+    def close(self):
+        # Views must go before the mapping can close
+        self.packed = self.base_offsets = self.record_offsets = None
+        self.exception_positions = self.exception_bases = self.quality = None
+        self._mapped.close()
+
+
+"""
+ * open_cache: str --> read_cache
+-- Opens the cache of a FASTQ file if there is a current one
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [out] cache (read_cache) - The cache, None if missing, stale or unreadable
+"""
+def open_cache(fastq_file):
+    path = cache_path(fastq_file)
+    if not cache_manager.restore(path): # Decompresses a cache compressed while it was cold
+        return None
+    try:
+        cache = read_cache(path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if not cache.matches(fastq_file):
+        cache.close()
+        return None
+    cache_manager.touch(path)
+    return cache
+
+"""
+ * _pad: file --> int
+-- Pads a file to the next 8 byte boundary and returns the offset
+"""
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % 8))
+    return f.tell()
+
+"""
+ * convert: str, bool --> str
+-- Converts a FASTQ file into its read cache, unless a current one exists
+ * @param [in] fastq_file (str) - Path to FASTQ file
+ * @param [in] quality (bool) - Also store the mean quality of every read (rounded, for
+-- callers of the cache; -qual and quality masks score the exact qualities of the FASTQ)
+ * @param [out] path (str) - Path of the cache file
+** Streams the file in batches of CONVERT_BATCH records. The packed bases go
+** straight to the cache file, the indexes to side files that are appended at
+** the end, and the finished file is renamed into place, so a cache is never
+** seen half written
+"""
+def convert(fastq_file, quality=False):
+    path = cache_path(fastq_file)
+    cache = open_cache(fastq_file)
+    if cache is not None:
+        has_quality = cache.quality is not None
+        cache.close()
+        if has_quality or not quality:
+            return path
+
+    os.makedirs(cache_folder(), exist_ok=True)
+    size, mtime = _source_stamp(fastq_file)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_folder(), suffix=".tmp")
+    sides = {name: tempfile.TemporaryFile(dir=cache_folder()) for name in ["bases", "records", "positions", "exceptions", "quality"]}
+    try:
+        with os.fdopen(fd, "wb") as out, open(fastq_file, "rb", buffering=1 << 20) as f:
+            out.write(b"\0" * HEADER.size)
+            packed_at = _pad(out)
+            num_reads = num_bases = num_exceptions = offset = 0
+            carry = np.zeros(0, dtype=np.uint8) # Codes not yet packed into a full byte
+            while True:
+                lines = list(islice(f, 4 * CONVERT_BATCH))
+                if not lines:
+                    break
+                line_offsets = offset + np.concatenate(([0], np.cumsum([len(line) for line in lines], dtype=np.uint64)))
+                offset = int(line_offsets[-1])
+                seqs = [line.rstrip(b"\r\n") for line in lines[1::4]]
+                count = len(seqs)
+
+                lengths = np.fromiter(map(len, seqs), dtype=np.uint64, count=count)
+                np.concatenate(([num_bases], num_bases + np.cumsum(lengths)))[:-1].astype(np.uint64).tofile(sides["bases"])
+                line_offsets[0:4 * count:4].astype(np.uint64).tofile(sides["records"])
+
+                data = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+                invalid = np.flatnonzero(~VALID[data])
+                (num_bases + invalid).astype(np.uint64).tofile(sides["positions"])
+                data[invalid].tofile(sides["exceptions"])
+                num_exceptions += len(invalid)
+
+                codes = np.concatenate((carry, ENCODE[data]))
+                full = len(codes) // 4 * 4
+                quads = codes[:full].reshape(-1, 4)
+                ((quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]).astype(np.uint8).tofile(out)
+                carry = codes[full:]
+
+                if quality:
+                    scores = np.zeros(count, dtype=np.uint8)
+                    quals = [line.rstrip(b"\r\n") for line in lines[3::4]]
+                    qual_lengths = np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))
+                    if qual_lengths.sum():
+                        qdata = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64) - 33
+                        starts = np.concatenate(([0], np.cumsum(qual_lengths)))[:-1]
+                        nonempty = qual_lengths > 0
+                        sums = np.add.reduceat(qdata, starts[nonempty])
+                        scores[:len(quals)][nonempty] = np.clip(np.rint(sums / qual_lengths[nonempty]), 0, 255).astype(np.uint8)
+                    scores.tofile(sides["quality"])
+
+                num_reads += count
+                num_bases += int(lengths.sum())
+
+            if len(carry):
+                codes = np.concatenate((carry, np.zeros(4 - len(carry), dtype=np.uint8)))
+                out.write(bytes([(codes[0] << 6) | (codes[1] << 4) | (codes[2] << 2) | codes[3]]))
+            np.array([num_bases], dtype=np.uint64).tofile(sides["bases"])
+            np.array([offset], dtype=np.uint64).tofile(sides["records"])
+
+            sections = []
+            for name in ["bases", "records", "positions", "exceptions", "quality"]:
+                if name != "exceptions": # Exception characters follow their positions directly
+                    sections.append(_pad(out))
+                sides[name].seek(0)
+                for block in iter(lambda: sides[name].read(1 << 20), b""):
+                    out.write(block)
+            out.seek(0)
+            out.write(HEADER.pack(MAGIC, CACHE_VERSION, FLAG_QUALITY if quality else 0, num_reads, num_bases, num_exceptions,
+                                  size, mtime, packed_at, *sections))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        for side in sides.values():
+            side.close()
+    return path
@@ -3,7 +3,6 @@
 # Inspired by Killian Hanlon's 'Shuttlecock' package --> killian@transduction.cc
 
 from collections import Counter 
-from collections import OrderedDict
 from scipy.spatial.distance import hamming
 import os
 from Bio.Seq import Seq
@@ -17,8 +16,21 @@ import numpy as np
 from capgenie import mani
 from capgenie import filter_module ## See filter_count.cpp for more info
 from capgenie import fuzzy_match ## See fuzzy_match.cpp for more info
+from capgenie.telemetry import telemetry ## See telemetry.py for more info
+from capgenie import fastq ## See fastq.py for more info
+from capgenie.shards import shard_counter ## See shards.py for more info
+from capgenie import mapreduce ## See mapreduce.py for more info
+from capgenie import multilib ## See multilib.py for more info
+from capgenie import quality_mask ## See quality_mask.py for more info
+from capgenie.aggregate import replicate_aggregate ## See aggregate.py for more info
+from capgenie.count_matrix import count_matrix ## See count_matrix.py for more info
+from capgenie import ranking ## See ranking.py for more info
+from capgenie import session_export ## See session_export.py for more info
 import json
 import shutil
+import tempfile
+
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
 
 class color:
 	PURPLE = '\033[95m'
@@ -33,11 +45,22 @@ class color:
 	END = '\033[0m'
 
 class search_aav9:
-    def __init__(self):
+    def __init__(self, telemetry_instance=None):
         self._save_dir = ""
         self._pkl_file_path = ""
         self._instructions_file = ""
         self._cache_folder = ""
+        self._num_reads = 0
+        self._num_unique_reads = 0
+        self.out_of_core_budget = None # bytes, set to count unknown variants out of core
+        self.workers = 1 # Worker processes per FASTQ file, see mapreduce.py
+        self.ranges = 0 # Byte ranges per FASTQ file, 0 for one per worker (more ranges bound the memory of a worker, see planner.py)
+        self.both_strands = False # Count reverse complement matches too, in the same pass
+        self.sample_reads = {} # Reads per sample of the last demultiplexed file, see demux.py
+        self.unassigned_reads = 0
+        self.quality_masks = {} # Absolute FASTQ path --> quality mask file, failing reads are skipped (see quality_mask.py)
+        self._count_matrix = None # Session samples x peptides matrix, loaded on first use
+        self.telemetry = telemetry_instance if telemetry_instance else telemetry()
 
     # save_dir is where the session is placed in cache
     @property
@@ -54,6 +77,21 @@ class search_aav9:
     def intructions_file_path(self):
         return self._instructions_file
     
+    # Number of reads seen by the last counting call
+    @property
+    def num_reads(self):
+        return self._num_reads
+
+    # Number of distinct reads matched by the last counting call
+    @property
+    def num_unique_reads(self):
+        return self._num_unique_reads
+
+    # Whether files are counted over byte ranges in worker processes (see mapreduce.py)
+    @property
+    def distributed(self):
+        return self.workers > 1 or self.ranges > 1
+
     # Loads instruction data
     @property
     def get_instructions_data(self):
@@ -77,6 +115,68 @@ class search_aav9:
                 if peptide in nuc[frame:].translate(1):
                     return str(nuc)
         return False
+
+    """
+    reverse_complement: cls, str --> str
+    -- Returns the reverse complement of a DNA sequence
+    * @param [in] seq (str) - DNA sequence
+    * @param [out] rc (str) - Reverse complement
+    """
+    @classmethod
+    def reverse_complement(cls, seq):
+        return seq.translate(COMPLEMENT)[::-1]
+
+    """
+    strand_automaton: cls, iterable --> Automaton
+    -- Builds one automaton over every sequence and its reverse complement,
+    -- so both strands are matched in a single scan
+    * @param [in] sequences (iterable) - Oriented library sequences
+    * @param [out] A (Automaton) - Values are (sequence, "+") or (sequence, "-")
+    ** A reverse complement that is itself a library sequence (e.g. a
+    ** palindrome) is only counted on the forward strand
+    """
+    @classmethod
+    def strand_automaton(cls, sequences):
+        sequences = list(sequences)
+        forward = set(sequences)
+        A = ahocorasick.Automaton()
+        for pattern in sequences:
+            A.add_word(pattern, (pattern, "+"))
+        for pattern in sequences:
+            rc = cls.reverse_complement(pattern)
+            if rc not in forward:
+                A.add_word(rc, (pattern, "-"))
+        A.make_automaton()
+        return A
+
+    """
+    reverse_queries: cls, iterable --> dict
+    -- Reverse complement queries for fuzzy matching both strands at once
+    * @param [in] sequences (iterable) - Oriented library sequences
+    * @param [out] queries (dict) - Reverse complement --> library sequence, skipping
+    -- reverse complements that are library sequences themselves
+    """
+    @classmethod
+    def reverse_queries(cls, sequences):
+        sequences = list(sequences)
+        forward = set(sequences)
+        return {cls.reverse_complement(seq): seq for seq in sequences if cls.reverse_complement(seq) not in forward}
+
+    """
+    split_strands: cls, dict --> tuple
+    -- Splits counts keyed by (key, strand) into merged counts and per-strand counts
+    * @param [in] counts (dict) - (key, "+"|"-") --> count, plain keys count as "+"
+    * @param [out] result (tuple) - (Counter of merged counts, dict key --> [forward, reverse])
+    """
+    @classmethod
+    def split_strands(cls, counts):
+        merged = Counter()
+        strands = {}
+        for key, count in counts.items():
+            key, strand = key if isinstance(key, tuple) else (key, "+")
+            merged[key] += count
+            strands.setdefault(key, [0, 0])[0 if strand == "+" else 1] += count
+        return merged, strands
     
     """
     find_upstream_downstream: cls, list[str] --> tuple[str, str]
@@ -184,47 +284,134 @@ class search_aav9:
         content = f.read().split("\n")
         f.close()
 
-        dna_seq = "".join(content[1::4])
+        reads = content[1::4]
+        self._num_reads = len(reads)
+        dna_seq = "".join(reads)
         return dna_seq
     
     """
-    count_known_reads: dict, str, str --> None
-    -- Takes a peptide_map from the given csv file and counts the
-    -- number of occurances of every peptide. Then it prunes reads
-    -- beyond a given threshold.
-    * @param [in] peptide_map (dict) - Map of peptides to sequences
+    collapse_reads: str --> Counter
+    -- Reads a FASTQ file once and collapses duplicate reads into a
+    -- unique sequence --> multiplicity table
     * @param [in] fastq_file (str) - Path to FASTQ file
-    * @param [in] data_directory (str) - Data directory path
-    * @param [out] None - Saves counts to pickle file
-    ** Counts known peptide reads in FASTQ file
+    * @param [out] unique_reads (Counter) - Unique read sequences and their counts
+    ** Matching then only runs on unique reads, weighted by multiplicity
     """
-    def count_known_reads(self, peptide_map, fastq_file, data_directory):
-        new_path = os.path.join(self._pkl_file_path, data_directory)
-        if not os.path.exists(new_path):
-            os.mkdir(new_path)
+    def collapse_reads(self, fastq_file):
+        unique_reads = fastq.collapse_reads(fastq.iter_reads(fastq_file, mask=self.mask_file(fastq_file)))
+        self._num_reads = sum(unique_reads.values())
+        self._num_unique_reads = len(unique_reads)
+        return unique_reads
 
-        dna_seq = self.load_dna_seq(fastq_file=fastq_file)
+    """
+    mask_file: str --> str
+    -- Quality mask file registered for a FASTQ file, None if every read counts
+    """
+    def mask_file(self, fastq_file):
+        return self.quality_masks.get(os.path.abspath(fastq_file))
 
-        automaton = ahocorasick.Automaton()
+    """
+    _work_folder: str, str, str --> str
+    -- Returns a scratch folder for one FASTQ file, inside the session when
+    -- there is one and in the temp folder otherwise (e.g. when called from api.py)
+    * @param [in] kind (str) - Scratch kind, e.g. "mapreduce" or "shards"
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [out] folder (str) - Scratch folder path (not created)
+    """
+    def _work_folder(self, kind, data_directory, fastq_file):
+        name = f"{data_directory}_{os.path.basename(fastq_file)}"
+        if self._save_dir:
+            return os.path.join(self._cache_folder, self._save_dir, kind, name)
+        return os.path.join(tempfile.gettempdir(), "capgenie", kind, f"{os.getpid()}_{name}")
 
-        for pattern in peptide_map.keys():
-            automaton.add_word(pattern, pattern)
-        automaton.make_automaton()
+    """
+    _map_reduce: str, str, dict, dict --> Counter
+    -- Counts one FASTQ file over byte ranges (self.ranges, or one per worker)
+    -- in self.workers separate processes and merges the partial count tables
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] params (dict) - Counting mode and its parameters
+    * @param [in] shared (dict) - Inputs written once for all workers
+    * @param [out] counts (Counter) - Merged counts
+    """
+    def _map_reduce(self, fastq_file, data_directory, params, shared=None):
+        work_dir = self._work_folder("mapreduce", data_directory, fastq_file)
+        if self.mask_file(fastq_file):
+            params = {**params, "mask": self.mask_file(fastq_file)}
+        counts, self._num_reads, self._num_unique_reads = mapreduce.map_reduce(fastq_file, params, self.workers, work_dir, shared, self.ranges)
+        try:
+            os.rmdir(os.path.dirname(work_dir))
+        except OSError:
+            pass
+        return counts
+
+    """
+    count_known_table: dict, str, Automaton, str --> DataFrame
+    -- Takes a peptide_map from the given csv file and counts the
+    -- number of occurances of every peptide, without touching the session
+    * @param [in] peptide_map (dict) - Map of peptides to sequences
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] automaton (Automaton) - Prebuilt automaton, e.g. library_index.automaton
+    -- (library_index.strand_automaton when self.both_strands)
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] table (DataFrame) - Peptide, Count and Decimal columns, plus
+    -- Forward Count and Reverse Count when self.both_strands
+    """
+    def count_known_table(self, peptide_map, fastq_file, automaton=None, data_directory=""):
+        if automaton is None and self.both_strands:
+            automaton = self.strand_automaton(peptide_map.keys())
+        elif automaton is None:
+            automaton = ahocorasick.Automaton()
+            for pattern in peptide_map.keys():
+                automaton.add_word(pattern, pattern)
+            automaton.make_automaton()
         
         counts = {pattern: 0 for pattern in peptide_map.keys()}
 
-        for end_pos, pattern in automaton.iter(dna_seq):
-            counts[pattern] += 1
+        if self.distributed:
+            hits = self._map_reduce(fastq_file, data_directory, {"mode": "known"}, {"automaton": automaton})
+        else:
+            hits = Counter()
+            unique_reads = self.collapse_reads(fastq_file)
+            for read, multiplicity in unique_reads.items():
+                for end_pos, value in automaton.iter(read):
+                    hits[value] += multiplicity
+
+        strands = None
+        if self.both_strands:
+            hits, strands = self.split_strands(hits)
+            strands = {peptide_map[k]: v for k, v in strands.items()}
+        for pattern, count in hits.items():
+            counts[pattern] += count
 
         # Ensure all peptides are present, fill missing with 0
         for pattern in peptide_map.keys():
             if pattern not in counts:
                 counts[pattern] = 0
 
-        sorted_count = dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
-        sorted_count = {peptide_map[k]:v for k,v in sorted_count.items()}
+        patterns, ranked_counts = ranking.ranked(counts)
+
+        return self.decimal_table(([peptide_map[k] for k in patterns], ranked_counts), strands=strands)
+
+    """
+    count_known_reads: dict, str, str, Automaton --> DataFrame
+    -- Counts every peptide of the peptide_map (see count_known_table)
+    -- and saves the table into the session
+    * @param [in] peptide_map (dict) - Map of peptides to sequences
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] automaton (Automaton) - Prebuilt automaton, e.g. library_index.automaton
+    * @param [out] table (DataFrame) - The saved table
+    ** Counts known peptide reads in FASTQ file
+    """
+    def count_known_reads(self, peptide_map, fastq_file, data_directory, automaton=None):
+        new_path = os.path.join(self._pkl_file_path, data_directory)
+        if not os.path.exists(new_path):
+            os.mkdir(new_path)
 
-        self.add_decimal(sorted_count, os.path.join(new_path, f"variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
+        table = self.count_known_table(peptide_map, fastq_file, automaton, data_directory)
+        table.to_pickle(os.path.join(new_path, f"variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
 
         with open(self._instructions_file, "rb+") as file:
             content = pkl.load(file)
@@ -235,43 +422,39 @@ class search_aav9:
             file.seek(0)
             file.truncate()
             pkl.dump(content, file)
+        return table
 
     """
-    search_by_flank: str, str, str, str --> None
-    -- Searches for unknown variants between upstream and downstream sequences
+    flank_automaton: cls, str, str, bool --> Automaton
+    -- Builds the automaton used to find upstream (1) and downstream (2) flanks
     * @param [in] upstream (str) - Upstream flanking sequence
     * @param [in] downstream (str) - Downstream flanking sequence
-    * @param [in] fastq_file (str) - Path to FASTQ file
-    * @param [in] data_directory (str) - Data directory path
-    * @param [out] None - Saves unknown variants to pickle file
-    ** Searches for unknown variants between flanking sequences
+    * @param [in] both_strands (bool) - Also add the reverse strand flanks, reverse
+    -- complement of downstream (3) and of upstream (4)
+    * @param [out] A (Automaton) - Automaton with lengths stored next to the tag
     """
-    def search_by_flank(self, upstream, downstream, fastq_file, data_directory):
-        new_path = os.path.join(self._pkl_file_path, data_directory)
-        if not os.path.exists(new_path):
-            os.mkdir(new_path)
-
-        dna_seq = self.load_dna_seq(fastq_file=fastq_file)
-
+    @classmethod
+    def flank_automaton(cls, upstream, downstream, both_strands=False):
         A = ahocorasick.Automaton()
-        A.add_word(upstream, 1)
-        A.add_word(downstream, 2)
+        A.add_word(upstream, (1, len(upstream)))
+        A.add_word(downstream, (2, len(downstream)))
+        if both_strands:
+            A.add_word(cls.reverse_complement(downstream), (3, len(downstream)))
+            A.add_word(cls.reverse_complement(upstream), (4, len(upstream)))
         A.make_automaton()
+        return A
 
-        f1_pos = []
-        f2_pos = []
-
-        len_f1 = len(upstream)
-        len_f2 = len(downstream)
-
-        for end, tag in A.iter(dna_seq):
-            start = end - (len_f1 if tag == 1 else len_f2) + 1
-            if tag == 1:
-                f1_pos.append((start, end))
-            else:
-                f2_pos.append((start, end))
-
-        read_counts = Counter()
+    """
+    pair_flanks: cls, list, list, int, int --> generator
+    -- Pairs every left flank with the next right flank that starts after it
+    * @param [in] f1_pos (list) - (start, end) of the left flanks, in read order
+    * @param [in] f2_pos (list) - (start, end) of the right flanks, in read order
+    * @param [in] min_length (int) - Shortest insert kept
+    * @param [in] max_length (int) - Longest insert kept
+    * @param [out] inserts (generator) - (start, end) slices of every insert in range
+    """
+    @classmethod
+    def pair_flanks(cls, f1_pos, f2_pos, min_length=12, max_length=25):
         f2_idx = 0
         f2_len = len(f2_pos)
 
@@ -286,14 +469,111 @@ class search_aav9:
             read_end = f2_start
             read_len = read_end - read_start
 
-            if 12 <= read_len <= 25:
-                read = dna_seq[read_start:read_end]
-                read_counts[read] += 1
+            if min_length <= read_len <= max_length:
+                yield read_start, read_end
+
+    """
+    flank_inserts: cls, Automaton, str --> generator
+    -- Yields every 12-25 nt insert between an upstream flank and the next
+    -- downstream flank in a single read
+    * @param [in] A (Automaton) - Automaton from flank_automaton
+    * @param [in] dna_seq (str) - Read sequence
+    * @param [out] inserts (generator) - Insert sequences
+    """
+    @classmethod
+    def flank_inserts(cls, A, dna_seq):
+        f1_pos = []
+        f2_pos = []
+
+        for end, (tag, length) in A.iter(dna_seq):
+            start = end - length + 1
+            if tag == 1:
+                f1_pos.append((start, end))
+            elif tag == 2:
+                f2_pos.append((start, end))
+
+        for read_start, read_end in cls.pair_flanks(f1_pos, f2_pos):
+            yield dna_seq[read_start:read_end]
+
+    """
+    stranded_flank_inserts: cls, Automaton, str --> generator
+    -- Yields the inserts of both strands of a read in a single scan
+    * @param [in] A (Automaton) - Automaton from flank_automaton(..., both_strands=True)
+    * @param [in] dna_seq (str) - Read sequence
+    * @param [out] inserts (generator) - (insert, "+"|"-"), reverse strand inserts are
+    -- reverse complemented into the library orientation
+    """
+    @classmethod
+    def stranded_flank_inserts(cls, A, dna_seq):
+        positions = {1: [], 2: [], 3: [], 4: []}
+        for end, (tag, length) in A.iter(dna_seq):
+            positions[tag].append((end - length + 1, end))
+
+        for read_start, read_end in cls.pair_flanks(positions[1], positions[2]):
+            yield dna_seq[read_start:read_end], "+"
+        for read_start, read_end in cls.pair_flanks(positions[3], positions[4]):
+            yield cls.reverse_complement(dna_seq[read_start:read_end]), "-"
+
+    """
+    flank_table: str, str, str, str --> DataFrame
+    -- Searches for unknown variants between upstream and downstream sequences,
+    -- prunes them and returns the table without touching the session
+    * @param [in] upstream (str) - Upstream flanking sequence
+    * @param [in] downstream (str) - Downstream flanking sequence
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] table (DataFrame) - Translated Peptide, Count and Decimal columns, plus
+    -- Forward Count and Reverse Count when self.both_strands
+    ** Runs out of core when self.out_of_core_budget is set
+    """
+    def flank_table(self, upstream, downstream, fastq_file, data_directory=""):
+        A = self.flank_automaton(upstream, downstream, self.both_strands)
+
+        if self.out_of_core_budget:
+            return self._flank_table_out_of_core(A, fastq_file, data_directory)
 
-        sorted_read = dict(sorted(read_counts.items(), key=lambda item: item[1], reverse=True))
-        sorted_read = self.prune_reads(0.05, sorted_read)
+        if self.distributed:
+            read_counts = self._map_reduce(fastq_file, data_directory, {"mode": "flank", "upstream": upstream, "downstream": downstream,
+                                                                         "both_strands": self.both_strands})
+        else:
+            unique_reads = self.collapse_reads(fastq_file)
+
+            read_counts = Counter()
+            inserts = self.stranded_flank_inserts if self.both_strands else self.flank_inserts
+
+            for dna_seq, multiplicity in unique_reads.items():
+                for read in inserts(A, dna_seq):
+                    read_counts[read] += multiplicity
+
+        strands = None
+        if self.both_strands:
+            read_counts, strands = self.split_strands(read_counts)
+
+        sorted_read = ranking.ranked_dict(read_counts)
+        with self.telemetry.stage("pruning", directory=data_directory, file=os.path.basename(fastq_file)) as record:
+            record["reads"] = len(sorted_read)
+            sorted_read = self.prune_reads(0.05, sorted_read, strands)
+
+        return self.decimal_table(sorted_read, merc=True, strands=strands)
+
+    """
+    search_by_flank: str, str, str, str --> DataFrame
+    -- Searches for unknown variants between upstream and downstream sequences
+    -- (see flank_table) and saves the table into the session
+    * @param [in] upstream (str) - Upstream flanking sequence
+    * @param [in] downstream (str) - Downstream flanking sequence
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory path
+    * @param [out] table (DataFrame) - The saved table
+    ** Searches for unknown variants between flanking sequences
+    """
+    def search_by_flank(self, upstream, downstream, fastq_file, data_directory):
+        new_path = os.path.join(self._pkl_file_path, data_directory)
+        if not os.path.exists(new_path):
+            os.mkdir(new_path)
 
-        self.add_decimal(sorted_read, os.path.join(new_path, f"unknown_variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"), merc=True)
+        table = self.flank_table(upstream, downstream, fastq_file, data_directory)
+        table.to_pickle(os.path.join(new_path, f"unknown_variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
 
         with open(self._instructions_file, "rb+") as file:
             content = pkl.load(file)
@@ -304,33 +584,132 @@ class search_aav9:
             file.seek(0)
             file.truncate()
             pkl.dump(content, file)
+        return table
+
+    """
+    _flank_table_out_of_core: Automaton, str, str --> DataFrame
+    -- Out-of-core version of flank_table for runs with more distinct
+    -- inserts than fit in memory. Reads are collapsed in bounded batches and
+    -- inserts are counted with a shard_counter under self.out_of_core_budget.
+    * @param [in] A (Automaton) - Automaton from flank_automaton
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] table (DataFrame) - Translated Peptide, Count and Decimal columns, plus
+    -- Forward Count and Reverse Count when self.both_strands
+    ** Produces exactly the same table and order as the in-memory path. With
+    ** self.both_strands reverse strand inserts are also counted in a second
+    ** shard_counter (the budget is split between the two). Its sorted items
+    ** are streamed once after pruning and only the counts of table rows, or of
+    ** pruned inserts merged into them, are kept
+    """
+    def _flank_table_out_of_core(self, A, fastq_file, data_directory):
+        shard_folder = self._work_folder("shards", data_directory, fastq_file)
+        budget = self.out_of_core_budget // 2 if self.both_strands else self.out_of_core_budget
+        counter = shard_counter(shard_folder, budget)
+        reverse_counter = shard_counter(os.path.join(shard_folder, "reverse"), budget) if self.both_strands else None
+        batch_size = max(1000, self.out_of_core_budget // 1024)
+
+        self._num_reads = 0
+        self._num_unique_reads = 0
+        try:
+            for unique_reads in fastq.collapse_batches(fastq.iter_reads(fastq_file, mask=self.mask_file(fastq_file)), batch_size):
+                self._num_reads += sum(unique_reads.values())
+                self._num_unique_reads += len(unique_reads)
+                for dna_seq, multiplicity in unique_reads.items():
+                    if self.both_strands:
+                        for read, strand in self.stranded_flank_inserts(A, dna_seq):
+                            counter.add(read, multiplicity)
+                            if strand == "-":
+                                reverse_counter.add(read, multiplicity)
+                    else:
+                        for read in self.flank_inserts(A, dna_seq):
+                            counter.add(read, multiplicity)
+
+            with self.telemetry.stage("pruning", directory=data_directory, file=os.path.basename(fastq_file)) as record:
+                counter.finish()
+                record["reads"] = counter.num_distinct
+                strands = None
+                if self.both_strands:
+                    merges = {}
+                    sorted_read = list(self.prune_sorted_reads(0.05, counter.sorted_items, counter.num_distinct, merges))
+                    reverse = {read: 0 for read, count in sorted_read}
+                    for read, count in reverse_counter.sorted_items():
+                        if read in reverse:
+                            reverse[read] += count
+                        for x in merges.get(read, ()):
+                            reverse[x] += count
+                    strands = {read: [count - reverse[read], reverse[read]] for read, count in sorted_read}
+                else:
+                    sorted_read = self.prune_sorted_reads(0.05, counter.sorted_items, counter.num_distinct)
+                table = self.decimal_table(sorted_read, merc=True, strands=strands)
+        finally:
+            counter.cleanup()
+            try:
+                os.rmdir(os.path.dirname(shard_folder))
+            except OSError:
+                pass # Still in use by another file
+        return table
 
     """
-    _cpp_fuzzy_match: dict, str, str, int, bool --> None
+    fuzzy_match_table: dict, str, int, bool, str --> DataFrame
     -- Fuzzy matches peptides in two ways: substitutions w/o indels.
+    -- Duplicate reads are collapsed first, so each distinct read is only
+    -- matched once and its matches are weighted by multiplicity.
     * @param [in] peptide_map (dict) - Map of peptides to sequences
     * @param [in] fastq_file (str) - Path to FASTQ file
-    * @param [in] data_directory (str) - Data directory path
     * @param [in] mismatches (int) - Number of allowed mismatches
     * @param [in] subOnly (bool) - If True, only allow substitutions; if False, allow indels too
-    * @param [out] None - Saves fuzzy match results to pickle file
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] table (DataFrame) - Peptide, Count and Decimal columns, plus
+    -- Forward Count and Reverse Count when self.both_strands
     ** Note: substitutions w indels is much slower than just substitutions, but provides
     ** more accurate results. Powered by edlib. Please visit and give credit at github.com/Martinos/edlib
+    ** With self.both_strands the reverse complement queries are matched in the same call
     """
-    def _cpp_fuzzy_match(self, peptide_map, fastq_file, data_directory, mismatches, subOnly=False):
-        new_path = os.path.join(self._pkl_file_path, data_directory)
-        if not os.path.exists(new_path):
-            os.mkdir(new_path)
+    def fuzzy_match_table(self, peptide_map, fastq_file, mismatches, subOnly=False, data_directory=""):
+        queries = list(peptide_map.keys())
+        reverse = self.reverse_queries(queries) if self.both_strands else {}
+        queries += list(reverse.keys())
 
-        dna_seq = self.load_dna_seq(fastq_file=fastq_file)
+        if self.distributed:
+            hits = self._map_reduce(fastq_file, data_directory, {"mode": "fuzzy", "mismatches": mismatches, "subOnly": subOnly},
+                                    {"queries": queries})
+        else:
+            unique_reads = self.collapse_reads(fastq_file)
 
-        counts = fuzzy_match.fuzzy_match(list(peptide_map.keys()), dna_seq.encode(), mismatches, subOnly)
+            hits = fuzzy_match.fuzzy_match_reads(queries, list(unique_reads.keys()), list(unique_reads.values()), mismatches, subOnly)
 
-        sorted_count = dict(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+        counts = {query: hits.get(query, 0) for query in peptide_map.keys()}
+        strands = None
+        if self.both_strands:
+            strands = {query: [count, 0] for query, count in counts.items()}
+            for rc, query in reverse.items():
+                strands[query][1] += hits.get(rc, 0)
+            counts = {query: sum(strands[query]) for query in counts}
+            strands = {peptide_map[k]: v for k, v in strands.items()}
 
-        sorted_count = {peptide_map[k]:v for k,v in sorted_count.items()}
+        patterns, ranked_counts = ranking.ranked(counts)
 
-        self.add_decimal(sorted_count, os.path.join(new_path, f"variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
+        return self.decimal_table(([peptide_map[k] for k in patterns], ranked_counts), strands=strands)
+
+    """
+    _cpp_fuzzy_match: dict, str, str, int, bool --> DataFrame
+    -- Fuzzy matches peptides (see fuzzy_match_table) and saves the table
+    -- into the session
+    * @param [in] peptide_map (dict) - Map of peptides to sequences
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] mismatches (int) - Number of allowed mismatches
+    * @param [in] subOnly (bool) - If True, only allow substitutions; if False, allow indels too
+    * @param [out] table (DataFrame) - The saved table
+    """
+    def _cpp_fuzzy_match(self, peptide_map, fastq_file, data_directory, mismatches, subOnly=False):
+        new_path = os.path.join(self._pkl_file_path, data_directory)
+        if not os.path.exists(new_path):
+            os.mkdir(new_path)
+
+        table = self.fuzzy_match_table(peptide_map, fastq_file, mismatches, subOnly, data_directory)
+        table.to_pickle(os.path.join(new_path, f"variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
 
         with open(self._instructions_file, "rb+") as file:
             content = pkl.load(file)
@@ -341,16 +720,64 @@ class search_aav9:
             file.seek(0)
             file.truncate()
             pkl.dump(content, file)
+        return table
 
     """
-    _cpp_filter_count: str, str, str --> None
+    filter_count_table: str, str, str --> DataFrame
     -- Python wrapper for filter_count.cpp (see for more detail)
-    -- Searches fastq files for AAV9 sequence containing 21-mer inserts 
-    -- and pulls out, sorts and counts them.
+    -- Searches fastq files for AAV9 sequence containing 21-mer inserts
+    -- and pulls out, sorts, counts and prunes them.
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] refseq (str) - Reference sequence
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] table (DataFrame) - Translated Peptide, Count and Decimal columns, plus
+    -- Forward Count and Reverse Count when self.both_strands
+    ** Wrapper for C++ filter_count function. filter_count already finds the
+    ** reverse reads and flips them, by default only the forward reads are counted
+    """
+    def filter_count_table(self, fastq_file, refseq, data_directory=""):
+        strands = None
+        if self.distributed:
+            # Every worker maps its byte range and hands it to filter_count_buffer
+            inserts = self._map_reduce(fastq_file, data_directory, {"mode": "filter", "refseq": refseq, "both_strands": self.both_strands})
+            if self.both_strands:
+                inserts, strands = self.split_strands(inserts)
+            merc = self.sort_list(inserts)
+        else:
+            result = filter_module.FilterResult()
+            if self.mask_file(fastq_file): # The scanner skips the failing reads itself
+                mask = quality_mask.load(self.mask_file(fastq_file), fastq_file)
+                with fastq.map_range(fastq_file) as view:
+                    result = filter_module.filter_count_buffer(view, refseq, mask.bitmap, 0)
+            else:
+                result = filter_module.filter_count(fastq_file.encode(), refseq.encode())
+
+            print(len(result.forward_reads))
+            print(len(result.reverse_reads))
+            print(len(result.junk_reads))
+            self._num_reads = result.total_reads
+            self._num_unique_reads = result.total_reads # filter_count scans the file itself
+
+            if self.both_strands:
+                inserts, strands = self.split_strands(Counter([(read, "+") for read in result.forward_reads] +
+                                                              [(read, "-") for read in result.reverse_reads]))
+                merc = self.sort_list(inserts)
+            else:
+                merc = self.sort_list(result.forward_reads)
+         
+        with self.telemetry.stage("pruning", directory=data_directory, file=os.path.basename(fastq_file)) as record:
+            record["reads"] = len(merc)
+            merc = self.prune_reads(0.05, merc, strands)
+
+        return self.decimal_table(merc, merc=True, strands=strands)
+
+    """
+    _cpp_filter_count: str, str, str --> DataFrame
+    -- Runs filter_count_table and saves the table into the session
     * @param [in] data_directory (str) - Data directory path
     * @param [in] fastq_file (str) - Path to FASTQ file
     * @param [in] refseq (str) - Reference sequence
-    * @param [out] None - Saves filtered results to pickle file
+    * @param [out] table (DataFrame) - The saved table
     ** Wrapper for C++ filter_count function
     """
     def _cpp_filter_count(self, data_directory, fastq_file, refseq):
@@ -358,18 +785,8 @@ class search_aav9:
         if not os.path.exists(new_path):
             os.mkdir(new_path)
 
-        result = filter_module.FilterResult()
-        result = filter_module.filter_count(fastq_file.encode(), refseq.encode())
-
-        print(len(result.forward_reads))
-        print(len(result.reverse_reads))
-        print(len(result.junk_reads))
-
-        merc = self.sort_list(result.forward_reads)
-         
-        merc = self.prune_reads(0.05, merc)
-
-        self.add_decimal(merc, os.path.join(new_path, f"unknown_variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"), merc=True)
+        table = self.filter_count_table(fastq_file, refseq, data_directory)
+        table.to_pickle(os.path.join(new_path, f"unknown_variants_{os.path.basename(fastq_file.replace('.fastq', ''))}.pkl"))
 
         with open(self._instructions_file, "rb+") as file:
             content = pkl.load(file)
@@ -380,49 +797,192 @@ class search_aav9:
             file.seek(0)
             file.truncate()
             pkl.dump(content, file)
+        return table
 
     """
-    add_decimal: dict, str, bool --> None
-    -- Add's a Decimal column to a dictionary with Peptide's and there
-    -- counts
-    * @param [in] data_dict (dict) - Dictionary with peptide counts
-    * @param [in] file (str) - Path to save pickle file
+    library_tables: tagged_matcher, str, str --> dict
+    -- Counts every library of a multilib.tagged_matcher in one pass over the
+    -- FASTQ file and splits the counts into one table per library, without
+    -- touching the session
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] tables (dict) - Library name --> table. Capsid libraries get the
+    -- count_known_table layout, flank libraries the pruned and translated flank_table layout
+    """
+    def library_tables(self, matcher, fastq_file, data_directory=""):
+        if self.distributed:
+            hits = self._map_reduce(fastq_file, data_directory, {"mode": "libraries"}, {"matcher": matcher})
+        else:
+            hits = matcher.count(self.collapse_reads(fastq_file))
+        return self._split_libraries(matcher, hits, fastq_file, data_directory)
+
+    """
+    demux_tables: tagged_matcher, barcode_sheet, str, str --> dict
+    -- Demultiplexes a pooled FASTQ file by sample barcode and counts every
+    -- library of every sample in the same pass, without touching the session
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] sheet (barcode_sheet) - Sample barcodes (see demux.py)
+    * @param [in] fastq_file (str) - Path to the pooled FASTQ file
+    * @param [in] data_directory (str) - Data directory name, used for scratch folders
+    * @param [out] tables (dict) - Sample --> library name --> table (see library_tables)
+    ** The reads of every sample and the unassigned reads are kept in
+    ** self.sample_reads and self.unassigned_reads
+    """
+    def demux_tables(self, matcher, sheet, fastq_file, data_directory=""):
+        if self.distributed:
+            hits = self._map_reduce(fastq_file, data_directory, {"mode": "demux"}, {"matcher": matcher, "sheet": sheet})
+        else:
+            hits = sheet.count(matcher, self.collapse_reads(fastq_file))
+
+        self.unassigned_reads = hits.pop((None, None, None), 0)
+        self.sample_reads = {sample: hits.pop((sample, None, None), 0) for sample in sheet.barcodes}
+        sample_counts = {sample: Counter() for sample in sheet.barcodes}
+        for (sample, name, key), count in hits.items():
+            sample_counts[sample][(name, key)] += count
+        return {sample: self._split_libraries(matcher, counts, fastq_file, sample) for sample, counts in sample_counts.items()}
+
+    """
+    _split_libraries: tagged_matcher, Counter, str, str --> dict
+    -- Splits tagged matcher counts into one table per library
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] hits (Counter) - (library name, sequence) --> count
+    * @param [in] fastq_file (str) - Path to FASTQ file, for telemetry
+    * @param [in] data_directory (str) - Data directory name, for telemetry
+    * @param [out] tables (dict) - Library name --> table
+    """
+    def _split_libraries(self, matcher, hits, fastq_file, data_directory):
+        library_counts = {library.name: Counter() for library in matcher.libraries}
+        for (name, key), count in hits.items():
+            library_counts[name][key] += count
+
+        tables = {}
+        for library in matcher.libraries:
+            counts = library_counts[library.name]
+            if library.kind == "capsid":
+                counts = {pattern: counts.get(pattern, 0) for pattern in library.peptide_map}
+                patterns, ranked_counts = ranking.ranked(counts)
+                tables[library.name] = self.decimal_table(([library.peptide_map[k] for k in patterns], ranked_counts))
+            else:
+                sorted_read = ranking.ranked_dict(counts)
+                with self.telemetry.stage("pruning", directory=multilib.library_directory(data_directory, library.name),
+                                          file=os.path.basename(fastq_file)) as record:
+                    record["reads"] = len(sorted_read)
+                    sorted_read = self.prune_reads(0.05, sorted_read)
+                tables[library.name] = self.decimal_table(sorted_read, merc=True)
+        return tables
+
+    """
+    count_libraries: tagged_matcher, str, str --> dict
+    -- Counts every library in one pass (see library_tables) and saves each
+    -- table into the session under its own data directory
+    -- (multilib.library_directory), with the instructions key of its kind
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] fastq_file (str) - Path to FASTQ file
+    * @param [in] data_directory (str) - Data directory path
+    * @param [out] tables (dict) - Library name --> saved table
+    """
+    def count_libraries(self, matcher, fastq_file, data_directory):
+        tables = self.library_tables(matcher, fastq_file, data_directory)
+        self._save_library_tables(matcher, {data_directory: tables}, fastq_file)
+        return tables
+
+    """
+    count_demultiplexed: tagged_matcher, barcode_sheet, str, str --> dict
+    -- Demultiplexes and counts a pooled FASTQ file (see demux_tables) and
+    -- saves the tables of every sample as if the sample had its own data
+    -- directory (multilib.library_directory(sample, library))
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] sheet (barcode_sheet) - Sample barcodes (see demux.py)
+    * @param [in] fastq_file (str) - Path to the pooled FASTQ file
+    * @param [in] data_directory (str) - Data directory path, used for scratch folders
+    * @param [out] tables (dict) - Sample --> library name --> saved table
+    """
+    def count_demultiplexed(self, matcher, sheet, fastq_file, data_directory):
+        tables = self.demux_tables(matcher, sheet, fastq_file, data_directory)
+        self._save_library_tables(matcher, tables, fastq_file)
+        return tables
+
+    """
+    _save_library_tables: tagged_matcher, dict, str --> None
+    -- Pickles library tables into the session and lists them in the instructions
+    * @param [in] matcher (tagged_matcher) - Compiled libraries (see multilib.py)
+    * @param [in] tables (dict) - Data directory (or sample) --> library name --> table
+    * @param [in] fastq_file (str) - Path to the counted FASTQ file
+    """
+    def _save_library_tables(self, matcher, tables, fastq_file):
+        name = os.path.basename(fastq_file.replace('.fastq', ''))
+
+        with open(self._instructions_file, "rb+") as file:
+            content = pkl.load(file)
+            for data_directory, library_tables in tables.items():
+                for library in matcher.libraries:
+                    library_dir = multilib.library_directory(data_directory, library.name)
+                    new_path = os.path.join(self._pkl_file_path, library_dir)
+                    if not os.path.exists(new_path):
+                        os.mkdir(new_path)
+                    library_tables[library.name].to_pickle(os.path.join(new_path, f"{library.file_prefix}{name}.pkl"))
+                    content.setdefault(library.instructions_link, []).append(os.path.join("pkl_files", library_dir, f"{library.file_prefix}{name}.pkl"))
+            file.seek(0)
+            file.truncate()
+            pkl.dump(content, file)
+
+    """
+    decimal_table: dict, bool --> DataFrame
+    -- Builds the Peptide/Count/Decimal table from a dictionary with
+    -- Peptide's and there counts
+    * @param [in] data_dict (dict) - Dictionary with peptide counts (or iterable of pairs), or a
+    -- (peptides, counts) tuple of arrays in rank order (see ranking.ranked)
     * @param [in] merc (bool) - Whether to translate peptides
-    * @param [out] None - Saves DataFrame with decimal column to pickle file
-    ** Adds decimal column to peptide count dictionary
+    * @param [in] strands (dict) - Optional peptide --> [forward, reverse] counts (see split_strands)
+    * @param [out] df (DataFrame) - Table with a Decimal column, and Forward Count and
+    -- Reverse Count columns when strands is given
     """
-    def add_decimal(self, data_dict, file, merc=False):
-        df = pd.DataFrame(list(data_dict.items()), columns=["Peptide", "Count"])
+    def decimal_table(self, data_dict, merc=False, strands=None):
+        if isinstance(data_dict, tuple):
+            df = pd.DataFrame({"Peptide": data_dict[0], "Count": data_dict[1]}, columns=["Peptide", "Count"])
+        else:
+            items = data_dict.items() if isinstance(data_dict, dict) else data_dict
+            df = pd.DataFrame(list(items), columns=["Peptide", "Count"])
         total = df["Count"].sum()
         if total == 0:
             df["Decimal"] = 0.0
         else:
             df["Decimal"] = df["Count"] / total
+        if strands is not None:
+            df["Forward Count"] = [strands.get(peptide, (0, 0))[0] for peptide in df["Peptide"]]
+            df["Reverse Count"] = [strands.get(peptide, (0, 0))[1] for peptide in df["Peptide"]]
         # Do not filter out zeros, keep all peptides
         if merc:
             df["Peptide"] = df["Peptide"].apply(self.translate)
-        df.to_pickle(file)
+        return df
 
     """
-    create_avg_pkl: str, list, str --> str
-    -- Creates an average pkl file with all the data from the other fastq 
-    -- files. Adds a Decimal Column too.
-    * @param [in] data_directory (str) - Data directory path
-    * @param [in] files (list) - List of file names
-    * @param [in] instruction_link (str) - Instruction link for file extension
-    * @param [out] result (str) - Name of the generated average file
-    ** Creates average pickle file from multiple FASTQ files
+    add_decimal: dict, str, bool --> None
+    -- Add's a Decimal column to a dictionary with Peptide's and there
+    -- counts
+    * @param [in] data_dict (dict) - Dictionary with peptide counts (or iterable of pairs)
+    * @param [in] file (str) - Path to save pickle file
+    * @param [in] merc (bool) - Whether to translate peptides
+    * @param [out] None - Saves DataFrame with decimal column to pickle file
+    ** Adds decimal column to peptide count dictionary
     """
-    def create_avg_pkl(self, data_directory, files, instruction_link):
-        if instruction_link == "count_known_reads":
-            file_ext = "variants_"
-        else:
-            file_ext = "unknown_variants_"
+    def add_decimal(self, data_dict, file, merc=False):
+        self.decimal_table(data_dict, merc).to_pickle(file)
 
-        df_list = [pd.read_pickle(os.path.join(self.pkl_file_path, data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl")) for file in files]
+    """
+    avg_table: dict --> DataFrame
+    -- Merges the Decimal column of several count tables into one table
+    -- with an Average Decimal column
+    * @param [in] tables (dict) - File name --> count table (Peptide, Count, Decimal)
+    * @param [out] merged_df (DataFrame) - One column per file plus Average Decimal, indexed by Peptide
+    ** Peptides missing from a file are left empty and ignored by the mean
+    """
+    def avg_table(self, tables):
+        files = list(tables.keys())
         foo = []
 
-        for d in df_list:
+        for d in tables.values():
             obj_dict = dict(zip(d.Peptide, d.Decimal))
             foo.append(obj_dict)
         
@@ -435,6 +995,50 @@ class search_aav9:
         merged_df.index.name = "Peptide"
         merged_df["Average Decimal"] = merged_df[files].mean(axis=1)
         merged_df = merged_df.sort_values("Average Decimal", ascending=False)
+        return merged_df
+
+    """
+    update_aggregate: str, list, str, dict --> replicate_aggregate
+    -- Brings the running replicate aggregate of a data directory up to date
+    -- with its files and saves it with the session
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] files (list) - List of file names
+    * @param [in] instruction_link (str) - Instruction link for file extension
+    * @param [in] tables (dict) - Optional file name --> table already in memory
+    * @param [out] aggregate (replicate_aggregate) - The aggregate (see aggregate.py)
+    ** Only the pkls of files that are neither in memory nor aggregated yet are loaded
+    """
+    def update_aggregate(self, data_directory, files, instruction_link, tables=None):
+        if instruction_link == "count_known_reads":
+            file_ext = "variants_"
+        else:
+            file_ext = "unknown_variants_"
+
+        aggregate_path = os.path.join(self._pkl_file_path, data_directory, f"aggregate_{data_directory}.pkl")
+        aggregate = pkl.load(open(aggregate_path, "rb")) if os.path.exists(aggregate_path) else replicate_aggregate()
+        load = lambda file: pd.read_pickle(os.path.join(self.pkl_file_path, data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl"))
+        if aggregate.update(files, tables if tables else {}, load) or not os.path.exists(aggregate_path):
+            pkl.dump(aggregate, open(aggregate_path, "wb+"))
+        return aggregate
+
+    """
+    create_avg_pkl: str, list, str, dict, replicate_aggregate --> str
+    -- Creates an average pkl file with all the data from the other fastq 
+    -- files. Adds a Decimal Column too.
+    * @param [in] data_directory (str) - Data directory path
+    * @param [in] files (list) - List of file names
+    * @param [in] instruction_link (str) - Instruction link for file extension
+    * @param [in] tables (dict) - Optional file name --> table already in memory, skips reloading the pkls
+    * @param [in] aggregate (replicate_aggregate) - Optional aggregate already brought up to date with update_aggregate
+    * @param [out] result (str) - Name of the generated average file
+    ** Creates average pickle file from the running replicate aggregate, so only
+    ** added or changed files are merged in
+    """
+    def create_avg_pkl(self, data_directory, files, instruction_link, tables=None, aggregate=None):
+        if aggregate is None:
+            aggregate = self.update_aggregate(data_directory, files, instruction_link, tables)
+
+        merged_df = aggregate.average_table()
         pkl.dump(merged_df, open(os.path.join(self._pkl_file_path, data_directory, f"average_{data_directory}.pkl"), "wb+"))
         return f"average_{data_directory}.fastq"
     
@@ -446,21 +1050,20 @@ class search_aav9:
     ** Sorts list by frequency in descending order
     """
     def sort_list(self, lst):
-        unsorted = Counter(lst)
-        sorted_lst = sorted(unsorted.items(), key = lambda item: (-item[1], item[0]))
-        return OrderedDict(sorted_lst)
+        return ranking.ranked_by_key(Counter(lst))
 
     """
     prune_reads: float, OrderedDict --> OrderedDict
     -- Prunes similar reads beyond a given threshold
     * @param [in] threshold (float) - Frequency threshold for pruning
     * @param [in] sorted_merlist (OrderedDict) - Sorted dictionary of sequences and counts
+    * @param [in] strands (dict) - Optional sequence --> [forward, reverse] counts, merged the same way
     * @param [out] pruned_merlist (OrderedDict) - Pruned dictionary with similar reads merged
     ** Forked from Killian Hanlon's Shuttlecock package
     ** Improved for efficiency and optimization
     """
     # TODO: Create C++ wrapper for this function
-    def prune_reads(self, threshold, sorted_merlist):
+    def prune_reads(self, threshold, sorted_merlist, strands=None):
         highfreq_raws = []
         highfreq_translated = set()
 
@@ -484,12 +1087,59 @@ class search_aav9:
                 #Hamming distance
                 if fuzzy_match.peptide_levenshtein_distance(x, y) <= 1:
                     sorted_merlist[x] += sorted_merlist[y]
+                    if strands is not None:
+                        strands[x] = [a + b for a, b in zip(strands[x], strands[y])]
                     delset.add(y)
         for item in delset:
             del sorted_merlist[item]
 
         return sorted_merlist
     
+    """
+    prune_sorted_reads: float, callable, int --> generator
+    -- Streaming version of prune_reads for tables that don't fit in memory.
+    -- Makes two passes over the sorted items and yields the pruned table.
+    * @param [in] threshold (float) - Frequency threshold for pruning
+    * @param [in] sorted_items (callable) - Returns a fresh (seq, count) iterator sorted by count
+    * @param [in] num_of_mers (int) - Number of distinct sequences
+    * @param [in] merges (dict) - Optional, filled with pruned seq --> high frequency seqs it was merged into
+    * @param [out] pruned (generator) - (seq, count) tuples, same result as prune_reads
+    ** merges only holds the pruned sequences, so other per-sequence counts
+    ** (such as strand counts) can be merged the same way in one more pass
+    """
+    def prune_sorted_reads(self, threshold, sorted_items, num_of_mers, merges=None):
+        highfreq_raws = []
+        highfreq_translated = set()
+
+        for var, count in sorted_items():
+            if count / num_of_mers >= threshold:
+                translated_var = self.translate(var)
+                if translated_var not in highfreq_translated:
+                    highfreq_raws.append(var)
+                    highfreq_translated.add(translated_var)
+            else:
+                break
+
+        highfreq_set = set(highfreq_raws)
+        additions = {x: 0 for x in highfreq_raws}
+        delset = set()
+
+        if highfreq_raws:
+            for y, count in sorted_items():
+                if y in highfreq_set:
+                    continue
+                for x in highfreq_raws:
+                    if fuzzy_match.peptide_levenshtein_distance(x, y) <= 1:
+                        additions[x] += count
+                        if merges is not None:
+                            merges.setdefault(y, []).append(x)
+                        delset.add(y)
+
+        for var, count in sorted_items():
+            if var in delset:
+                continue
+            yield var, count + additions.get(var, 0)
+
     """
     translate: str --> str
     -- Translates DNA sequence to protein sequence using standard genetic code
@@ -567,6 +1217,50 @@ class search_aav9:
             pkl.dump(content, instruction_file)
             
 
+    """
+    save_stages: list --> None
+    -- Saves the per-stage telemetry records to the instructions file
+    * @param [in] records (list) - Stage records from telemetry.stage
+    * @param [out] None - Stores records under "stages" in the instructions file
+    ** Ends up in instruction.json after _serialize_pkl
+    """
+    def save_stages(self, records):
+        with open(self._instructions_file, "rb") as instruction_file:
+            content = pkl.load(instruction_file)
+
+        content.setdefault("stages", []).extend(records)
+        content["stage_summary"] = self.telemetry.summary()
+
+        with open(self._instructions_file, "wb") as instruction_file:
+            pkl.dump(content, instruction_file)
+
+    # Sparse samples x peptides count matrix of the session (see count_matrix.py)
+    @property
+    def session_matrix(self):
+        if self._count_matrix is None:
+            path = os.path.join(self._pkl_file_path, "count_matrix.pkl")
+            self._count_matrix = count_matrix.load(path) if os.path.exists(path) else count_matrix()
+        return self._count_matrix
+
+    """
+    record_samples: str, list, dict, str --> None
+    -- Makes the samples of a data directory in the session matrix exactly its files
+    * @param [in] data_directory (str) - Data directory name
+    * @param [in] files (list) - Every counted file of the directory
+    * @param [in] tables (dict) - File name --> count table of the files counted now
+    * @param [in] instruction_link (str) - Instructions key of the tables
+    """
+    def record_samples(self, data_directory, files, tables, instruction_link):
+        self.session_matrix.update_directory(data_directory, {file: tables[file] for file in files if file in tables}, instruction_link, files)
+
+    """
+    save_matrix: None --> None
+    -- Saves the session matrix, if it was used, to pkl_files/count_matrix.pkl
+    """
+    def save_matrix(self):
+        if self._count_matrix is not None:
+            self._count_matrix.save(os.path.join(self._pkl_file_path, "count_matrix.pkl"))
+
     """
     _serialize_pkl: None --> None
     -- Serializes pickle instructions to JSON format
@@ -592,7 +1286,8 @@ class search_aav9:
         if not os.path.exists(self._cache_folder):
             os.mkdir(self._cache_folder)
 
-        sessions = os.listdir(self._cache_folder)
+        # Hidden folders hold shared caches (e.g. .libraries), not sessions
+        sessions = [session for session in os.listdir(self._cache_folder) if not session.startswith(".")]
 
         if len(sessions) > 0:
             sessions.append("Create new one")
@@ -650,19 +1345,26 @@ class search_aav9:
             os.mkdir(self._pkl_file_path)
 
     """
-    save_to_output: str --> None
-    -- Saves session data to output directory
+    save_to_output: str, str, bool --> None
+    -- Exports session data to the output directory (see session_export.py)
     * @param [in] output_dir (str) - Output directory path
-    * @param [out] None - Copies session data to output directory
-    ** Copies all session data to specified output directory
+    * @param [in] profile (str) - tables, plots or all (session_export.EXPORT_PROFILES)
+    * @param [in] archive (bool) - Stream one compressed tar archive into output_dir instead
+    * @param [out] None - Links or copies session data to output directory
+    ** On the same file system files are reflinked (copy-on-write) where the file system
+    ** supports it, otherwise copied, except quality masks, which are hardlinked
     """
-    def save_to_output(self, output_dir):
+    def save_to_output(self, output_dir, profile="all", archive=False):
         dir_to_copy = os.path.join(self._cache_folder, self._save_dir)
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
         try:
-            shutil.copytree(dir_to_copy, output_dir, dirs_exist_ok=True)
-            print(f"Successfully copied contents of '{dir_to_copy}' to '{output_dir}'")
+            if archive:
+                summary = session_export.export_archive(dir_to_copy, session_export.archive_path(output_dir, self._save_dir), profile)
+                print(f"Successfully archived {summary['files']} files of '{dir_to_copy}' ({summary['bytes'] / (1024 * 1024):.1f} MB) "
+                      f"into '{summary['archive']}' ({summary['archive_bytes'] / (1024 * 1024):.1f} MB)")
+            else:
+                summary = session_export.export_folder(dir_to_copy, output_dir, profile)
+                print(f"Successfully exported {summary['files']} files of '{dir_to_copy}' to '{output_dir}' "
+                      f"({summary['reflink']} reflinked, {summary['hardlink']} hardlinked, {summary['copy']} copied)")
         except shutil.Error as e:
             print(f"Error copying directory: {e}")
         except OSError as e:
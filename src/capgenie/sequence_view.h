@@ -0,0 +1,53 @@
+#pragma once
+
+// Zero-copy views of Python sequence data for the native extensions.
+// str, bytes and any buffer-protocol object (mmap, memoryview, bytearray,
+// NumPy uint8 arrays) are read in place instead of being copied into a
+// std::string.
+
+#include <pybind11/pybind11.h>
+#include <string_view>
+
+namespace py = pybind11;
+
+/**
+ * sequence_view: py::handle --> sequence_view
+-- Borrows the bytes of a Python object without copying them
+ * @param [in] obj (py::handle) - str, bytes or C-contiguous buffer object
+ * @param [out] view (std::string_view) - Pointer and length into obj's memory
+** obj must outlive the view. Buffers stay exported (an mmap can't be closed,
+** a bytearray can't be resized) until the sequence_view is destroyed, which
+** must happen while holding the GIL
+*/
+struct sequence_view {
+    std::string_view view;
+    Py_buffer buffer{};
+    bool has_buffer = false;
+
+    explicit sequence_view(py::handle obj) {
+        if (PyUnicode_Check(obj.ptr())) {
+            // ASCII strings hand out their own storage, nothing is encoded
+            Py_ssize_t size = 0;
+            const char* data = PyUnicode_AsUTF8AndSize(obj.ptr(), &size);
+            if (!data) throw py::error_already_set();
+            view = std::string_view(data, static_cast<size_t>(size));
+        } else if (PyBytes_Check(obj.ptr())) {
+            view = std::string_view(PyBytes_AS_STRING(obj.ptr()), static_cast<size_t>(PyBytes_GET_SIZE(obj.ptr())));
+        } else {
+            // PyBUF_SIMPLE only succeeds for contiguous memory
+            if (PyObject_GetBuffer(obj.ptr(), &buffer, PyBUF_SIMPLE) != 0) throw py::error_already_set();
+            has_buffer = true;
+            view = std::string_view(static_cast<const char*>(buffer.buf), static_cast<size_t>(buffer.len));
+        }
+    }
+
+    ~sequence_view() {
+        if (has_buffer) PyBuffer_Release(&buffer);
+    }
+
+    sequence_view(const sequence_view&) = delete;
+    sequence_view& operator=(const sequence_view&) = delete;
+
+    const char* data() const { return view.data(); }
+    size_t size() const { return view.size(); }
+};
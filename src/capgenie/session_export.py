@@ -0,0 +1,176 @@
+# File that exports a session folder (-o/--output) without copying it byte by
+# byte where it can. On the same file system files are reflinked (a
+# copy-on-write clone, where the file system supports it), so exporting takes
+# about as long as listing the session and a later run can't change the export.
+# Otherwise only files that are never rewritten in place are hardlinked: quality
+# masks, which quality_mask.build writes to a temporary file and renames over
+# the old one (LINKED_KINDS). Everything else (pkl tables, the count matrix,
+# spreadsheets, denoised copies) is rewritten in place by a rerun of the
+# session, so it is copied, and an export stays a snapshot.
+#
+# A profile picks what is exported, by the kinds of cache_manager.py:
+#
+#   tables - session metadata, pkl tables and spreadsheets
+#   plots  - tables plus charts and other outputs (e.g. motifs)
+#   all    - the whole session except scratch folders
+#
+# Instead of a folder, the export can also be streamed into one compressed
+# tar archive (zstd, or gzip when the zstandard package is missing).
+
+import os
+import shutil
+import tarfile
+from capgenie import cache_manager
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows, reflinks are skipped
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError: # Archives fall back to gzip
+    zstandard = None
+
+FICLONE = 0x40049409 # Linux ioctl that clones a file's extents (Btrfs, XFS, bcachefs)
+LINKED_KINDS = ("mask",) # Kinds only ever replaced by a rename, safe to hardlink
+EXPORT_PROFILES = {
+    "tables": ("metadata", "table"),
+    "plots": ("metadata", "table", "chart", "other"),
+    "all": ("metadata", "table", "chart", "other", "denoised", "mask"),
+}
+
+
+"""
+ * session_files: str, str --> list
+-- Files of a session folder that belong to an export profile
+ * @param [in] session_dir (str) - Session folder
+ * @param [in] profile (str) - Key of EXPORT_PROFILES
+ * @param [out] files (list) - (path, path relative to the session folder, kind), in walk order
+"""
+def session_files(session_dir, profile="all"):
+    if profile not in EXPORT_PROFILES:
+        raise ValueError(f"Unknown export profile {profile}, expected one of {', '.join(EXPORT_PROFILES)}")
+    kinds = EXPORT_PROFILES[profile]
+    session = os.path.basename(os.path.normpath(session_dir))
+    files = []
+    for root, dirs, names in os.walk(session_dir):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, session_dir)
+            _, kind, _ = cache_manager.cache_manager.kind_of((session,) + tuple(relative.split(os.sep)))
+            if kind in kinds:
+                files.append((path, relative, kind))
+    return files
+
+"""
+ * _reflink: str, str --> None
+-- Clones src into dst, raises OSError where the file system can't
+"""
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError("Reflinks need fcntl")
+    with open(src, "rb") as source, open(dst, "wb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+"""
+ * link_or_copy: str, str, bool, bool --> str
+-- Puts a file at dst as cheaply as possible, replacing what is there
+ * @param [in] src (str) - Source file
+ * @param [in] dst (str) - Destination path (its folder must exist)
+ * @param [in] same_device (bool) - Whether src and dst are on the same file system
+ * @param [in] linkable (bool) - Whether src is never rewritten in place, so a hardlink stays a snapshot
+ * @param [out] method (str) - reflink, hardlink or copy
+"""
+def link_or_copy(src, dst, same_device, linkable=False):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if same_device:
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except OSError:
+            pass
+        if linkable:
+            try:
+                os.link(src, dst)
+                return "hardlink"
+            except OSError:
+                pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+"""
+ * export_folder: str, str, str --> dict
+-- Exports a session into a folder, keeping its layout
+ * @param [in] session_dir (str) - Session folder
+ * @param [in] output_dir (str) - Output folder, created if missing, existing files are replaced
+ * @param [in] profile (str) - Key of EXPORT_PROFILES
+ * @param [out] summary (dict) - files, bytes and the number of files per method (reflink, hardlink, copy)
+"""
+def export_folder(session_dir, output_dir, profile="all"):
+    os.makedirs(output_dir, exist_ok=True)
+    same_device = os.stat(session_dir).st_dev == os.stat(output_dir).st_dev
+    summary = {"files": 0, "bytes": 0, "reflink": 0, "hardlink": 0, "copy": 0}
+    for path, relative, kind in session_files(session_dir, profile):
+        target = os.path.join(output_dir, relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        summary[link_or_copy(path, target, same_device, kind in LINKED_KINDS)] += 1
+        summary["files"] += 1
+        summary["bytes"] += os.path.getsize(path)
+    return summary
+
+"""
+ * archive_path: str, str --> str
+-- Path of the archive of a session in an output folder
+ * @param [out] path (str) - <output_dir>/<session>.tar.zst (.tar.gz without zstandard)
+"""
+def archive_path(output_dir, session):
+    return os.path.join(output_dir, f"{session}.tar.{'zst' if zstandard else 'gz'}")
+
+"""
+ * _add_files: file, str, list, str --> None
+-- Streams files into a tar archive written to fileobj, under the session's name
+"""
+def _add_files(fileobj, mode, files, session):
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for path, relative, _ in files:
+            tar.add(path, arcname=os.path.join(session, relative), recursive=False)
+
+"""
+ * export_archive: str, str, str --> dict
+-- Streams a session into one compressed tar archive
+ * @param [in] session_dir (str) - Session folder
+ * @param [in] path (str) - Archive path (see archive_path), .zst for zstd, otherwise gzip
+ * @param [in] profile (str) - Key of EXPORT_PROFILES
+ * @param [out] summary (dict) - files, bytes (before compression), archive and archive_bytes
+** Members are stored under the session's name. The archive is written to a
+** temporary file and renamed, so a failed export leaves no partial archive
+"""
+def export_archive(session_dir, path, profile="all"):
+    session = os.path.basename(os.path.normpath(session_dir))
+    files = session_files(session_dir, profile)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb") as raw:
+            if path.endswith(".zst"):
+                if zstandard is None:
+                    raise ValueError("zstd archives need the zstandard package")
+                with zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(raw, closefd=False) as compressed:
+                    _add_files(compressed, "w|", files, session)
+            else:
+                _add_files(raw, "w|gz", files, session)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {"files": len(files), "bytes": sum(os.path.getsize(file_path) for file_path, _, _ in files),
+            "archive": path, "archive_bytes": os.path.getsize(path)}
@@ -0,0 +1,187 @@
+# File that counts keys (e.g. unknown inserts) out of core. Counts are buffered
+# in memory up to a budget, then hash-partitioned into on-disk shards. Every
+# shard is merged and sorted on its own and the sorted shards are streamed back
+# with a k-way merge, giving exactly the same table and order as an in-memory
+# Counter sorted by count.
+
+import heapq
+import os
+import shutil
+import zlib
+
+ENTRY_OVERHEAD = 120 # Approximate bytes of a buffered dict entry besides the key itself
+DEFAULT_SHARDS = 64
+
+
+"""
+ * shard_of: str, int, int --> int
+-- Stable hash partition of a key (Python's hash() is salted per process)
+ * @param [in] key (str) - Key to partition
+ * @param [in] num_shards (int) - Number of shards
+ * @param [in] level (int) - Partition level, so oversized shards re-split differently
+ * @param [out] shard (int) - Shard number
+"""
+def shard_of(key, num_shards, level=0):
+    return zlib.crc32(f"{level}:{key}".encode()) % num_shards
+
+
+class shard_counter:
+    def __init__(self, folder, memory_budget, num_shards=DEFAULT_SHARDS):
+        self.folder = folder
+        self.memory_budget = memory_budget # bytes
+        self.num_shards = num_shards
+        self._buffer = {} # key --> [count, first seen]
+        self._buffer_bytes = 0
+        self._next_seen = 0
+        self._flushed = False
+        self._runs = None
+        self.num_distinct = 0
+        self.total = 0
+        os.makedirs(self.folder, exist_ok=True)
+
+    """
+    add: str, int --> None
+    -- Adds count to key, spilling the buffer to disk when it is over budget
+    * @param [in] key (str) - Key to count (must not contain tabs or newlines)
+    * @param [in] count (int) - Amount to add
+    * @param [out] None
+    ** First-seen order is tracked so ties sort like an in-memory Counter
+    """
+    def add(self, key, count=1):
+        entry = self._buffer.get(key)
+        if entry is None:
+            self._buffer[key] = [count, self._next_seen]
+            self._next_seen += 1
+            self._buffer_bytes += len(key) + ENTRY_OVERHEAD
+            if self._buffer_bytes > self.memory_budget:
+                self._spill()
+        else:
+            entry[0] += count
+        self.total += count
+
+    """
+    _spill: None --> None
+    -- Appends the buffered counts to the shard files and empties the buffer
+    """
+    def _spill(self):
+        shards = [[] for _ in range(self.num_shards)]
+        for key, (count, seen) in self._buffer.items():
+            shards[shard_of(key, self.num_shards)].append(f"{key}\t{count}\t{seen}\n")
+        for shard, lines in enumerate(shards):
+            if lines:
+                with open(os.path.join(self.folder, f"shard_{shard}.tsv"), "a") as f:
+                    f.writelines(lines)
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self._flushed = True
+
+    """
+    _merge_file: str, int --> list
+    -- Merges one shard file into a sorted list of (key, count, first_seen).
+    -- A shard that is itself over budget is re-partitioned one level deeper.
+    * @param [in] path (str) - Shard file
+    * @param [in] level (int) - Partition level of the shard
+    * @param [out] runs (list) - Paths of sorted run files
+    """
+    def _merge_file(self, path, level):
+        if os.path.getsize(path) > self.memory_budget and level < 4:
+            sub_paths = {}
+            with open(path) as f:
+                for line in f:
+                    sub = shard_of(line.split("\t", 1)[0], self.num_shards, level + 1)
+                    sub_path = f"{path}.{sub}"
+                    if sub not in sub_paths:
+                        sub_paths[sub] = open(sub_path, "a")
+                    sub_paths[sub].write(line)
+            for handle in sub_paths.values():
+                handle.close()
+            os.remove(path)
+            runs = []
+            for sub in sorted(sub_paths):
+                runs.extend(self._merge_file(f"{path}.{sub}", level + 1))
+            return runs
+
+        table = {}
+        with open(path) as f:
+            for line in f:
+                key, count, seen = line.rstrip("\n").split("\t")
+                entry = table.get(key)
+                if entry is None:
+                    table[key] = [int(count), int(seen)]
+                else:
+                    entry[0] += int(count)
+                    entry[1] = min(entry[1], int(seen))
+        os.remove(path)
+
+        run_path = path + ".run"
+        with open(run_path, "w") as f:
+            for key, (count, seen) in sorted(table.items(), key=lambda item: (-item[1][0], item[1][1])):
+                f.write(f"{key}\t{count}\t{seen}\n")
+        self.num_distinct += len(table)
+        return [run_path]
+
+    """
+    finish: None --> None
+    -- Spills whatever is buffered and turns every shard into a sorted run
+    """
+    def finish(self):
+        if self._runs is not None:
+            return
+        if not self._flushed:
+            # Everything fit in memory, keep it there
+            self.num_distinct = len(self._buffer)
+            self._runs = []
+            return
+        self._spill()
+        self._runs = []
+        for shard in range(self.num_shards):
+            path = os.path.join(self.folder, f"shard_{shard}.tsv")
+            if os.path.exists(path):
+                self._runs.extend(self._merge_file(path, 0))
+
+    """
+    _read_run: str --> generator
+    -- Streams (count, first_seen, key) tuples from a sorted run file
+    """
+    def _read_run(self, path):
+        with open(path) as f:
+            for line in f:
+                key, count, seen = line.rstrip("\n").split("\t")
+                yield (-int(count), int(seen), key)
+
+    """
+    sorted_items: None --> generator
+    -- Streams (key, count) by count descending, ties in first-seen order.
+    -- Can be called repeatedly, each call re-reads the runs from disk.
+    * @param [out] items (generator) - (key, count) tuples
+    ** Same order as sorted(Counter.items(), key=count, reverse=True)
+    """
+    def sorted_items(self):
+        self.finish()
+        if not self._runs:
+            for key, (count, seen) in sorted(self._buffer.items(), key=lambda item: (-item[1][0], item[1][1])):
+                yield key, count
+            return
+        for neg_count, seen, key in heapq.merge(*[self._read_run(path) for path in self._runs]):
+            yield key, -neg_count
+
+    """
+    top_k: int --> list
+    -- Returns the k most frequent (key, count) pairs
+    * @param [in] k (int) - Number of items
+    * @param [out] items (list) - (key, count) tuples
+    """
+    def top_k(self, k):
+        items = []
+        for item in self.sorted_items():
+            if len(items) == k:
+                break
+            items.append(item)
+        return items
+
+    """
+    cleanup: None --> None
+    -- Removes the shard folder
+    """
+    def cleanup(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
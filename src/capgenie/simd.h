@@ -0,0 +1,343 @@
+#pragma once
+
+// Vectorized kernels shared by the native extensions. The best implementation
+// for the running CPU (AVX2, SSE4.2 + POPCNT or scalar) is picked once at
+// runtime, so the same build runs everywhere. Set CAPGENIE_SIMD=scalar, sse4.2
+// or avx2 to cap the level (e.g. to compare results or timings).
+
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+#include <vector>
+
+#if (defined(__GNUC__) || defined(__clang__)) && defined(__x86_64__)
+    #define CAPGENIE_X86_DISPATCH 1
+    #define CAPGENIE_TARGET(isa) __attribute__((target(isa)))
+    #include <immintrin.h>
+#elif defined(_MSC_VER) && defined(_M_X64)
+    // MSVC compiles every intrinsic without /arch flags, so the kernels need no target attribute
+    #define CAPGENIE_X86_DISPATCH 1
+    #define CAPGENIE_TARGET(isa)
+    #include <immintrin.h>
+    #include <intrin.h>
+#endif
+
+namespace simd {
+
+enum level { SCALAR = 0, SSE42 = 1, AVX2 = 2 };
+
+#ifdef CAPGENIE_X86_DISPATCH
+/**
+ * detect_level: None --> level
+-- Highest SIMD level the CPU (and, for AVX2, the OS) supports
+*/
+inline level detect_level() {
+#if defined(_MSC_VER) && !defined(__clang__)
+    int info[4];
+    __cpuid(info, 0);
+    const int max_leaf = info[0];
+    __cpuid(info, 1);
+    const bool popcnt = (info[2] >> 23) & 1, sse42 = (info[2] >> 20) & 1;
+    // AVX registers are only usable if the OS saves them (OSXSAVE, then XCR0 bits 1 and 2)
+    const bool os_avx = ((info[2] >> 27) & 1) && ((info[2] >> 28) & 1) && (_xgetbv(0) & 6) == 6;
+    bool avx2 = false;
+    if (max_leaf >= 7) {
+        __cpuidex(info, 7, 0);
+        avx2 = os_avx && ((info[1] >> 5) & 1);
+    }
+#else
+    __builtin_cpu_init();
+    const bool popcnt = __builtin_cpu_supports("popcnt"), sse42 = __builtin_cpu_supports("sse4.2");
+    const bool avx2 = __builtin_cpu_supports("avx2");
+#endif
+    if (avx2 && popcnt) return AVX2;
+    if (sse42 && popcnt) return SSE42;
+    return SCALAR;
+}
+#endif
+
+/**
+ * cpu_level: None --> level
+-- Returns the SIMD level used by the kernels, detected once
+ * @param [out] level (level) - SCALAR, SSE42 or AVX2
+** Capped by the CAPGENIE_SIMD environment variable
+*/
+inline level cpu_level() {
+    static const level detected = [] {
+        level found = SCALAR;
+#ifdef CAPGENIE_X86_DISPATCH
+        found = detect_level();
+#endif
+        const char* cap = std::getenv("CAPGENIE_SIMD");
+        if (cap) {
+            level limit = std::strcmp(cap, "scalar") == 0 ? SCALAR : std::strcmp(cap, "sse4.2") == 0 ? SSE42 : AVX2;
+            if (limit < found) found = limit;
+        }
+        return found;
+    }();
+    return detected;
+}
+
+/**
+ * level_name: None --> const char*
+-- Name of the active SIMD level, for logs and telemetry
+*/
+inline const char* level_name() {
+    switch (cpu_level()) {
+        case AVX2: return "avx2";
+        case SSE42: return "sse4.2";
+        default: return "scalar";
+    }
+}
+
+/**
+ * find_newline: const char*, const char* --> const char*
+-- Finds the next '\n' in [pos, end)
+ * @param [in] pos (const char*) - Where to start scanning
+ * @param [in] end (const char*) - End of the data
+ * @param [out] newline (const char*) - Position of the newline, or end if there is none
+** memchr is already vectorized (and CPU dispatched) by the C library
+*/
+inline const char* find_newline(const char* pos, const char* end) {
+    if (pos >= end) return end;
+    const char* found = static_cast<const char*>(std::memchr(pos, '\n', end - pos));
+    return found ? found : end;
+}
+
+// ---- Quality sums ----
+
+inline uint64_t sum_bytes_scalar(const unsigned char* data, size_t n) {
+    uint64_t total = 0;
+    for (size_t i = 0; i < n; ++i) total += data[i];
+    return total;
+}
+
+#ifdef CAPGENIE_X86_DISPATCH
+CAPGENIE_TARGET("sse4.2") inline uint64_t sum_bytes_sse42(const unsigned char* data, size_t n) {
+    const __m128i zero = _mm_setzero_si128();
+    __m128i acc = zero;
+    size_t i = 0;
+    for (; i + 16 <= n; i += 16) {
+        // sad against zero adds 8 bytes into each 64-bit lane
+        acc = _mm_add_epi64(acc, _mm_sad_epu8(_mm_loadu_si128(reinterpret_cast<const __m128i*>(data + i)), zero));
+    }
+    uint64_t total = static_cast<uint64_t>(_mm_cvtsi128_si64(acc)) + static_cast<uint64_t>(_mm_extract_epi64(acc, 1));
+    return total + sum_bytes_scalar(data + i, n - i);
+}
+
+CAPGENIE_TARGET("avx2") inline uint64_t sum_bytes_avx2(const unsigned char* data, size_t n) {
+    const __m256i zero = _mm256_setzero_si256();
+    __m256i acc = zero;
+    size_t i = 0;
+    for (; i + 32 <= n; i += 32) {
+        acc = _mm256_add_epi64(acc, _mm256_sad_epu8(_mm256_loadu_si256(reinterpret_cast<const __m256i*>(data + i)), zero));
+    }
+    alignas(32) uint64_t lanes[4];
+    _mm256_store_si256(reinterpret_cast<__m256i*>(lanes), acc);
+    return lanes[0] + lanes[1] + lanes[2] + lanes[3] + sum_bytes_scalar(data + i, n - i);
+}
+#endif
+
+/**
+ * quality_sum: const char*, size_t, int --> int64_t
+-- Sums the Phred scores of a quality line
+ * @param [in] quality (const char*) - Quality characters
+ * @param [in] n (size_t) - Number of characters
+ * @param [in] offset (int) - Phred offset (33 for Sanger/Illumina 1.8+)
+ * @param [out] total (int64_t) - Sum of (character - offset)
+*/
+inline int64_t quality_sum(const char* quality, size_t n, int offset = 33) {
+    const unsigned char* data = reinterpret_cast<const unsigned char*>(quality);
+    uint64_t total;
+#ifdef CAPGENIE_X86_DISPATCH
+    switch (cpu_level()) {
+        case AVX2: total = sum_bytes_avx2(data, n); break;
+        case SSE42: total = sum_bytes_sse42(data, n); break;
+        default: total = sum_bytes_scalar(data, n);
+    }
+#else
+    total = sum_bytes_scalar(data, n);
+#endif
+    return static_cast<int64_t>(total) - static_cast<int64_t>(offset) * static_cast<int64_t>(n);
+}
+
+// ---- Hamming distance over 2-bit packed bases ----
+
+const size_t MAX_PACKED_BASES = 32; // One 64-bit word
+const uint8_t INVALID_BASE = 4;
+
+/**
+ * base_code: char --> uint8_t
+-- 2-bit code of a base (A=0, C=1, G=2, T=3), INVALID_BASE for anything else
+*/
+inline uint8_t base_code(char c) {
+    static const struct table {
+        uint8_t codes[256];
+        table() {
+            std::memset(codes, INVALID_BASE, sizeof(codes));
+            codes[(unsigned char)'A'] = 0; codes[(unsigned char)'C'] = 1;
+            codes[(unsigned char)'G'] = 2; codes[(unsigned char)'T'] = 3;
+        }
+    } lookup;
+    return lookup.codes[static_cast<unsigned char>(c)];
+}
+
+/**
+ * pack_bases: const char*, size_t, uint64_t& --> bool
+-- Packs up to 32 bases into one word, first base in the highest bits
+ * @param [in] seq (const char*) - Bases
+ * @param [in] n (size_t) - Number of bases (<= MAX_PACKED_BASES)
+ * @param [out] word (uint64_t&) - Packed bases
+ * @param [out] packed (bool) - False if n is too long or seq has a non ACGT base
+*/
+inline bool pack_bases(const char* seq, size_t n, uint64_t& word) {
+    if (n == 0 || n > MAX_PACKED_BASES) return false;
+    word = 0;
+    for (size_t i = 0; i < n; ++i) {
+        uint8_t code = base_code(seq[i]);
+        if (code == INVALID_BASE) return false;
+        word = (word << 2) | code;
+    }
+    return true;
+}
+
+/**
+ * pack_windows: const char*, size_t, size_t, std::vector<uint64_t>&, std::vector<uint32_t>& --> size_t
+-- Packs every k-base window of a sequence with a rolling 2-bit encoding
+ * @param [in] seq (const char*) - Sequence
+ * @param [in] n (size_t) - Sequence length
+ * @param [in] k (size_t) - Window length (<= MAX_PACKED_BASES)
+ * @param [out] words (std::vector<uint64_t>&) - Packed window starting at every position
+ * @param [out] invalid (std::vector<uint32_t>&) - Windows containing a non ACGT base
+ * @param [out] windows (size_t) - Number of windows
+** Invalid windows still get a word (the bad base packs as A) and have to be
+** checked with a plain comparison by the caller
+*/
+inline size_t pack_windows(const char* seq, size_t n, size_t k, std::vector<uint64_t>& words, std::vector<uint32_t>& invalid) {
+    words.clear();
+    invalid.clear();
+    if (k == 0 || k > MAX_PACKED_BASES || n < k) return 0;
+    const uint64_t mask = k == MAX_PACKED_BASES ? ~0ULL : ((1ULL << (2 * k)) - 1);
+    const size_t windows = n - k + 1;
+    words.resize(windows);
+
+    uint64_t word = 0;
+    size_t last_bad = SIZE_MAX;
+    for (size_t j = 0; j < n; ++j) {
+        uint8_t code = base_code(seq[j]);
+        if (code == INVALID_BASE) {
+            code = 0;
+            last_bad = j;
+        }
+        word = ((word << 2) | code) & mask;
+        if (j + 1 >= k) {
+            size_t start = j + 1 - k;
+            words[start] = word;
+            if (last_bad != SIZE_MAX && last_bad >= start) invalid.push_back(static_cast<uint32_t>(start));
+        }
+    }
+    return windows;
+}
+
+/**
+ * popcount: uint64_t --> int
+-- Number of set bits, without assuming the POPCNT instruction
+** MSVC's __popcnt64 always emits POPCNT, so it gets the portable bit count
+*/
+inline int popcount(uint64_t x) {
+#if defined(__GNUC__) || defined(__clang__)
+    return __builtin_popcountll(x);
+#else
+    x = x - ((x >> 1) & 0x5555555555555555ULL);
+    x = (x & 0x3333333333333333ULL) + ((x >> 2) & 0x3333333333333333ULL);
+    x = (x + (x >> 4)) & 0x0f0f0f0f0f0f0f0fULL;
+    return static_cast<int>((x * 0x0101010101010101ULL) >> 56);
+#endif
+}
+
+/**
+ * packed_mismatches: uint64_t, uint64_t --> int
+-- Number of differing bases between two packed words
+*/
+inline int packed_mismatches(uint64_t a, uint64_t b) {
+    uint64_t diff = a ^ b;
+    diff = (diff | (diff >> 1)) & 0x5555555555555555ULL; // One bit per differing base
+    return popcount(diff);
+}
+
+inline size_t count_within_scalar(const uint64_t* words, size_t n, uint64_t query, int max_mismatch) {
+    size_t count = 0;
+    for (size_t i = 0; i < n; ++i) count += packed_mismatches(words[i], query) <= max_mismatch;
+    return count;
+}
+
+#ifdef CAPGENIE_X86_DISPATCH
+CAPGENIE_TARGET("sse4.2,popcnt") inline size_t count_within_popcnt(const uint64_t* words, size_t n, uint64_t query, int max_mismatch) {
+    size_t count = 0;
+    for (size_t i = 0; i < n; ++i) {
+        uint64_t diff = words[i] ^ query;
+        diff = (diff | (diff >> 1)) & 0x5555555555555555ULL;
+        count += static_cast<int>(_mm_popcnt_u64(diff)) <= max_mismatch;
+    }
+    return count;
+}
+
+CAPGENIE_TARGET("avx2,popcnt") inline size_t count_within_avx2(const uint64_t* words, size_t n, uint64_t query, int max_mismatch) {
+    const __m256i q = _mm256_set1_epi64x(static_cast<long long>(query));
+    const __m256i low_bits = _mm256_set1_epi64x(0x5555555555555555LL);
+    const __m256i nibble = _mm256_set1_epi8(0x0f);
+    const __m256i lut = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                         0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i limit = _mm256_set1_epi64x(max_mismatch);
+    const __m256i zero = _mm256_setzero_si256();
+
+    size_t count = 0;
+    size_t i = 0;
+    for (; i + 4 <= n; i += 4) {
+        __m256i diff = _mm256_xor_si256(_mm256_loadu_si256(reinterpret_cast<const __m256i*>(words + i)), q);
+        diff = _mm256_and_si256(_mm256_or_si256(diff, _mm256_srli_epi64(diff, 1)), low_bits);
+        // Nibble lookup popcount, then sad sums the bytes of every 64-bit lane
+        __m256i bits = _mm256_add_epi8(_mm256_shuffle_epi8(lut, _mm256_and_si256(diff, nibble)),
+                                       _mm256_shuffle_epi8(lut, _mm256_and_si256(_mm256_srli_epi64(diff, 4), nibble)));
+        __m256i mismatches = _mm256_sad_epu8(bits, zero);
+        int over = _mm256_movemask_pd(_mm256_castsi256_pd(_mm256_cmpgt_epi64(mismatches, limit)));
+        count += 4 - _mm_popcnt_u32(static_cast<unsigned>(over));
+    }
+    return count + count_within_popcnt(words + i, n - i, query, max_mismatch);
+}
+#endif
+
+/**
+ * count_within: const uint64_t*, size_t, uint64_t, int --> size_t
+-- Counts the packed windows within max_mismatch substitutions of a packed query
+ * @param [in] words (const uint64_t*) - Packed windows from pack_windows
+ * @param [in] n (size_t) - Number of windows
+ * @param [in] query (uint64_t) - Packed query of the same length
+ * @param [in] max_mismatch (int) - Maximum number of substitutions
+ * @param [out] count (size_t) - Number of matching windows
+*/
+inline size_t count_within(const uint64_t* words, size_t n, uint64_t query, int max_mismatch) {
+#ifdef CAPGENIE_X86_DISPATCH
+    switch (cpu_level()) {
+        case AVX2: return count_within_avx2(words, n, query, max_mismatch);
+        case SSE42: return count_within_popcnt(words, n, query, max_mismatch);
+        default: break;
+    }
+#endif
+    return count_within_scalar(words, n, query, max_mismatch);
+}
+
+/**
+ * window_mismatches_within: const char*, const char*, size_t, int --> bool
+-- Plain byte comparison with early exit, for windows that can't be packed
+*/
+inline bool window_mismatches_within(const char* window, const char* query, size_t n, int max_mismatch) {
+    int mismatches = 0;
+    for (size_t j = 0; j < n; ++j) {
+        if (window[j] != query[j] && ++mismatches > max_mismatch) return false;
+    }
+    return true;
+}
+
+} // namespace simd
@@ -12,7 +12,7 @@ class spreadsheet:
         self.cache_folder = cache_folder
 
     """
-    save_file: str, str, str, str, bool, bool --> None
+    save_file: str, str, str, str, bool, bool, DataFrame --> None
     -- Saves file into an excel spreadsheet
     * @param [in] pkl_file_path (str) - Path to pickle file directory
     * @param [in] file (str) - File name to save
@@ -20,10 +20,11 @@ class spreadsheet:
     * @param [in] instruction_link (str) - Instruction link for file extension
     * @param [in] avg_file (bool) - Whether this is an average file
     * @param [in] barcode (bool) - Whether to include barcode processing
+    * @param [in] table (DataFrame) - Optional table already in memory, skips reloading the pkl
     * @param [out] None - Saves Excel file to sheets directory
     ** Saves processed data to Excel spreadsheet format
     """
-    def save_file(self, pkl_file_path, file, data_directory, instruction_link, avg_file=False, barcode=True):
+    def save_file(self, pkl_file_path, file, data_directory, instruction_link, avg_file=False, barcode=True, table=None):
         if instruction_link == "count_known_reads":
             file_ext = "variants_"
         else:
@@ -33,7 +34,7 @@ class spreadsheet:
             os.mkdir(os.path.join(self.sheets_dir, data_directory))
 
         if not avg_file:
-            df = pd.read_pickle(os.path.join(pkl_file_path, data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl"))
+            df = table if table is not None else pd.read_pickle(os.path.join(pkl_file_path, data_directory, f"{file_ext}{file}").replace(".fastq", ".pkl"))
             # Ensure all expected peptides are present, fill missing with 0
             if "Peptide" in df.columns and "Count" in df.columns:
                 all_peptides = df["Peptide"].unique().tolist()
@@ -44,7 +45,7 @@ class spreadsheet:
                 df = df.reset_index()
             df.to_excel(os.path.join(self.sheets_dir, data_directory, f"{file_ext}{file}").replace(".fastq", ".xlsx"))
         else:
-            df = pd.read_pickle(os.path.join(pkl_file_path, data_directory, file).replace(".fastq", ".pkl"))
+            df = table if table is not None else pd.read_pickle(os.path.join(pkl_file_path, data_directory, file).replace(".fastq", ".pkl"))
             #extra_columns = ["_".join(column.split("_")[0:2]) for column in df.columns.to_list()[:-1]]
             #extra_columns.append(df.columns.to_list()[-1])
             #df.columns = extra_columns
@@ -0,0 +1,137 @@
+# File that records wall time, CPU time, throughput and peak memory for every
+# pipeline stage. Records are kept in the session's instructions and can also be
+# streamed as JSON-lines events while the run is in progress.
+
+from contextlib import contextmanager
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+
+"""
+ * peak_rss: None --> int or None
+-- Returns the peak resident set size of this process in bytes
+ * @param [out] peak (int or None) - Peak RSS in bytes, None if it can't be measured
+** Uses VmHWM on Linux (resettable between stages), falls back to getrusage
+"""
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+"""
+ * reset_peak_rss: None --> bool
+-- Resets the kernel's peak RSS counter so the next reading is per stage
+ * @param [out] reset (bool) - True if the counter was reset
+** Only Linux supports this (writing 5 to /proc/self/clear_refs)
+"""
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+"""
+ * cpu_time: None --> float
+-- Returns the CPU time used by this process, its native threads and any
+-- finished child processes
+ * @param [out] seconds (float) - User + system CPU seconds
+"""
+def cpu_time():
+    t = os.times()
+    return time.process_time() + t.children_user + t.children_system
+
+
+class telemetry:
+    def __init__(self, events_file=None):
+        self.records = []
+        self.events_file = events_file
+        self.listeners = []
+        self._active = [] # Open stages, so nested stages can report their peak upwards
+
+    """
+    emit: str, dict --> None
+    -- Sends one JSON event to the events file and any listeners
+    * @param [in] event (str) - Event name, e.g. "stage_start"
+    * @param [in] data (dict) - JSON serializable event fields
+    * @param [out] None - Appends a line to the events file
+    """
+    def emit(self, event, data):
+        payload = {"event": event, "time": time.time(), **data}
+        for listener in self.listeners:
+            listener(payload)
+        if self.events_file:
+            with open(self.events_file, "a") as f:
+                f.write(json.dumps(payload, default=str) + "\n")
+
+    """
+    stage: str, **info --> dict
+    -- Context manager that measures a single pipeline stage. The yielded
+    -- record can be updated with "bytes" and "reads" while the stage runs.
+    * @param [in] name (str) - Stage name (denoise, counting, pruning, ...)
+    * @param [in] info (dict) - Extra fields to store, e.g. directory/file/bytes
+    * @param [out] record (dict) - Stage record, appended to self.records on exit
+    ** Records wall_time, cpu_time, bytes, reads, throughput and peak_rss
+    """
+    @contextmanager
+    def stage(self, name, **info):
+        record = {"stage": name, "bytes": None, "reads": None, **info}
+        self.emit("stage_start", {k: v for k, v in record.items() if v is not None})
+        per_stage_rss = reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = cpu_time()
+        child_peak = {"peak_rss": 0}
+        self._active.append(child_peak)
+        try:
+            yield record
+        finally:
+            self._active.pop()
+            wall = time.perf_counter() - wall_start
+            record["wall_time"] = wall
+            record["cpu_time"] = cpu_time() - cpu_start
+            peak = peak_rss()
+            record["peak_rss"] = max(peak, child_peak["peak_rss"]) if peak is not None else None
+            if self._active and peak is not None:
+                # Resetting the counter for this stage hid it from the enclosing stage
+                self._active[-1]["peak_rss"] = max(self._active[-1]["peak_rss"], record["peak_rss"])
+            record["peak_rss_scope"] = "stage" if per_stage_rss else "process"
+            if wall > 0:
+                if record["bytes"] is not None:
+                    record["mb_per_sec"] = record["bytes"] / (1024 * 1024) / wall
+                if record["reads"] is not None:
+                    record["reads_per_sec"] = record["reads"] / wall
+            self.records.append(record)
+            self.emit("stage_end", record)
+
+    """
+    summary: None --> dict
+    -- Totals wall and CPU time per stage name so the dominant stage
+    -- of a run is easy to spot
+    * @param [out] totals (dict) - Stage name to {wall_time, cpu_time, count, peak_rss}
+    """
+    def summary(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"wall_time": 0.0, "cpu_time": 0.0, "count": 0, "peak_rss": 0})
+            total["wall_time"] += record["wall_time"]
+            total["cpu_time"] += record["cpu_time"]
+            total["count"] += 1
+            total["peak_rss"] = max(total["peak_rss"], record["peak_rss"] or 0)
+        return totals
@@ -0,0 +1,203 @@
+#pragma once
+
+// Persistent worker pool shared by everything in one native extension. Threads
+// are created once (sized by set_num_threads, CAPGENIE_THREADS or the hardware)
+// and reused by every call, instead of spawning and joining threads per query
+// or per file.
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <cstdlib>
+#include <exception>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <vector>
+#ifndef _WIN32
+    #include <unistd.h>
+#endif
+
+class thread_pool {
+public:
+    /**
+     * shared: None --> thread_pool&
+    -- The pool of this extension, created on first use
+    */
+    static thread_pool& shared() {
+        static thread_pool pool(default_threads());
+        return pool;
+    }
+
+    /**
+     * default_threads: None --> size_t
+    -- CAPGENIE_THREADS if set (see threads.py), otherwise the hardware thread count
+    */
+    static size_t default_threads() {
+        const char* env = std::getenv("CAPGENIE_THREADS");
+        long requested = env ? std::strtol(env, nullptr, 10) : 0;
+        if (requested > 0) return static_cast<size_t>(requested);
+        return std::max(1u, std::thread::hardware_concurrency());
+    }
+
+    explicit thread_pool(size_t num_threads) : threads(std::max<size_t>(1, num_threads)) {}
+
+    ~thread_pool() { stop(); }
+
+    thread_pool(const thread_pool&) = delete;
+    thread_pool& operator=(const thread_pool&) = delete;
+
+    /**
+     * num_threads: None --> size_t
+    -- Number of threads working on a parallel_for, the caller included
+    */
+    size_t num_threads() const { return threads; }
+
+    /**
+     * set_num_threads: size_t --> None
+    -- Resizes the pool, the workers are restarted lazily by the next parallel_for
+     * @param [in] num_threads (size_t) - Total threads, the calling thread included (>= 1)
+    */
+    void set_num_threads(size_t num_threads) {
+        std::lock_guard<std::mutex> job_lock(job_mutex);
+        stop();
+        threads = std::max<size_t>(1, num_threads);
+    }
+
+    /**
+     * parallel_for: size_t, callable --> None
+    -- Runs task(i) for every i in [0, num_tasks) on the pool and waits for all of them
+     * @param [in] num_tasks (size_t) - Number of tasks
+     * @param [in] task (callable) - Called once per index, from any thread
+    ** Tasks are handed out one index at a time, so uneven tasks balance out.
+    ** The calling thread works too. The first exception thrown by a task is
+    ** rethrown here once every task has finished. Calls from inside a task, or
+    ** with a single thread, run serially on the calling thread
+    */
+    void parallel_for(size_t num_tasks, const std::function<void(size_t)>& task) {
+        if (num_tasks == 0) return;
+        if (threads == 1 || num_tasks == 1 || in_worker()) {
+            for (size_t i = 0; i < num_tasks; ++i) task(i);
+            return;
+        }
+
+        std::lock_guard<std::mutex> job_lock(job_mutex); // One job at a time
+        start();
+
+        auto current = std::make_shared<job>(task, num_tasks);
+        {
+            std::lock_guard<std::mutex> lock(state->mutex);
+            state->current = current;
+            state->generation++;
+        }
+        state->wake.notify_all();
+
+        in_worker() = true;
+        current->run();
+        in_worker() = false;
+
+        std::unique_lock<std::mutex> lock(state->mutex);
+        state->done.wait(lock, [&] { return current->finished == current->num_tasks; });
+        state->current.reset();
+        lock.unlock();
+
+        if (current->error) std::rethrow_exception(current->error);
+    }
+
+private:
+    struct job {
+        const std::function<void(size_t)>& task;
+        size_t num_tasks;
+        std::atomic<size_t> next{0};
+        std::atomic<size_t> finished{0};
+        std::exception_ptr error;
+        std::mutex error_mutex;
+
+        job(const std::function<void(size_t)>& task, size_t num_tasks) : task(task), num_tasks(num_tasks) {}
+
+        // Returns true if this call finished the last task
+        bool run() {
+            bool last = false;
+            for (size_t i = next++; i < num_tasks; i = next++) {
+                try {
+                    task(i);
+                } catch (...) {
+                    std::lock_guard<std::mutex> lock(error_mutex);
+                    if (!error) error = std::current_exception();
+                }
+                last = ++finished == num_tasks;
+            }
+            return last;
+        }
+    };
+
+    struct worker_state {
+        std::mutex mutex;
+        std::condition_variable wake;
+        std::condition_variable done;
+        std::shared_ptr<job> current;
+        size_t generation = 0;
+        bool stopping = false;
+        std::vector<std::thread> workers;
+#ifndef _WIN32
+        pid_t owner = getpid();
+#endif
+    };
+
+    size_t threads;
+    std::mutex job_mutex;
+    std::unique_ptr<worker_state> state;
+
+    static bool& in_worker() {
+        static thread_local bool flag = false;
+        return flag;
+    }
+
+    void start() {
+#ifndef _WIN32
+        // A forked child (e.g. a mapreduce worker) inherits the pool object but
+        // not its threads. The copied state can't be joined or destroyed safely,
+        // so it is leaked and the child starts its own workers
+        if (state && state->owner != getpid()) state.release();
+#endif
+        if (state) return;
+        state = std::make_unique<worker_state>();
+        for (size_t t = 1; t < threads; ++t) {
+            state->workers.emplace_back([s = state.get()] { work(s); });
+        }
+    }
+
+    void stop() {
+#ifndef _WIN32
+        if (state && state->owner != getpid()) state.release();
+#endif
+        if (!state) return;
+        {
+            std::lock_guard<std::mutex> lock(state->mutex);
+            state->stopping = true;
+        }
+        state->wake.notify_all();
+        for (auto& worker : state->workers) worker.join();
+        state.reset();
+    }
+
+    static void work(worker_state* s) {
+        in_worker() = true;
+        size_t seen = 0;
+        while (true) {
+            std::shared_ptr<job> current;
+            {
+                std::unique_lock<std::mutex> lock(s->mutex);
+                s->wake.wait(lock, [&] { return s->stopping || (s->current && s->generation != seen); });
+                if (s->stopping) return;
+                seen = s->generation;
+                current = s->current;
+            }
+            if (current->run()) {
+                std::lock_guard<std::mutex> lock(s->mutex);
+                s->done.notify_all();
+            }
+        }
+    }
+};
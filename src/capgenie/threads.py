@@ -0,0 +1,76 @@
+# File that decides how many threads the native extensions use. The count
+# respects the CPU affinity mask and cgroup CPU quotas (docker --cpus, Slurm,
+# Kubernetes limits), so a job on a shared batch node doesn't start one thread
+# per physical core of the machine. The result is applied to the persistent
+# worker pools of fuzzy_match and denoise (see thread_pool.h) and exported as
+# CAPGENIE_THREADS for child processes.
+
+import math
+import os
+
+_configured = None
+
+
+"""
+ * _cgroup_cpu_limit: None --> float
+-- Reads the CPU quota of the current cgroup (v2, then v1)
+ * @param [out] limit (float) - Number of CPUs allowed by the quota, None if unlimited or unknown
+"""
+def _cgroup_cpu_limit():
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f: # cgroup v2: "<quota> <period>" or "max <period>"
+            quota, period = f.read().split()[:2]
+        if quota != "max" and int(period) > 0:
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+"""
+ * available_cpus: None --> int
+-- Number of CPUs this process may actually use
+ * @param [out] cpus (int) - min(affinity mask, cgroup quota rounded up), at least 1
+"""
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # macOS and Windows
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+"""
+ * current: None --> int
+-- Thread count set by configure(), or the available CPUs
+"""
+def current():
+    return _configured or available_cpus()
+
+"""
+ * configure: int --> int
+-- Sizes the native worker pools
+ * @param [in] threads (int) - Requested thread count, None or 0 for available_cpus()
+ * @param [out] threads (int) - The thread count in use
+"""
+def configure(threads=None):
+    global _configured
+    _configured = int(threads) if threads and int(threads) > 0 else available_cpus()
+    os.environ["CAPGENIE_THREADS"] = str(_configured)
+
+    from capgenie import fuzzy_match
+    from capgenie import denoise
+    for module in (fuzzy_match, denoise):
+        module.set_num_threads(_configured)
+    return _configured